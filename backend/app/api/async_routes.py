@@ -0,0 +1,84 @@
+from quart import Blueprint
+from quart import request, jsonify, current_app
+from app.services import langchain_service, strava_service, prefetch_service, retrieval_service
+from app.utils.deadline import Deadline
+from app.utils.singleflight import SingleFlight, normalize_query
+
+bp = Blueprint("async_api", __name__)
+
+# identical requests that arrive while one is in flight share its result
+chat_flights = SingleFlight("chat")
+recommendation_flights = SingleFlight("recommendations")
+
+@bp.route("/hello")
+async def hello():
+  return "hello world"
+
+@bp.route("/chat", methods=['GET', 'POST'])
+async def chat():
+  if request.method == 'GET':
+    pass
+  elif request.method == 'POST':
+    # process user query and generate a response
+    data = await request.get_json()
+    query = data['query']
+    if not query:
+      return jsonify({"error": "No query provided"}), 400
+
+    result = await chat_flights.ado(normalize_query(query), langchain_service.ahandle_query,
+                                    query=query, retriever=current_app.retriever)
+    return jsonify({ "query": query, **result })
+
+@bp.route("/recommendations", methods=['POST'])
+async def recommendations():
+  data = await request.get_json()
+  athlete_id = data.get('id')
+  athlete_location = data.get('location')
+  auth_header = request.headers.get('Authorization')
+
+  if not athlete_id:
+    return jsonify({'error': 'Athlete ID is required'}), 400
+
+  if not auth_header:
+    return jsonify({'error': 'Authorization header is missing'}), 401
+
+  # Extract the token from the header
+  access_token = auth_header.split(" ")[1]
+
+  # served straight from the prefetch started at login, if there is one, joining it if it is still
+  # running; otherwise computed here in whatever is left of the same deadline
+  deadline = Deadline()
+  result = await prefetch_service.aget_prefetched(athlete_id, access_token, athlete_location, deadline=deadline)
+  if result is not None:
+    return jsonify(result)
+
+  key = (str(athlete_id), normalize_query(athlete_location or ''), access_token)
+  result = await recommendation_flights.ado(key, strava_service.aget_recommendations, access_token=access_token,
+                                            athlete_id=athlete_id, athlete_location=athlete_location,
+                                            retriever=current_app.retriever, deadline=deadline)
+  return jsonify(result)
+
+@bp.route("/prefetch", methods=['POST'])
+async def prefetch():
+  data = await request.get_json()
+  athlete_id = data.get('id')
+  athlete_location = data.get('location')
+  auth_header = request.headers.get('Authorization')
+
+  if not athlete_id:
+    return jsonify({'error': 'Athlete ID is required'}), 400
+
+  if not auth_header:
+    return jsonify({'error': 'Authorization header is missing'}), 401
+
+  access_token = auth_header.split(" ")[1]
+  started = prefetch_service.aprefetch(athlete_id, access_token, athlete_location, retriever=current_app.retriever)
+  return jsonify({'status': 'started' if started else 'pending'}), 202
+
+@bp.route("/coalescing", methods=['GET'])
+async def coalescing():
+  return jsonify({
+    **{ flights.name: flights.stats() for flights in (chat_flights, recommendation_flights) },
+    'prefetch': prefetch_service.stats(),
+    'candidates': retrieval_service.candidate_cache_stats(),
+  })
@@ -1,10 +1,16 @@
 from flask import Blueprint
-from flask import request, jsonify
-from app.services import langchain_service, strava_service
+from flask import request, jsonify, current_app
+from app.services import langchain_service, strava_service, prefetch_service, retrieval_service
+from app.utils.deadline import Deadline
+from app.utils.singleflight import SingleFlight, normalize_query
 import requests
 
 bp = Blueprint("api", __name__)
 
+# identical requests that arrive while one is in flight share its result
+chat_flights = SingleFlight("chat")
+recommendation_flights = SingleFlight("recommendations")
+
 @bp.route("/hello")
 def hello():
   return "hello world"
@@ -19,8 +25,8 @@ def chat():
     if not query:
       return jsonify({"error": "No query provided"}), 400
     
-    answer = langchain_service.handle_query(query=query)
-    return jsonify({ "query": query, "answer": answer })
+    result = chat_flights.do(normalize_query(query), langchain_service.handle_query, query=query)
+    return jsonify({ "query": query, **result })
 
 @bp.route("/recommendations", methods=['POST'])
 def recommendations():
@@ -40,5 +46,39 @@ def recommendations():
   # Extract the token from the header
   access_token = auth_header.split(" ")[1] # Might need to handle the token more securely
   
-  recommendations = strava_service.get_recommendations(access_token=access_token, athlete_id=athlete_id, athlete_location=athlete_location)
-  return jsonify({ "recommendations": recommendations })
\ No newline at end of file
+  # served straight from the prefetch started at login, if there is one, joining it if it is still
+  # running; otherwise computed here in whatever is left of the same deadline
+  deadline = Deadline()
+  result = prefetch_service.get_prefetched(athlete_id, access_token, athlete_location, deadline=deadline)
+  if result is not None:
+    return jsonify(result)
+
+  key = (str(athlete_id), normalize_query(athlete_location or ''), access_token)
+  result = recommendation_flights.do(key, strava_service.get_recommendations, access_token=access_token,
+                                     athlete_id=athlete_id, athlete_location=athlete_location, deadline=deadline)
+  return jsonify(result)
+
+@bp.route("/prefetch", methods=['POST'])
+def prefetch():
+  data = request.json
+  athlete_id = data.get('id')
+  athlete_location = data.get('location')
+  auth_header = request.headers.get('Authorization')
+
+  if not athlete_id:
+    return jsonify({'error': 'Athlete ID is required'}), 400
+
+  if not auth_header:
+    return jsonify({'error': 'Authorization header is missing'}), 401
+
+  access_token = auth_header.split(" ")[1]
+  started = prefetch_service.prefetch(current_app._get_current_object(), athlete_id, access_token, athlete_location)
+  return jsonify({'status': 'started' if started else 'pending'}), 202
+
+@bp.route("/coalescing", methods=['GET'])
+def coalescing():
+  return jsonify({
+    **{ flights.name: flights.stats() for flights in (chat_flights, recommendation_flights) },
+    'prefetch': prefetch_service.stats(),
+    'candidates': retrieval_service.candidate_cache_stats(),
+  })
\ No newline at end of file
@@ -0,0 +1,41 @@
+from quart import Quart
+from quart_cors import cors
+from app.services import pinecone_service, retrieval_service, strava_client
+
+def create_asgi_app(test_config=None):
+  """
+  Create the async (ASGI) version of the app.
+
+  Serves the same API as `create_app`, but the handlers await the embedding, Pinecone,
+  Cohere, Strava and Groq calls instead of blocking a worker thread on them.
+  Run with: hypercorn "app.asgi:create_asgi_app()"
+  """
+  # create and configure the app
+  app = Quart(__name__, instance_relative_config=True)
+
+  # Enable CORS for all routes
+  app = cors(app, allow_origin="*")
+
+  # Initialize global variables
+  vector_store = pinecone_service.load_index()
+  retriever = retrieval_service.get_retriever(vector_store)
+
+  # Store in current_app
+  app.vector_store = vector_store
+  app.retriever = retriever
+
+  if test_config is None:
+    # load the instance config, if it exists, when not testing
+    app.config.from_pyfile('config.py', silent=True)
+  else:
+    app.config.from_mapping(test_config)
+
+  @app.after_serving
+  async def close_sessions():
+    await strava_client.aclose_session()
+
+  # register async api blueprint
+  from app.api import async_routes
+  app.register_blueprint(async_routes.bp)
+
+  return app
@@ -0,0 +1,230 @@
+import os
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+import numpy as np
+from app.services import strava_client
+from app.utils.singleflight import SingleFlight
+from app.utils.fitness_metrics import compute_metrics
+
+ACTIVITY_STORE_DIR = os.getenv('ACTIVITY_STORE_DIR', 'activity_store')
+ACTIVITIES_PER_PAGE = 200
+# per page request, so a sync never waits on Strava (or on the rate limiter) indefinitely
+ACTIVITY_SYNC_TIMEOUT_SECONDS = float(os.getenv('ACTIVITY_SYNC_TIMEOUT_SECONDS', 10))
+RUN_TYPES = {'Run', 'TrailRun', 'VirtualRun'}
+
+# column name -> dtype; start_date is epoch seconds, distance and elevation are meters
+COLUMNS = {
+  'activity_id': np.int64,
+  'start_date': np.int64,
+  'distance': np.float32,
+  'moving_time': np.int32,
+  'elevation': np.float32,
+}
+
+class ActivityColumns:
+  """
+  One athlete's runs, stored as growable NumPy column arrays ordered by start date.
+  """
+  __slots__ = ('size', 'columns')
+
+  def __init__(self, columns: Optional[Dict[str, np.ndarray]] = None):
+    columns = columns or {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+    self.size = len(columns['activity_id'])
+    self.columns = columns
+
+  def append(self, batch: Dict[str, np.ndarray]) -> None:
+    """
+    Append a batch of activities, growing the arrays geometrically so appends stay amortised O(1).
+
+    Args:
+    - batch (Dict[str, np.ndarray]): One array per column, all the same length.
+    """
+    n = len(batch['activity_id'])
+    if n == 0:
+      return
+    capacity = len(self.columns['activity_id'])
+    if self.size + n > capacity:
+      new_capacity = max(self.size + n, 2 * capacity, 64)
+      for name, dtype in COLUMNS.items():
+        grown = np.empty(new_capacity, dtype=dtype)
+        grown[:self.size] = self.columns[name][:self.size]
+        self.columns[name] = grown
+    for name in COLUMNS:
+      self.columns[name][self.size:self.size + n] = batch[name]
+    self.size += n
+
+  def __getitem__(self, name: str) -> np.ndarray:
+    return self.columns[name][:self.size]
+
+  @property
+  def cursor(self) -> int:
+    """The start date (epoch seconds) of the most recent stored activity, 0 if there are none."""
+    return int(self.columns['start_date'][self.size - 1]) if self.size else 0
+
+_store: Dict[int, ActivityColumns] = {}
+_lock = threading.Lock()
+# one sync per athlete at a time, concurrent callers share it
+_sync_flights = SingleFlight("activity_sync")
+
+def _path(athlete_id: int) -> str:
+  return os.path.join(ACTIVITY_STORE_DIR, f'{athlete_id}.npz')
+
+def get_activities(athlete_id: int) -> ActivityColumns:
+  """
+  Get an athlete's stored activities, loading them from disk on first use.
+
+  Args:
+  - athlete_id (int): The Strava athlete id.
+
+  Returns:
+  - ActivityColumns: The athlete's activity columns (empty if never synced).
+  """
+  athlete_id = int(athlete_id)
+  with _lock:
+    activities = _store.get(athlete_id)
+    if activities is None:
+      path = _path(athlete_id)
+      if os.path.exists(path):
+        with np.load(path) as saved:
+          activities = ActivityColumns({name: saved[name].astype(dtype) for name, dtype in COLUMNS.items()})
+      else:
+        activities = ActivityColumns()
+      _store[athlete_id] = activities
+    return activities
+
+def save_activities(athlete_id: int) -> None:
+  """
+  Persist an athlete's activity columns to ACTIVITY_STORE_DIR.
+
+  Args:
+  - athlete_id (int): The Strava athlete id.
+  """
+  activities = get_activities(athlete_id)
+  os.makedirs(ACTIVITY_STORE_DIR, exist_ok=True)
+  np.savez(_path(int(athlete_id)), **{name: activities[name] for name in COLUMNS})
+
+def known_athletes() -> List[int]:
+  """
+  List the athletes with stored activities.
+
+  Returns:
+  - List[int]: The athlete ids.
+  """
+  on_disk = set()
+  if os.path.isdir(ACTIVITY_STORE_DIR):
+    on_disk = {int(name[:-4]) for name in os.listdir(ACTIVITY_STORE_DIR) if name.endswith('.npz')}
+  with _lock:
+    return sorted(on_disk | set(_store))
+
+def _page_to_columns(page: List[Dict[str, Any]], after: int) -> Dict[str, np.ndarray]:
+  """
+  Convert a page of Strava activities into column arrays, keeping only runs newer than `after`.
+  """
+  runs = [activity for activity in page if activity.get('sport_type', activity.get('type')) in RUN_TYPES]
+  start_dates = np.array([activity['start_date'][:19] for activity in runs], dtype='datetime64[s]').astype(np.int64)
+  batch = {
+    'activity_id': np.array([activity['id'] for activity in runs], dtype=np.int64),
+    'start_date': start_dates,
+    'distance': np.array([activity.get('distance', 0.0) for activity in runs], dtype=np.float32),
+    'moving_time': np.array([activity.get('moving_time', 0) for activity in runs], dtype=np.int32),
+    'elevation': np.array([activity.get('total_elevation_gain', 0.0) for activity in runs], dtype=np.float32),
+  }
+  keep = start_dates > after
+  return {name: column[keep] for name, column in batch.items()}
+
+def iter_activity_pages(access_token: str, after: int = 0, per_page: int = ACTIVITIES_PER_PAGE,
+                        timeout: Optional[float] = ACTIVITY_SYNC_TIMEOUT_SECONDS) -> Iterator[List[Dict[str, Any]]]:
+  """
+  Stream the authenticated athlete's activities newer than `after`, one page at a time.
+  Only the current page is held in memory.
+
+  Args:
+  - access_token (str): The athlete's Strava access token.
+  - after (int, optional): Epoch seconds; only activities that start later are fetched. Defaults to 0.
+  - per_page (int, optional): The page size. Defaults to ACTIVITIES_PER_PAGE (Strava's max).
+  - timeout (Optional[float], optional): The timeout of each page request. Defaults to ACTIVITY_SYNC_TIMEOUT_SECONDS.
+
+  Yields:
+  - List[Dict[str, Any]]: A page of activities.
+  """
+  page_number = 1
+  while True:
+    response = strava_client.get('/athlete/activities', access_token,
+                                 params={'after': after, 'page': page_number, 'per_page': per_page}, timeout=timeout)
+    response.raise_for_status()
+    page = response.json()
+    if not page:
+      return
+    yield page
+    if len(page) < per_page:
+      return
+    page_number += 1
+
+def _sync_athlete(athlete_id: int, access_token: str, persist: bool, timeout: Optional[float]) -> int:
+  activities = get_activities(athlete_id)
+  cursor = activities.cursor
+  new_runs = 0
+  for page in iter_activity_pages(access_token, after=cursor, timeout=timeout):
+    batch = _page_to_columns(page, after=cursor)
+    # Strava returns activities oldest first when `after` is given, keep the columns sorted anyway
+    order = np.argsort(batch['start_date'], kind='stable')
+    activities.append({name: column[order] for name, column in batch.items()})
+    new_runs += len(order)
+
+  if new_runs and persist:
+    save_activities(athlete_id)
+  print(f'Synced {new_runs} new runs for athlete {athlete_id} ({activities.size} stored)')
+  return new_runs
+
+def sync_athlete(athlete_id: int, access_token: str, persist: bool = True,
+                 timeout: Optional[float] = ACTIVITY_SYNC_TIMEOUT_SECONDS) -> int:
+  """
+  Incrementally sync an athlete's runs into the store, fetching only activities newer than the cursor.
+
+  Args:
+  - athlete_id (int): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+  - persist (bool, optional): Whether to save the columns to disk afterwards. Defaults to True.
+  - timeout (Optional[float], optional): The timeout of each page request. Defaults to ACTIVITY_SYNC_TIMEOUT_SECONDS.
+
+  Returns:
+  - int: The number of new runs stored.
+  """
+  return _sync_flights.do(int(athlete_id), _sync_athlete, int(athlete_id), access_token, persist, timeout)
+
+def get_metrics(athlete_ids: List[int], weeks: int = 12, now: Optional[float] = None) -> Dict[str, np.ndarray]:
+  """
+  Compute training metrics for a batch of athletes from their stored activities in one vectorised pass.
+
+  Args:
+  - athlete_ids (List[int]): The Strava athlete ids. Row i of every metric belongs to athlete_ids[i].
+  - weeks (int, optional): How many weeks back to look. Defaults to 12.
+  - now (Optional[float]): The reference time in epoch seconds. Defaults to the current time.
+
+  Returns:
+  - Dict[str, np.ndarray]: The metrics, see fitness_metrics.compute_metrics.
+  """
+  activities = [get_activities(athlete_id) for athlete_id in athlete_ids]
+  sizes = np.array([columns.size for columns in activities], dtype=np.int64)
+  athlete_index = np.repeat(np.arange(len(activities)), sizes)
+
+  def concat(name: str) -> np.ndarray:
+    return np.concatenate([columns[name] for columns in activities] + [np.empty(0, dtype=COLUMNS[name])])
+
+  return compute_metrics(concat('start_date'), concat('distance'), concat('moving_time'), concat('elevation'),
+                         athlete_index=athlete_index, n_athletes=len(activities), weeks=weeks, now=now)
+
+def get_athlete_metrics(athlete_id: int, weeks: int = 12) -> Optional[Dict[str, np.ndarray]]:
+  """
+  Compute one athlete's training metrics from their stored activities.
+
+  Args:
+  - athlete_id (int): The Strava athlete id.
+  - weeks (int, optional): How many weeks back to look. Defaults to 12.
+
+  Returns:
+  - Optional[Dict[str, np.ndarray]]: The metrics with a single row, or None if no runs are stored.
+  """
+  if get_activities(athlete_id).size == 0:
+    return None
+  return get_metrics([athlete_id], weeks=weeks)
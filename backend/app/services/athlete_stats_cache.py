@@ -0,0 +1,172 @@
+import os
+import time
+import struct
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from app.services import strava_client
+from app.utils.singleflight import SingleFlight
+
+# recent and YTD totals barely move within an hour
+ATHLETE_STATS_TTL_SECONDS = float(os.getenv('ATHLETE_STATS_TTL_SECONDS', 3600))
+ATHLETE_STATS_CACHE_MAX_ENTRIES = int(os.getenv('ATHLETE_STATS_CACHE_MAX_ENTRIES', 500_000))
+
+# only the totals the recommendation path reads are kept, packed as float32
+TOTALS_GROUPS = ('recent_run_totals', 'ytd_run_totals')
+TOTALS_FIELDS = ('count', 'distance', 'moving_time', 'elapsed_time', 'elevation_gain')
+# each entry is a single bytes object: packed totals, expiry, token fingerprint, then the ETag
+ENTRY_FORMAT = struct.Struct(f'<{len(TOTALS_GROUPS) * len(TOTALS_FIELDS)}fd8s')
+
+_entries: "OrderedDict[int, bytes]" = OrderedDict()
+_lock = threading.Lock()
+_flights = SingleFlight("athlete_stats")
+hits, misses, revalidated = 0, 0, 0
+
+def _pack(stats: Dict[str, Any]) -> List[float]:
+  values = []
+  for group in TOTALS_GROUPS:
+    totals = stats.get(group) or {}
+    values.extend(float(totals.get(field) or 0) for field in TOTALS_FIELDS)
+  return values
+
+def _unpack(values: Tuple[float, ...]) -> Dict[str, Any]:
+  stats = {}
+  for i, group in enumerate(TOTALS_GROUPS):
+    totals = dict(zip(TOTALS_FIELDS, values[i * len(TOTALS_FIELDS):(i + 1) * len(TOTALS_FIELDS)]))
+    totals['count'] = int(totals['count'])
+    stats[group] = totals
+  return stats
+
+def _decode_entry(entry: bytes) -> Tuple[Tuple[float, ...], float, bytes, Optional[str]]:
+  *values, expires_at, token_hash = ENTRY_FORMAT.unpack_from(entry)
+  etag = entry[ENTRY_FORMAT.size:].decode('ascii') or None
+  return tuple(values), expires_at, token_hash, etag
+
+def _token_hash(access_token: str) -> bytes:
+  return hashlib.blake2b(access_token.encode('utf-8'), digest_size=8).digest()
+
+def _lookup(athlete_id: int, token_hash: bytes):
+  """
+  Get the cached entry for an athlete.
+
+  Returns:
+  - The decoded entry, or None, and whether it can be served without asking Strava. It can
+    if it hasn't expired and was fetched with the same token; a different token has to be
+    checked with Strava before it may read the cached stats.
+  """
+  global hits
+  with _lock:
+    entry = _entries.get(athlete_id)
+    if entry is None:
+      return None, False
+    _entries.move_to_end(athlete_id)
+    decoded = _decode_entry(entry)
+    fresh = decoded[1] > time.monotonic() and decoded[2] == token_hash
+    if fresh:
+      hits += 1
+    return decoded, fresh
+
+def _store(athlete_id: int, status: int, etag: Optional[str], body: Any, previous, token_hash: bytes) -> Dict[str, Any]:
+  """
+  Store the result of a (conditional) stats request and return the stats.
+  """
+  global misses, revalidated
+  expires_at = time.monotonic() + ATHLETE_STATS_TTL_SECONDS
+  with _lock:
+    if status == 304 and previous is not None:
+      revalidated += 1
+      values = previous[0]
+      etag = etag or previous[3]
+    else:
+      misses += 1
+      values = _pack(body)
+    _entries[athlete_id] = ENTRY_FORMAT.pack(*values, expires_at, token_hash) + (etag or '').encode('ascii', 'ignore')
+    _entries.move_to_end(athlete_id)
+    while len(_entries) > ATHLETE_STATS_CACHE_MAX_ENTRIES:
+      _entries.popitem(last=False)
+  return _unpack(values)
+
+def _conditional_headers(previous) -> Optional[Dict[str, str]]:
+  return {'If-None-Match': previous[3]} if previous is not None and previous[3] else None
+
+def _fetch(athlete_id: int, access_token: str, timeout: Optional[float]) -> Dict[str, Any]:
+  token_hash = _token_hash(access_token)
+  previous, fresh = _lookup(athlete_id, token_hash)
+  if fresh:
+    return _unpack(previous[0])
+
+  response = strava_client.get(f'/athletes/{athlete_id}/stats', access_token,
+                               headers=_conditional_headers(previous), timeout=timeout)
+  response.raise_for_status()
+  body = None if response.status_code == 304 else response.json()
+  return _store(athlete_id, response.status_code, response.headers.get('ETag'), body, previous, token_hash)
+
+async def _afetch(athlete_id: int, access_token: str) -> Dict[str, Any]:
+  token_hash = _token_hash(access_token)
+  previous, fresh = _lookup(athlete_id, token_hash)
+  if fresh:
+    return _unpack(previous[0])
+
+  status, response_headers, body = await strava_client.aget(f'/athletes/{athlete_id}/stats', access_token,
+                                                            headers=_conditional_headers(previous))
+  return _store(athlete_id, status, response_headers.get('ETag'), body, previous, token_hash)
+
+def get_athlete_stats(athlete_id: str, access_token: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+  """
+  Get an athlete's recent and YTD run totals, from the cache while they are fresh.
+
+  Stale entries are revalidated with If-None-Match, and concurrent lookups for the same
+  athlete share one Strava call.
+
+  Args:
+  - athlete_id (str): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+  - timeout (Optional[float]): The Strava request timeout in seconds.
+
+  Returns:
+  - Dict[str, Any]: The athlete's recent_run_totals and ytd_run_totals.
+  """
+  key = int(athlete_id)
+  return _flights.do((key, access_token), _fetch, key, access_token, timeout)
+
+async def aget_athlete_stats(athlete_id: str, access_token: str) -> Dict[str, Any]:
+  """
+  Asynchronously get an athlete's recent and YTD run totals. See get_athlete_stats.
+
+  Args:
+  - athlete_id (str): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+
+  Returns:
+  - Dict[str, Any]: The athlete's recent_run_totals and ytd_run_totals.
+  """
+  key = int(athlete_id)
+  return await _flights.ado((key, access_token), _afetch, key, access_token)
+
+def peek_athlete_stats(athlete_id: str) -> Optional[Dict[str, Any]]:
+  """
+  Get an athlete's cached totals without calling Strava, even if they are stale. Only good
+  for coarse decisions like the fitness level in the retrieval query, never for the response.
+
+  Args:
+  - athlete_id (str): The Strava athlete id.
+
+  Returns:
+  - Optional[Dict[str, Any]]: The athlete's recent_run_totals and ytd_run_totals, None if nothing is cached.
+  """
+  with _lock:
+    entry = _entries.get(int(athlete_id))
+  if entry is None:
+    return None
+  return _unpack(_decode_entry(entry)[0])
+
+def stats() -> Dict[str, int]:
+  """
+  Get the cache counters.
+
+  Returns:
+  - Dict[str, int]: The number of entries, hits, misses and revalidations.
+  """
+  with _lock:
+    return {'entries': len(_entries), 'hits': hits, 'misses': misses, 'revalidated': revalidated}
@@ -1,13 +1,87 @@
 import os
-from langchain_community.document_loaders import S3DirectoryLoader
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List
+import boto3
+from botocore.config import Config
+from langchain_core.documents import Document
 
 S3_BUCKET = os.getenv('S3_BUCKET')
 PREFIX = 'short'
+# point at a local stand-in, e.g. fakes/fake_s3_server.py, instead of AWS
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+# one client is shared by every thread, its connection pool has to be as large as the thread pool
+S3_LOAD_WORKERS = int(os.getenv('S3_LOAD_WORKERS', 16))
+S3_MAX_CONNECTIONS = int(os.getenv('S3_MAX_CONNECTIONS', S3_LOAD_WORKERS))
 
-def load_docs():
+s3 = boto3.client('s3', endpoint_url=S3_ENDPOINT_URL, config=Config(max_pool_connections=S3_MAX_CONNECTIONS))
+
+def load_docs(prefix: str = PREFIX, bucket: str = S3_BUCKET) -> List[Document]:
+  """
+  Load the contents of the S3 bucket, downloading S3_LOAD_WORKERS objects at a time.
+
+  Args:
+  - prefix (str, optional): The key prefix. Defaults to PREFIX.
+  - bucket (str, optional): The bucket. Defaults to S3_BUCKET.
+
+  Returns:
+  - List[Document]: One document per object, in listing order.
+  """
+  with ThreadPoolExecutor(max_workers=S3_LOAD_WORKERS, thread_name_prefix='s3') as pool:
+    return list(pool.map(lambda key: fetch_document(key, bucket), iter_keys(prefix, bucket)))
+
+def iter_keys(prefix: str = PREFIX, bucket: str = S3_BUCKET) -> Iterator[str]:
+  """
+  List the object keys under a prefix, one page of the listing at a time.
+
+  Args:
+  - prefix (str, optional): The key prefix. Defaults to PREFIX.
+  - bucket (str, optional): The bucket. Defaults to S3_BUCKET.
+
+  Yields:
+  - str: The object keys.
   """
-  Load the contents of the S3 bucket.
+  paginator = s3.get_paginator('list_objects_v2')
+  for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+    for entry in page.get('Contents', []):
+      if not entry['Key'].endswith('/'):
+        yield entry['Key']
+
+def iter_race_records(lines: Iterable[bytes]) -> Iterator[str]:
+  """
+  Split a race file into its records, which are separated by blank lines, as the lines arrive.
+
+  Args:
+  - lines (Iterable[bytes]): The lines of the file, e.g. from StreamingBody.iter_lines().
+
+  Yields:
+  - str: The records.
+  """
+  record = []
+  for line in lines:
+    line = line.decode('utf-8').rstrip('\r')
+    if line.strip():
+      record.append(line)
+    elif record:
+      yield '\n'.join(record)
+      record = []
+  if record:
+    yield '\n'.join(record)
+
+def fetch_document(key: str, bucket: str = S3_BUCKET) -> Document:
+  """
+  Download one object as a document. The body is parsed into race records as it streams in,
+  without a temporary file.
+
+  Args:
+  - key (str): The object key.
+  - bucket (str, optional): The bucket. Defaults to S3_BUCKET.
+
+  Returns:
+  - Document: The object's races separated by blank lines, with its s3:// URI as the source.
   """
-  loader = S3DirectoryLoader(bucket=S3_BUCKET, prefix=PREFIX)
-  documents = loader.load()
-  return documents
\ No newline at end of file
+  body = s3.get_object(Bucket=bucket, Key=key)['Body']
+  try:
+    records = list(iter_race_records(body.iter_lines()))
+  finally:
+    body.close()
+  return Document(page_content='\n\n'.join(records), metadata={'source': f's3://{bucket}/{key}'})
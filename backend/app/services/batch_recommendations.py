@@ -0,0 +1,239 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from typing import Any, Dict, List, Optional
+import numpy as np
+from app.services import activity_store, candidate_views
+from app.utils.race_scoring import athlete_profiles, prepare_races, score_matrix, suitability
+from app.utils.singleflight import normalize_query
+
+BATCH_RESULTS_PATH = os.getenv('BATCH_RESULTS_PATH', 'batch_recommendations.npz')
+# every athlete that asked for recommendations, with their latest location
+ATHLETE_LOCATIONS_PATH = os.getenv('ATHLETE_LOCATIONS_PATH', 'athlete_locations.tsv')
+# memory a worker may spend on one chunk's (athletes, races, distances) float64 matrices
+BATCH_CHUNK_BYTES = int(os.getenv('BATCH_CHUNK_BYTES', 256 * 1024 * 1024))
+# how many of those matrices score_matrix holds at its peak, temporaries included
+SCORE_MATRIX_LIVE_ARRAYS = 8
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', os.cpu_count() or 1))
+BATCH_TOP_N = int(os.getenv('BATCH_TOP_N', 5))
+# the job runs nightly, older results mean it stopped running and the route computes online
+BATCH_MAX_AGE_SECONDS = float(os.getenv('BATCH_MAX_AGE_SECONDS', 36 * 3600))
+
+# per (athlete, rank) float32 outputs kept from score_matrix
+RESULT_FIELDS = ('distance', 'build_up', 'geo', 'terrain', 'score', 'km_away')
+
+_locations: Dict[int, str] = {}
+_locations_lock = threading.Lock()
+_results: Optional[Dict[str, np.ndarray]] = None
+_results_mtime = None
+_results_lock = threading.Lock()
+# the race catalogue of the worker process, sent once by the pool initializer
+_catalogue: Optional[Dict[str, Any]] = None
+
+def remember_location(athlete_id: Any, location: Optional[str]) -> None:
+  """
+  Record an athlete's location so the nightly job knows where to recommend races for them.
+
+  Args:
+  - athlete_id (Any): The Strava athlete id.
+  - location (Optional[str]): The athlete's location, formatted as "City, State".
+  """
+  if not location:
+    return
+  athlete_id = int(athlete_id)
+  location = ' '.join(location.split())
+  with _locations_lock:
+    if _locations.get(athlete_id) == location:
+      return
+    _locations[athlete_id] = location
+    # append only, the last line of an athlete wins when the job reads the file
+    try:
+      with open(ATHLETE_LOCATIONS_PATH, 'a') as f:
+        f.write(f'{athlete_id}\t{location}\n')
+    except OSError as e:
+      print(f'Error recording athlete location: {e}')
+
+def load_locations() -> Dict[int, str]:
+  """
+  Read every recorded athlete location.
+
+  Returns:
+  - Dict[int, str]: The latest location of each athlete.
+  """
+  locations = {}
+  if os.path.exists(ATHLETE_LOCATIONS_PATH):
+    with open(ATHLETE_LOCATIONS_PATH) as f:
+      for line in f:
+        athlete_id, _, location = line.rstrip('\n').partition('\t')
+        if athlete_id.isdigit() and location:
+          locations[int(athlete_id)] = location
+  return locations
+
+def _chunk_profiles(athlete_ids: List[int], now: float) -> Dict[str, np.ndarray]:
+  """
+  Compute the profiles of a chunk of athletes from their stored activities.
+  """
+  return athlete_profiles(activity_store.get_metrics(athlete_ids, now=now))
+
+def _chunk_size(catalogue: Dict[str, Any], budget: int = BATCH_CHUNK_BYTES) -> int:
+  """
+  Size the athlete chunks so one chunk's score_matrix stays within a memory budget.
+
+  Args:
+  - catalogue (Dict[str, Any]): The races from prepare_races.
+  - budget (int, optional): The bytes a chunk may use. Defaults to BATCH_CHUNK_BYTES.
+
+  Returns:
+  - int: The athletes per chunk, at least 1.
+  """
+  n_races, width = catalogue['miles'].shape
+  per_athlete = max(n_races * width, 1) * 8 * SCORE_MATRIX_LIVE_ARRAYS
+  return max(1, budget // per_athlete)
+
+def _init_worker(catalogue: Dict[str, Any]) -> None:
+  global _catalogue
+  _catalogue = catalogue
+
+def _score_chunk(profiles: Dict[str, np.ndarray], locations: List[str], top_n: int) -> Dict[str, np.ndarray]:
+  """
+  Score the whole catalogue for a chunk of athletes and keep each athlete's top_n races.
+  """
+  scored = score_matrix(_catalogue, profiles, locations)
+  scores = scored['score']
+  k = min(top_n, scores.shape[1])
+  top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+  top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable'), axis=1)
+  chunk = {'race': top.astype(np.int32), 'best_pair': np.take_along_axis(scored['best_pair'], top, axis=1).astype(np.int32)}
+  for name in RESULT_FIELDS:
+    chunk[name] = np.take_along_axis(scored[name], top, axis=1).astype(np.float32)
+  return chunk
+
+def _save_results(results: Dict[str, np.ndarray]) -> None:
+  temporary = f'{BATCH_RESULTS_PATH}.tmp'
+  with open(temporary, 'wb') as f:
+    np.savez(f, **results)
+  # the route never reads a half written file
+  os.replace(temporary, BATCH_RESULTS_PATH)
+
+def run(today: Optional[date] = None, workers: int = BATCH_WORKERS, chunk_size: Optional[int] = None,
+        top_n: int = BATCH_TOP_N) -> Dict[str, float]:
+  """
+  Score the upcoming race catalogue for every known athlete and store each athlete's top races.
+
+  The catalogue comes from the materialised candidate views and the athletes from the recorded
+  locations. Athletes without stored runs are left out, the route serves them online from their
+  Strava totals rather than scoring them on proximity alone. Athletes are scored in chunks of (athletes x races) matrices spread over a process
+  pool; at most two chunks per worker are in flight, so memory stays bounded.
+
+  Args:
+  - today (Optional[date]): The reference date. Defaults to today.
+  - workers (int, optional): The number of worker processes. Defaults to BATCH_WORKERS.
+  - chunk_size (Optional[int]): The athletes per chunk. Defaults to what fits in BATCH_CHUNK_BYTES.
+  - top_n (int, optional): The races kept per athlete. Defaults to BATCH_TOP_N.
+
+  Returns:
+  - Dict[str, float]: The number of athletes and races, the seconds taken and athletes per second.
+  """
+  started = time.perf_counter()
+  catalogue = prepare_races([json.loads(text) for text in candidate_views.all_races()], today=today)
+  locations = load_locations()
+  athlete_ids = [athlete_id for athlete_id in sorted(locations) if activity_store.get_activities(athlete_id).size > 0]
+  if not catalogue['races'] or not athlete_ids:
+    print(f"Nothing to score: {len(catalogue['races'])} races, {len(athlete_ids)} athletes")
+    return {'athletes': 0, 'races': len(catalogue['races']), 'seconds': 0.0, 'athletes_per_second': 0.0}
+
+  now = time.time()
+  chunk_size = chunk_size or _chunk_size(catalogue)
+  chunks = [athlete_ids[i:i + chunk_size] for i in range(0, len(athlete_ids), chunk_size)]
+  results = [None] * len(chunks)
+  with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(catalogue,)) as pool:
+    in_flight = {}
+    for i, chunk in enumerate(chunks):
+      in_flight[i] = pool.submit(_score_chunk, _chunk_profiles(chunk, now), [locations[id] for id in chunk], top_n)
+      if len(in_flight) >= 2 * workers:
+        oldest = min(in_flight)
+        results[oldest] = in_flight.pop(oldest).result()
+    for i, future in in_flight.items():
+      results[i] = future.result()
+
+  stored = {name: np.concatenate([chunk[name] for chunk in results]) for name in results[0]}
+  stored.update({
+    'athlete_ids': np.array(athlete_ids, dtype=np.int64),
+    'locations': np.array([normalize_query(locations[id]) for id in athlete_ids]),
+    'race_texts': np.array([json.dumps(race) for race in catalogue['races']]),
+    'labels': np.array(catalogue['labels'] or ['']),
+    'undated': catalogue['undated'],
+    'weeks_to_race': catalogue['weeks_to_race'].astype(np.float32),
+    'generated_at': np.array(now),
+  })
+  _save_results(stored)
+
+  seconds = time.perf_counter() - started
+  rate = len(athlete_ids) / seconds if seconds else 0.0
+  print(f"Scored {len(catalogue['races'])} races for {len(athlete_ids)} athletes in {seconds:.2f}s ({rate:.0f} athletes/s)")
+  return {'athletes': len(athlete_ids), 'races': len(catalogue['races']), 'seconds': seconds, 'athletes_per_second': rate}
+
+def _load_results() -> Optional[Dict[str, np.ndarray]]:
+  """
+  Get the latest batch results, reloading them when the job has rewritten the file.
+  """
+  global _results, _results_mtime
+  try:
+    mtime = os.path.getmtime(BATCH_RESULTS_PATH)
+  except OSError:
+    return None
+  with _results_lock:
+    if mtime != _results_mtime:
+      with np.load(BATCH_RESULTS_PATH) as saved:
+        _results = {name: saved[name] for name in saved.files}
+      _results_mtime = mtime
+    return _results
+
+def get_batch_recommendations(athlete_id: Any, location: Optional[str]) -> Optional[List[Dict[str, Any]]]:
+  """
+  Get an athlete's recommendations from the latest nightly batch.
+
+  Args:
+  - athlete_id (Any): The Strava athlete id.
+  - location (Optional[str]): The athlete's location, formatted as "City, State".
+
+  Returns:
+  - Optional[List[Dict[str, Any]]]: The recommended races, best first, each with its score breakdown,
+    or None if the batch is missing or stale, doesn't know the athlete, scored a different location
+    or every race it kept for the athlete has since passed.
+  """
+  results = _load_results()
+  if results is None:
+    return None
+  age = time.time() - float(results['generated_at'])
+  if age > BATCH_MAX_AGE_SECONDS:
+    return None
+  athlete_ids = results['athlete_ids']
+  row = int(np.searchsorted(athlete_ids, int(athlete_id)))
+  if row >= len(athlete_ids) or athlete_ids[row] != int(athlete_id):
+    return None
+  if results['locations'][row] != normalize_query(location or ''):
+    return None
+
+  races = results['race'][row]
+  # the weeks to each race have shrunk since the job ran
+  elapsed_weeks = age / (7 * 86400)
+  view = {
+    'labels': results['labels'],
+    'undated': results['undated'][races],
+    'weeks_to_race': results['weeks_to_race'][races].astype(np.float64) - elapsed_weeks,
+  }
+  scored = {name: results[name][row] for name in (*RESULT_FIELDS, 'best_pair')}
+  recommendations = []
+  for j, i in enumerate(races.tolist()):
+    if not np.isfinite(scored['score'][j]) or view['weeks_to_race'][j] < 0:
+      continue
+    recommendations.append({**json.loads(str(results['race_texts'][i])), 'Suitability': suitability(view, scored, j)})
+  # only the top BATCH_TOP_N races are stored, the online path ranks the rest
+  return recommendations or None
+
+if __name__ == '__main__':
+  run()
@@ -0,0 +1,219 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import requests
+from app.services import strava_client, activity_store
+from app.utils.fitness_metrics import BEST_EFFORT_DISTANCES, best_efforts
+from app.utils.singleflight import SingleFlight
+
+# how many of an athlete's most recent runs to fetch streams for, streams cost one Strava call each
+BEST_EFFORT_ACTIVITIES = int(os.getenv('BEST_EFFORT_ACTIVITIES', 30))
+# stream fetches in flight at once across all athletes, and how long each may take
+BEST_EFFORT_CONCURRENCY = int(os.getenv('BEST_EFFORT_CONCURRENCY', 4))
+BEST_EFFORT_TIMEOUT_SECONDS = float(os.getenv('BEST_EFFORT_TIMEOUT_SECONDS', 10))
+BEST_EFFORT_NAMES = list(BEST_EFFORT_DISTANCES)
+_CACHE_FILE = 'best_efforts.npz'
+
+# activity id -> best time in seconds per BEST_EFFORT_DISTANCES entry (NaN if the run was too short,
+# all NaN if Strava has no stream for it)
+_cache: Dict[int, np.ndarray] = {}
+_executor = ThreadPoolExecutor(max_workers=BEST_EFFORT_CONCURRENCY, thread_name_prefix='best-efforts')
+# syncs queued by requests that found efforts missing, one athlete at a time
+_sync_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='best-efforts-sync')
+_queued = set()
+_lock = threading.Lock()
+_loaded = False
+_sync_flights = SingleFlight("best_efforts")
+
+def _cache_path() -> str:
+  return os.path.join(activity_store.ACTIVITY_STORE_DIR, _CACHE_FILE)
+
+def _load_cache() -> None:
+  global _loaded
+  with _lock:
+    if _loaded:
+      return
+    if os.path.exists(_cache_path()):
+      with np.load(_cache_path()) as saved:
+        _cache.update(zip(saved['activity_id'].tolist(), saved['efforts']))
+    _loaded = True
+
+def _save_cache() -> None:
+  with _lock:
+    activity_ids = np.fromiter(_cache, dtype=np.int64, count=len(_cache))
+    efforts = np.array([_cache[activity_id] for activity_id in activity_ids.tolist()], dtype=np.float32).reshape(-1, len(BEST_EFFORT_NAMES))
+  os.makedirs(activity_store.ACTIVITY_STORE_DIR, exist_ok=True)
+  np.savez(_cache_path(), activity_id=activity_ids, efforts=efforts)
+
+def fetch_stream(activity_id: int, access_token: str, timeout: Optional[float] = BEST_EFFORT_TIMEOUT_SECONDS) -> Tuple[np.ndarray, np.ndarray]:
+  """
+  Fetch an activity's per-sample time and distance streams.
+
+  Args:
+  - activity_id (int): The Strava activity id.
+  - access_token (str): The athlete's Strava access token.
+  - timeout (Optional[float], optional): The request timeout in seconds. Defaults to BEST_EFFORT_TIMEOUT_SECONDS.
+
+  Returns:
+  - Tuple[np.ndarray, np.ndarray]: The elapsed seconds and cumulative meters of every sample.
+  """
+  response = strava_client.get(f'/activities/{activity_id}/streams', access_token,
+                               params={'keys': 'time,distance', 'key_by_type': 'true'}, timeout=timeout)
+  response.raise_for_status()
+  streams = response.json()
+  time_data = streams.get('time', {}).get('data', [])
+  distance_data = streams.get('distance', {}).get('data', [])
+  n = min(len(time_data), len(distance_data))
+  return np.asarray(time_data[:n], dtype=np.float64), np.asarray(distance_data[:n], dtype=np.float64)
+
+def _compute(activity_id: int, access_token: str, timeout: Optional[float]) -> np.ndarray:
+  """
+  Fetch one activity's streams and compute its best efforts. An activity Strava has no stream
+  for (deleted, private or manual) gets an all NaN row, which is cached like any other.
+  """
+  try:
+    stream = fetch_stream(activity_id, access_token, timeout=timeout)
+  except requests.HTTPError as e:
+    if e.response is None or e.response.status_code != 404:
+      raise
+    return np.full(len(BEST_EFFORT_NAMES), np.nan, dtype=np.float32)
+  return best_efforts([stream])[0].astype(np.float32)
+
+def get_best_efforts(activity_ids: List[int], access_token: str, persist: bool = True,
+                     timeout: Optional[float] = BEST_EFFORT_TIMEOUT_SECONDS) -> np.ndarray:
+  """
+  Get the best efforts of a batch of activities. Only activities that aren't cached yet have
+  their streams fetched, BEST_EFFORT_CONCURRENCY at a time, and each one is cached as soon as it
+  arrives. An activity that fails (rate limited, timed out) is left NaN and fetched again next
+  time; one that Strava has no stream for is cached as all NaN so it isn't.
+
+  Args:
+  - activity_ids (List[int]): The Strava activity ids.
+  - access_token (str): The athlete's Strava access token.
+  - persist (bool, optional): Whether to save newly computed efforts to disk. Defaults to True.
+  - timeout (Optional[float], optional): The timeout of each stream request. Defaults to BEST_EFFORT_TIMEOUT_SECONDS.
+
+  Returns:
+  - np.ndarray: (len(activity_ids), len(BEST_EFFORT_DISTANCES)) best times in seconds, NaN where a
+    run was too short or couldn't be fetched.
+  """
+  _load_cache()
+  activity_ids = [int(activity_id) for activity_id in activity_ids]
+  with _lock:
+    missing = [activity_id for activity_id in dict.fromkeys(activity_ids) if activity_id not in _cache]
+
+  if missing:
+    futures = {_executor.submit(_compute, activity_id, access_token, timeout): activity_id for activity_id in missing}
+    computed = failed = 0
+    for future in as_completed(futures):
+      try:
+        efforts = future.result()
+      except Exception as e:
+        failed += 1
+        print(f'Error computing best efforts for activity {futures[future]}: {e}')
+        continue
+      with _lock:
+        _cache[futures[future]] = efforts
+      computed += 1
+    print(f'Computed best efforts for {computed} new activities ({failed} failed, {len(activity_ids) - len(missing)} cached)')
+    if persist and computed:
+      _save_cache()
+
+  empty = np.full(len(BEST_EFFORT_NAMES), np.nan, dtype=np.float32)
+  with _lock:
+    return np.array([_cache.get(activity_id, empty) for activity_id in activity_ids], dtype=np.float32).reshape(-1, len(BEST_EFFORT_NAMES))
+
+def _recent_runs(athlete_id: int, limit: int) -> List[int]:
+  """
+  The ids of the athlete's most recent stored runs long enough to hold a best effort.
+  """
+  activities = activity_store.get_activities(athlete_id)
+  # runs shorter than the shortest target can't contribute
+  long_enough = activities['distance'] >= min(BEST_EFFORT_DISTANCES.values())
+  return activities['activity_id'][long_enough][-limit:].tolist()
+
+def _sync_athlete(athlete_id: int, access_token: str, limit: int, timeout: Optional[float]) -> int:
+  activity_ids = _recent_runs(athlete_id, limit)
+  _load_cache()
+  with _lock:
+    missing = sum(1 for activity_id in activity_ids if activity_id not in _cache)
+  if missing:
+    get_best_efforts(activity_ids, access_token, timeout=timeout)
+  return missing
+
+def sync_athlete_best_efforts(athlete_id: int, access_token: str, limit: int = BEST_EFFORT_ACTIVITIES,
+                              timeout: Optional[float] = BEST_EFFORT_TIMEOUT_SECONDS) -> int:
+  """
+  Compute the best efforts of the athlete's recent stored runs that aren't cached yet, for
+  get_athlete_best_efforts to read. Runs outside any request, e.g. when prefetching after
+  login; concurrent calls for the same athlete share one computation.
+
+  Args:
+  - athlete_id (int): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+  - limit (int, optional): How many of the most recent runs to look at. Defaults to BEST_EFFORT_ACTIVITIES.
+  - timeout (Optional[float], optional): The timeout of each stream request. Defaults to BEST_EFFORT_TIMEOUT_SECONDS.
+
+  Returns:
+  - int: The number of runs that weren't cached.
+  """
+  return _sync_flights.do(int(athlete_id), _sync_athlete, int(athlete_id), access_token, limit, timeout)
+
+def _sync_queued(athlete_id: int, access_token: str, limit: int) -> None:
+  try:
+    sync_athlete_best_efforts(athlete_id, access_token, limit)
+  except Exception as e:
+    print(f'Error computing best efforts in the background: {e}')
+  finally:
+    with _lock:
+      _queued.discard(athlete_id)
+
+def queue_sync(athlete_id: int, access_token: str, limit: int = BEST_EFFORT_ACTIVITIES) -> bool:
+  """
+  Run sync_athlete_best_efforts in the background, e.g. for an athlete a request found without
+  cached efforts because they weren't prefetched.
+
+  Args:
+  - athlete_id (int): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+  - limit (int, optional): How many of the most recent runs to look at. Defaults to BEST_EFFORT_ACTIVITIES.
+
+  Returns:
+  - bool: True if a sync was queued, False if one is already queued for the athlete.
+  """
+  athlete_id = int(athlete_id)
+  with _lock:
+    if athlete_id in _queued:
+      return False
+    _queued.add(athlete_id)
+  _sync_executor.submit(_sync_queued, athlete_id, access_token, limit)
+  return True
+
+def get_athlete_best_efforts(athlete_id: int, limit: int = BEST_EFFORT_ACTIVITIES,
+                             access_token: Optional[str] = None) -> Dict[str, Optional[float]]:
+  """
+  Get an athlete's fastest times over the BEST_EFFORT_DISTANCES across their recent stored runs.
+  Only reads cached efforts, so it never calls Strava; sync_athlete_best_efforts fills the cache.
+
+  Args:
+  - athlete_id (int): The Strava athlete id.
+  - limit (int, optional): How many of the most recent runs to look at. Defaults to BEST_EFFORT_ACTIVITIES.
+  - access_token (Optional[str]): The athlete's Strava access token. If given, runs that aren't
+    cached yet are computed in the background for the next request, see queue_sync.
+
+  Returns:
+  - Dict[str, Optional[float]]: The best time in seconds per distance name, None if no cached run was long enough.
+  """
+  _load_cache()
+  activity_ids = _recent_runs(int(athlete_id), limit)
+  with _lock:
+    efforts = [_cache[activity_id] for activity_id in activity_ids if activity_id in _cache]
+  if access_token and len(efforts) < len(activity_ids):
+    queue_sync(athlete_id, access_token, limit)
+  if not efforts:
+    return {name: None for name in BEST_EFFORT_NAMES}
+  efforts = np.array(efforts, dtype=np.float32).reshape(-1, len(BEST_EFFORT_NAMES))
+  best = np.where(np.isnan(efforts), np.inf, efforts).min(axis=0)
+  return {name: (float(seconds) if np.isfinite(seconds) else None) for name, seconds in zip(BEST_EFFORT_NAMES, best)}
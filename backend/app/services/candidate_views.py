@@ -0,0 +1,322 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
+from app.utils.geo import nearby_states, state_code
+from app.utils.race_metadata import DATED, TENTATIVE, parse_dates
+from app.utils.race_prediction import parse_distances
+
+CANDIDATE_VIEWS_PATH = os.getenv('CANDIDATE_VIEWS_PATH', 'candidate_views.json')
+# at most this many races are served from the views for one request, nearest states first
+VIEW_CANDIDATES_MAX = int(os.getenv('VIEW_CANDIDATES_MAX', 500))
+# how often a server process checks whether ingestion rewrote the views on disk
+VIEW_RELOAD_SECONDS = float(os.getenv('VIEW_RELOAD_SECONDS', 60))
+# tentative races (Tentative, TBD, Unknown Year) share one view per region
+UNDATED = 'undated'
+
+# race id -> {hash, text, state, city, date, distances}
+_races: Dict[str, Dict[str, Any]] = {}
+# "state|CA|2024-05" or "metro|san jose, ca|2024-05" -> race ids sorted by date
+_views: Dict[str, List[str]] = {}
+_lock = threading.Lock()
+_loaded_mtime = None
+_checked_at = 0.0
+
+def race_id(race: Dict[str, Any]) -> str:
+  """
+  Build a race's stable id from its name and date, the same identity score_races dedupes on.
+
+  Args:
+  - race (Dict[str, Any]): The race record.
+
+  Returns:
+  - str: The id.
+  """
+  identity = f"{race.get('Race Name', '').strip().lower()}|{race.get('Race Date', '')}"
+  return hashlib.blake2b(identity.encode('utf-8'), digest_size=8).hexdigest()
+
+def _metro(location: Optional[str]) -> Optional[str]:
+  """
+  The metro area of a "City, State" location. Races only carry their city, so the metro is
+  the normalised city and state.
+  """
+  code = state_code(location)
+  if code is None:
+    return None
+  city = location.rsplit(',', 1)[0].strip().lower()
+  return f'{city}, {code.lower()}'
+
+def view_keys(race: Dict[str, Any]) -> List[str]:
+  """
+  List the views a parsed race belongs to: its (state, month) and (metro, month) views.
+
+  Args:
+  - race (Dict[str, Any]): The parsed race from parse_races.
+
+  Returns:
+  - List[str]: The view keys, empty if the race's state is unknown.
+  """
+  if race['state'] is None:
+    return []
+  month = race['date'][:7] if race['date'] else UNDATED
+  keys = [f"state|{race['state']}|{month}"]
+  if race['metro'] is not None:
+    keys.append(f"metro|{race['metro']}|{month}")
+  return keys
+
+def parse_races(texts: List[str], today: Optional[date] = None) -> Dict[str, Dict[str, Any]]:
+  """
+  Parse race documents and their metadata in one pass. Cancelled races, races in the past
+  ("Past Date" or dated before today) and races whose date doesn't parse are left out, so
+  they never reach a view or the batch catalogue.
+
+  Args:
+  - texts (List[str]): The race documents, one JSON race per document.
+  - today (Optional[date]): The reference date. Defaults to today.
+
+  Returns:
+  - Dict[str, Dict[str, Any]]: Parsed races by id, each with its text, content hash, state,
+    metro, ISO date (None if tentative) and distance labels.
+  """
+  races = []
+  for text in texts:
+    try:
+      race = json.loads(text)
+    except ValueError:
+      continue
+    if isinstance(race, dict):
+      races.append((text, race))
+
+  statuses, dates = parse_dates([race.get('Race Date', '') for _, race in races])
+  with np.errstate(invalid='ignore'):
+    keep = ((statuses == TENTATIVE) | ((statuses == DATED) & (dates >= np.datetime64(today or date.today(), 'D')))).tolist()
+  races = [text_and_race for text_and_race, kept in zip(races, keep) if kept]
+  dates = dates[np.array(keep, dtype=bool)]
+  race_index, _, labels = parse_distances([race.get('Distances Available', '') for _, race in races])
+  distances = [[] for _ in races]
+  for i, label in zip(race_index.tolist(), labels):
+    distances[i].append(label)
+
+  parsed = {}
+  for i, (text, race) in enumerate(races):
+    parsed[race_id(race)] = {
+      'hash': hashlib.blake2b(text.encode('utf-8'), digest_size=8).hexdigest(),
+      'text': text,
+      'name': race.get('Race Name', ''),
+      'state': state_code(race.get('Location')),
+      'metro': _metro(race.get('Location')),
+      'date': None if np.isnat(dates[i]) else str(dates[i]),
+      'distances': distances[i],
+    }
+  return parsed
+
+def _sort_view(ids: Iterable[str]) -> List[str]:
+  # dated races first in date order, then the undated ones by name
+  return sorted(ids, key=lambda id: (_races[id]['date'] or '9999', _races[id]['name'].lower(), id))
+
+def _save() -> None:
+  global _loaded_mtime
+  directory = os.path.dirname(CANDIDATE_VIEWS_PATH)
+  if directory:
+    os.makedirs(directory, exist_ok=True)
+  temporary = f'{CANDIDATE_VIEWS_PATH}.tmp'
+  with open(temporary, 'w') as f:
+    json.dump({'races': _races, 'views': _views}, f)
+  # readers in other processes never see a half written file
+  os.replace(temporary, CANDIDATE_VIEWS_PATH)
+  _loaded_mtime = os.path.getmtime(CANDIDATE_VIEWS_PATH)
+
+def _load() -> None:
+  """
+  Load the views from disk if ingestion (possibly in another process) rewrote them. Must hold _lock.
+  """
+  global _races, _views, _loaded_mtime, _checked_at
+  now = time.monotonic()
+  if _loaded_mtime is not None and now - _checked_at < VIEW_RELOAD_SECONDS:
+    return
+  _checked_at = now
+  try:
+    mtime = os.path.getmtime(CANDIDATE_VIEWS_PATH)
+  except OSError:
+    return
+  if mtime == _loaded_mtime:
+    return
+  with open(CANDIDATE_VIEWS_PATH) as f:
+    saved = json.load(f)
+  _races, _views, _loaded_mtime = saved['races'], saved['views'], mtime
+  print(f'Loaded {len(_views)} candidate views over {len(_races)} races')
+
+def _apply(upserts: Dict[str, Dict[str, Any]], removals: Set[str]) -> Tuple[int, int]:
+  """
+  Apply race changes and rebuild only the views they touch. Must hold _lock.
+
+  Returns:
+  - Tuple[int, int]: The number of races changed and views rebuilt.
+  """
+  changed = {id: race for id, race in upserts.items() if _races.get(id, {}).get('hash') != race['hash']}
+  removals = {id for id in removals if id in _races}
+  dirty = set()
+  for id in removals | set(changed):
+    if id in _races:
+      dirty.update(view_keys(_races[id]))
+  for id in removals:
+    del _races[id]
+  for id, race in changed.items():
+    _races[id] = race
+    dirty.update(view_keys(race))
+
+  for key in dirty:
+    members = {id for id in _views.get(key, []) if id in _races and key in view_keys(_races[id])}
+    members.update(id for id, race in changed.items() if key in view_keys(race))
+    if members:
+      _views[key] = _sort_view(members)
+    else:
+      _views.pop(key, None)
+  return len(changed) + len(removals), len(dirty)
+
+def refresh(texts: List[str], persist: bool = True) -> Dict[str, int]:
+  """
+  Bring the views in line with a full snapshot of the race catalogue, as loaded by ingestion.
+  Races that are new, changed or gone are diffed by content hash, and only the views they
+  belong to are rebuilt.
+
+  Args:
+  - texts (List[str]): Every race document, one JSON race per document.
+  - persist (bool, optional): Whether to save the views to CANDIDATE_VIEWS_PATH. Defaults to True.
+
+  Returns:
+  - Dict[str, int]: The number of races in the catalogue, races changed and views rebuilt.
+  """
+  parsed = parse_races(texts)
+  with _lock:
+    _load()
+    changed, rebuilt = _apply(parsed, set(_races) - set(parsed))
+    if persist and changed:
+      _save()
+    total_views = len(_views)
+  print(f'Refreshed candidate views: {changed} races changed, {rebuilt} of {total_views} views rebuilt')
+  return {'races': len(parsed), 'changed': changed, 'rebuilt': rebuilt}
+
+def upsert_races(texts: List[str], persist: bool = True) -> Dict[str, int]:
+  """
+  Add or update some races without touching the rest of the catalogue.
+
+  Args:
+  - texts (List[str]): The new or changed race documents.
+  - persist (bool, optional): Whether to save the views to CANDIDATE_VIEWS_PATH. Defaults to True.
+
+  Returns:
+  - Dict[str, int]: The number of races changed and views rebuilt.
+  """
+  with _lock:
+    _load()
+    changed, rebuilt = _apply(parse_races(texts), set())
+    if persist and changed:
+      _save()
+  return {'changed': changed, 'rebuilt': rebuilt}
+
+def remove_races(ids: Iterable[str], persist: bool = True) -> Dict[str, int]:
+  """
+  Remove races, e.g. cancelled ones, by id.
+
+  Args:
+  - ids (Iterable[str]): The race ids from race_id.
+  - persist (bool, optional): Whether to save the views to CANDIDATE_VIEWS_PATH. Defaults to True.
+
+  Returns:
+  - Dict[str, int]: The number of races removed and views rebuilt.
+  """
+  with _lock:
+    _load()
+    changed, rebuilt = _apply({}, set(ids))
+    if persist and changed:
+      _save()
+  return {'changed': changed, 'rebuilt': rebuilt}
+
+def retain(ids: Iterable[str], persist: bool = True) -> Dict[str, int]:
+  """
+  Drop every race that isn't in `ids`, after a streaming ingestion has upserted the current
+  catalogue batch by batch, and save the views.
+
+  Args:
+  - ids (Iterable[str]): The ids of the races still in the catalogue.
+  - persist (bool, optional): Whether to save the views to CANDIDATE_VIEWS_PATH. Defaults to True.
+
+  Returns:
+  - Dict[str, int]: The number of races removed and views rebuilt.
+  """
+  ids = set(ids)
+  with _lock:
+    _load()
+    changed, rebuilt = _apply({}, set(_races) - ids)
+    if persist:
+      _save()
+  return {'changed': changed, 'rebuilt': rebuilt}
+
+def _months(today: date, months: int) -> List[str]:
+  keys = []
+  for offset in range(max(months, 1)):
+    year, month = divmod(today.month - 1 + offset, 12)
+    keys.append(f'{today.year + year:04d}-{month + 1:02d}')
+  return keys
+
+def get_candidates(location: Optional[str], months: int, today: Optional[date] = None,
+                   limit: int = VIEW_CANDIDATES_MAX) -> Optional[List[str]]:
+  """
+  Read the candidate races for an athlete straight from the materialised views: their metro
+  first, then their state and the nearby states, nearest first, each in date order.
+
+  Args:
+  - location (Optional[str]): The athlete's location, formatted as "City, State".
+  - months (int): How many months to cover, starting with the current one.
+  - today (Optional[date]): The reference date. Defaults to today.
+  - limit (int, optional): The maximum number of races. Defaults to VIEW_CANDIDATES_MAX.
+
+  Returns:
+  - Optional[List[str]]: The race documents, or None if there are no views or the state is unknown.
+  """
+  code = state_code(location)
+  if code is None:
+    return None
+  month_keys = _months(today or date.today(), months) + [UNDATED]
+  metro = _metro(location)
+  with _lock:
+    _load()
+    if not _views:
+      return None
+    keys = [f'metro|{metro}|{month}' for month in month_keys]
+    keys += [f'state|{state}|{month}' for state in nearby_states(code) for month in month_keys]
+    seen, candidates = set(), []
+    for key in keys:
+      for id in _views.get(key, ()):
+        if id not in seen:
+          seen.add(id)
+          candidates.append(_races[id]['text'])
+          if len(candidates) >= limit:
+            return candidates
+  return candidates
+
+def all_races() -> List[str]:
+  """
+  List every race document in the catalogue the views were built from.
+
+  Returns:
+  - List[str]: The race documents.
+  """
+  with _lock:
+    _load()
+    return [race['text'] for race in _races.values()]
+
+def stats() -> Dict[str, int]:
+  """
+  Get the size of the views.
+
+  Returns:
+  - Dict[str, int]: The number of races and views.
+  """
+  with _lock:
+    return {'races': len(_races), 'views': len(_views)}
@@ -0,0 +1,116 @@
+import os
+import time
+import random
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, List, Sequence, Tuple
+import numpy as np
+from app.utils.helper_functions import count_tokens_batch
+
+# OpenAI caps an embeddings request at 300k tokens and 2048 inputs, stay well under both
+EMBED_BATCH_TOKENS = int(os.getenv('EMBED_BATCH_TOKENS', 100_000))
+EMBED_BATCH_INPUTS = int(os.getenv('EMBED_BATCH_INPUTS', 2048))
+# batches in flight at once, across every caller
+EMBED_CONCURRENCY = int(os.getenv('EMBED_CONCURRENCY', 4))
+EMBED_RETRIES = int(os.getenv('EMBED_RETRIES', 3))
+EMBED_RETRY_BASE_SECONDS = float(os.getenv('EMBED_RETRY_BASE_SECONDS', 0.5))
+
+# shared by every embed_texts call, e.g. the ingestion pipeline's embed workers
+_executor = ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY, thread_name_prefix='embed')
+
+def pack_batches(token_counts: Sequence[int], max_tokens: int = EMBED_BATCH_TOKENS,
+                 max_inputs: int = EMBED_BATCH_INPUTS) -> List[Tuple[int, int]]:
+  """
+  Pack consecutive texts into batches under a token and input budget, keeping their order.
+  A text over the token budget on its own gets a batch to itself.
+
+  Args:
+  - token_counts (Sequence[int]): The token count of every text.
+  - max_tokens (int, optional): The token budget per batch. Defaults to EMBED_BATCH_TOKENS.
+  - max_inputs (int, optional): The input budget per batch. Defaults to EMBED_BATCH_INPUTS.
+
+  Returns:
+  - List[Tuple[int, int]]: The (start, end) range of every batch.
+  """
+  batches = []
+  start, tokens = 0, 0
+  for i, count in enumerate(token_counts):
+    if i > start and (tokens + count > max_tokens or i - start >= max_inputs):
+      batches.append((start, i))
+      start, tokens = i, 0
+    tokens += count
+  if start < len(token_counts):
+    batches.append((start, len(token_counts)))
+  return batches
+
+def _embed_batch(embed: Callable[[List[str]], List[List[float]]], texts: List[str], retries: int) -> List[List[float]]:
+  """
+  Embed one batch, retrying it alone with jittered exponential backoff.
+  """
+  for attempt in range(retries + 1):
+    try:
+      return embed(texts)
+    except Exception as e:
+      if attempt == retries:
+        raise
+      delay = EMBED_RETRY_BASE_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5)
+      print(f'Embedding batch of {len(texts)} failed ({e}), retrying in {delay:.2f}s')
+      time.sleep(delay)
+
+def embed_texts(texts: Sequence[str], embed: Callable[[List[str]], List[List[float]]],
+                concurrency: int = EMBED_CONCURRENCY, retries: int = EMBED_RETRIES,
+                max_tokens: int = EMBED_BATCH_TOKENS, max_inputs: int = EMBED_BATCH_INPUTS) -> np.ndarray:
+  """
+  Embed texts in token-packed batches, several at a time.
+
+  At most `concurrency` batches of this call are in flight, and at most EMBED_CONCURRENCY across
+  all calls, which share one executor; a failed batch is retried on its own without redoing the
+  others. Vectors are written back in input order.
+
+  Args:
+  - texts (Sequence[str]): The texts to embed.
+  - embed (Callable[[List[str]], List[List[float]]]): Embeds one batch, e.g. OpenAIEmbeddings.embed_documents.
+  - concurrency (int, optional): The batches of this call in flight. Defaults to EMBED_CONCURRENCY.
+  - retries (int, optional): The retries per batch. Defaults to EMBED_RETRIES.
+  - max_tokens (int, optional): The token budget per batch. Defaults to EMBED_BATCH_TOKENS.
+  - max_inputs (int, optional): The input budget per batch. Defaults to EMBED_BATCH_INPUTS.
+
+  Returns:
+  - np.ndarray: (len(texts), dimensions) float32 vectors.
+  """
+  texts = list(texts)
+  if not texts:
+    return np.empty((0, 0), dtype=np.float32)
+  started = time.perf_counter()
+  token_counts = count_tokens_batch(texts)
+  batches = pack_batches(token_counts, max_tokens=max_tokens, max_inputs=max_inputs)
+
+  vectors = None
+  pending = iter(batches)
+  in_flight = {}
+
+  def submit_next() -> None:
+    batch = next(pending, None)
+    if batch is not None:
+      in_flight[_executor.submit(_embed_batch, embed, texts[batch[0]:batch[1]], retries)] = batch
+
+  for _ in range(concurrency):
+    submit_next()
+  try:
+    while in_flight:
+      done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+      for future in done:
+        start, end = in_flight.pop(future)
+        batch_vectors = np.asarray(future.result(), dtype=np.float32)
+        if vectors is None:
+          vectors = np.empty((len(texts), batch_vectors.shape[1]), dtype=np.float32)
+        vectors[start:end] = batch_vectors
+        submit_next()
+  finally:
+    # after a failed batch don't leave this call's queued batches to hold up other callers
+    for future in in_flight:
+      future.cancel()
+
+  seconds = time.perf_counter() - started
+  print(f'Embedded {len(texts)} texts in {len(batches)} batches in {seconds:.2f}s '
+        f'({sum(token_counts) / seconds:.0f} tokens/s, {len(batches) / seconds:.1f} batches/s)')
+  return vectors
@@ -0,0 +1,117 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Iterable, Set, Tuple
+
+# one JSON line per upserted batch, appended as soon as the index accepted it
+INGEST_MANIFEST_PATH = os.getenv('INGEST_MANIFEST_PATH', 'ingest_manifest.jsonl')
+
+def batch_hash(texts: Iterable[str]) -> str:
+  """
+  Hash the contents of a batch of chunks. A batch whose chunks change hashes differently and is ingested again.
+
+  Args:
+  - texts (Iterable[str]): The chunk texts, in order.
+
+  Returns:
+  - str: The hex digest.
+  """
+  digest = hashlib.blake2b(digest_size=16)
+  for text in texts:
+    encoded = text.encode('utf-8')
+    # length prefixed so that moving text between chunks changes the hash
+    digest.update(len(encoded).to_bytes(8, 'little'))
+    digest.update(encoded)
+  return digest.hexdigest()
+
+class Manifest:
+  """
+  The (source object, batch hash) pairs already upserted into an index, persisted as an
+  append-only file so a failed or interrupted ingestion resumes where it stopped.
+  Safe to share between threads.
+  """
+
+  def __init__(self, index_name: str, path: str = INGEST_MANIFEST_PATH, fresh: bool = False):
+    """
+    Args:
+    - index_name (str): The index the batches went into; entries for other indexes are ignored.
+    - path (str, optional): The manifest file. Defaults to INGEST_MANIFEST_PATH.
+    - fresh (bool, optional): Forget this index's entries, e.g. after recreating it. Defaults to False.
+    """
+    self.index_name = index_name
+    self.path = path
+    self._lock = threading.Lock()
+    self._done: Set[Tuple[str, str]] = set()
+    if fresh:
+      self._forget()
+    else:
+      self._read()
+
+  def _entries(self) -> Iterable[dict]:
+    try:
+      with open(self.path) as f:
+        lines = f.readlines()
+    except FileNotFoundError:
+      return []
+    entries = []
+    for line in lines:
+      try:
+        entries.append(json.loads(line))
+      except ValueError:
+        # the last line is cut short if the process died while writing it
+        continue
+    return entries
+
+  def _read(self) -> None:
+    self._done = {(entry['source'], entry['batch']) for entry in self._entries() if entry.get('index') == self.index_name}
+    if self._done:
+      print(f'Resuming ingestion into {self.index_name}: {len(self._done)} batches already upserted')
+
+  def _forget(self) -> None:
+    kept = [entry for entry in self._entries() if entry.get('index') != self.index_name]
+    directory = os.path.dirname(self.path)
+    if directory:
+      os.makedirs(directory, exist_ok=True)
+    temporary = f'{self.path}.tmp'
+    with open(temporary, 'w') as f:
+      f.writelines(json.dumps(entry) + '\n' for entry in kept)
+    os.replace(temporary, self.path)
+
+  def __len__(self) -> int:
+    return len(self._done)
+
+  def done(self, source: str, batch: str) -> bool:
+    """
+    Check whether a batch was already upserted.
+
+    Args:
+    - source (str): The source object, e.g. s3://bucket/key.
+    - batch (str): The batch hash from batch_hash.
+
+    Returns:
+    - bool: True if the batch can be skipped.
+    """
+    with self._lock:
+      return (source, batch) in self._done
+
+  def record(self, source: str, batch: str) -> None:
+    """
+    Record a batch as upserted. Only call this once the index accepted the batch.
+
+    Args:
+    - source (str): The source object, e.g. s3://bucket/key.
+    - batch (str): The batch hash from batch_hash.
+    """
+    line = json.dumps({'index': self.index_name, 'source': source, 'batch': batch}) + '\n'
+    with self._lock:
+      if (source, batch) in self._done:
+        return
+      directory = os.path.dirname(self.path)
+      if directory:
+        os.makedirs(directory, exist_ok=True)
+      with open(self.path, 'a') as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+      self._done.add((source, batch))
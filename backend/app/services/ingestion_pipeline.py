@@ -0,0 +1,214 @@
+import os
+import time
+import queue
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from app.services import aws_service, pinecone_service, candidate_views, ingest_manifest, upsert_scheduler
+
+# items waiting between two stages, this bounds the memory of the whole pipeline
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 4))
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 100))
+FETCH_WORKERS = int(os.getenv('FETCH_WORKERS', 8))
+EMBED_WORKERS = int(os.getenv('EMBED_WORKERS', 4))
+
+# end of stream marker, every worker of a stage passes it on to its siblings
+_DONE = object()
+
+class _Pipeline:
+  """
+  Threads connected by bounded queues. Each stage pulls from its inbox and pushes to its
+  outbox, so a slow stage blocks the ones before it instead of letting items pile up.
+  """
+
+  def __init__(self):
+    self.failed = threading.Event()
+    self.errors: List[BaseException] = []
+    self.threads: List[threading.Thread] = []
+    self.counts: Dict[str, int] = {}
+    self._lock = threading.Lock()
+
+  def put(self, outbox: queue.Queue, item: Any) -> bool:
+    # never block forever on a queue whose consumer has died
+    while not self.failed.is_set():
+      try:
+        outbox.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def fail(self, stage: str, error: BaseException) -> None:
+    print(f'Ingestion stage {stage} failed: {error}')
+    with self._lock:
+      self.errors.append(error)
+    self.failed.set()
+
+  def count(self, stage: str, n: int = 1) -> None:
+    with self._lock:
+      self.counts[stage] = self.counts.get(stage, 0) + n
+
+  def source(self, stage: str, items: Iterable[Any]) -> queue.Queue:
+    """
+    Start a stage that feeds an iterable into a new queue.
+    """
+    outbox = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+
+    def run():
+      try:
+        for item in items:
+          if not self.put(outbox, item):
+            return
+          self.count(stage)
+      except Exception as e:
+        self.fail(stage, e)
+      finally:
+        self.put(outbox, _DONE)
+
+    self._start(stage, run)
+    return outbox
+
+  def stage(self, stage: str, fn: Callable[[Any], Iterable[Any]], inbox: queue.Queue, workers: int) -> queue.Queue:
+    """
+    Start a stage of `workers` threads, each applying fn to items of the inbox. fn yields the
+    stage's outputs, which go to a new queue.
+    """
+    outbox = queue.Queue(maxsize=INGEST_QUEUE_SIZE)
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def run():
+      try:
+        while not self.failed.is_set():
+          try:
+            item = inbox.get(timeout=0.1)
+          except queue.Empty:
+            continue
+          if item is _DONE:
+            self.put(inbox, _DONE)
+            return
+          for output in fn(item):
+            if not self.put(outbox, output):
+              return
+          self.count(stage)
+      except Exception as e:
+        self.fail(stage, e)
+      finally:
+        # the last worker out closes the stage
+        with lock:
+          remaining[0] -= 1
+          if remaining[0] == 0:
+            self.put(outbox, _DONE)
+
+    for _ in range(workers):
+      self._start(stage, run)
+    return outbox
+
+  def drain(self, inbox: queue.Queue) -> None:
+    """
+    Wait for the last stage to finish and for every thread to exit.
+    """
+    while not self.failed.is_set():
+      try:
+        if inbox.get(timeout=0.1) is _DONE:
+          break
+      except queue.Empty:
+        continue
+    for thread in self.threads:
+      thread.join()
+
+  def _start(self, stage: str, run: Callable[[], None]) -> None:
+    thread = threading.Thread(target=run, name=f'ingest-{stage}', daemon=True)
+    thread.start()
+    self.threads.append(thread)
+
+def _batches(document) -> Iterable[Dict[str, Any]]:
+  chunks = pinecone_service.chunk_documents([document])
+  for start in range(0, len(chunks), INGEST_BATCH_SIZE):
+    batch = chunks[start:start + INGEST_BATCH_SIZE]
+    yield {'source': document.metadata.get('source'), 'chunks': batch,
+           'hash': ingest_manifest.batch_hash(chunk.page_content for chunk in batch)}
+
+def run(prefix: str = aws_service.PREFIX, keys: Optional[Iterable[str]] = None, fresh: bool = False) -> Dict[str, Any]:
+  """
+  Stream the S3 corpus into the vector index through concurrent stages with bounded queues:
+  list -> fetch -> chunk -> embed -> upsert. Only a few documents and batches are in memory at
+  any time, and the first upserts happen while later objects are still downloading. Upserts go
+  through an UpsertScheduler, which adapts to how fast the index accepts them and holds back
+  embedding while its window is full.
+
+  Every upserted batch is checkpointed in the ingestion manifest. A rerun, e.g. after a failure,
+  still reads the corpus but skips embedding and upserting the batches that already made it,
+  and record ids derive from the contents so nothing is duplicated.
+
+  The candidate views are updated batch by batch and, when the whole prefix was ingested, races
+  that are no longer in the corpus are dropped from them at the end.
+
+  Args:
+  - prefix (str, optional): The S3 key prefix. Defaults to aws_service.PREFIX.
+  - keys (Optional[Iterable[str]]): The object keys to ingest. Defaults to every key under the prefix.
+  - fresh (bool, optional): Ignore the manifest and ingest everything, e.g. into a recreated index. Defaults to False.
+
+  Returns:
+  - Dict[str, Any]: The items each stage processed, the batches skipped, the upsert scheduler's
+    stats and the seconds taken.
+
+  Raises:
+  - Exception: The first stage error, after the pipeline has stopped.
+  """
+  started = time.perf_counter()
+  pipeline = _Pipeline()
+  manifest = ingest_manifest.Manifest(pinecone_service.PINECONE_INDEX_NAME, fresh=fresh)
+  scheduler = upsert_scheduler.UpsertScheduler(pinecone_service.upsert_records)
+  seen_races = set()
+  seen_lock = threading.Lock()
+
+  def fetch(key):
+    yield aws_service.fetch_document(key)
+
+  def embed(batch):
+    if manifest.done(batch['source'], batch['hash']):
+      pipeline.count('skipped')
+      yield batch
+    else:
+      yield {**batch, 'records': pinecone_service.embed_chunks(batch['chunks'])}
+
+  def upserted(batch):
+    if 'records' in batch:
+      manifest.record(batch['source'], batch['hash'])
+      pipeline.count('records', len(batch['records']))
+    texts = [chunk.page_content for chunk in batch['chunks']]
+    candidate_views.upsert_races(texts, persist=False)
+    with seen_lock:
+      seen_races.update(candidate_views.parse_races(texts))
+
+  def upsert(batch):
+    # blocks while the scheduler's window is full, which in turn blocks the embed stage
+    if 'records' in batch:
+      scheduler.submit(batch['records'], on_done=lambda: upserted(batch))
+    else:
+      # skipped batches still count as present in the corpus for the candidate views
+      upserted(batch)
+    return ()
+
+  listed = pipeline.source('list', keys if keys is not None else aws_service.iter_keys(prefix))
+  documents = pipeline.stage('fetch', fetch, listed, FETCH_WORKERS)
+  batches = pipeline.stage('chunk', _batches, documents, 1)
+  embedded = pipeline.stage('embed', embed, batches, EMBED_WORKERS)
+  done = pipeline.stage('upsert', upsert, embedded, 1)
+  pipeline.drain(done)
+  # let the requests in flight finish, and checkpoint, even if another stage failed
+  upserts = {}
+  try:
+    upserts = scheduler.close()
+  except Exception as e:
+    pipeline.fail('upsert', e)
+
+  if pipeline.errors:
+    raise pipeline.errors[0]
+  if keys is None:
+    # a partial ingest only saw some of the corpus, the other races are still in it
+    candidate_views.retain(seen_races)
+  seconds = time.perf_counter() - started
+  print(f"Ingested {pipeline.counts.get('list', 0)} objects, {pipeline.counts.get('records', 0)} records in {seconds:.2f}s, "
+        f"skipped {pipeline.counts.get('skipped', 0)} batches upserted by an earlier run")
+  return {**pipeline.counts, 'upserts': upserts, 'seconds': seconds}
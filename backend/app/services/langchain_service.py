@@ -1,15 +1,22 @@
 import os
 import json
+import time
+from typing import Any, Dict, List, Optional
 from langchain_community.document_loaders import S3DirectoryLoader
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
+from langchain_core.vectorstores import VectorStoreRetriever
 from langchain_openai import OpenAIEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_groq import ChatGroq
-from langchain_pinecone import PineconeVectorStore
 from dotenv import load_dotenv
-from app.services import pinecone_service, retrieval_service, aws_service
-from app.utils.helper_functions import build_prompt, pretty_print_context, format_contexts, get_current_datetime, get_recommendation_prompt
+from app.services import pinecone_service, retrieval_service, llm_router, candidate_views, ingestion_pipeline
+from app.utils.helper_functions import build_prompt, pretty_print_context, pack_contexts, get_current_datetime, get_canonical_retrieval_query, format_race_list, RETRIEVAL_MONTH_WINDOW
+from app.utils.deadline import Deadline, run_stage, arun_stage, TIER_RACE_LIST, TIER_UNAVAILABLE
+from app.utils.race_encoding import expand_links, link_ids
+from app.utils.race_scoring import TARGET_DISTANCES, athlete_profile, fitness_bucket, score_races
+from app.utils.geo import nearby_states, state_code
+from app.utils.race_metadata import UNSCHEDULED_MONTHS
 from flask import current_app
 
 # Load environment variables from .env file
@@ -19,6 +26,9 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 PINECONE_INDEX_NAME = os.getenv('PINECONE_INDEX_NAME')
 LLM = os.getenv('LLM')
 EMBEDDING_MODEL = OpenAIEmbeddings(model=os.getenv('EMBEDDING_MODEL'))
+LLM_ROUTER = llm_router.build_router()
+
+UNAVAILABLE_ANSWER = "Sorry, I couldn't look up races right now. Please try again in a moment."
 
 def original_rag(prompt):
   """
@@ -37,9 +47,8 @@ def original_rag(prompt):
   )
   docs = text_splitter.split_documents(documents)
   
-  # Embed and store document splits in a vector store
-  # vector_store = PineconeVectorStore.from_documents(docs, EMBEDDING_MODEL, index_name=PINECONE_INDEX_NAME)
-  vector_store = PineconeVectorStore.from_existing_index(index_name=PINECONE_INDEX_NAME, embedding=EMBEDDING_MODEL)
+  # Load the vector store the documents were embedded into
+  vector_store = pinecone_service.load_index()
 
   # Initialize a retriever from our vector store
   retriever = vector_store.as_retriever(search_type="similarity", search_kwargs={"k": 6})
@@ -62,55 +71,229 @@ def original_rag(prompt):
 
 def load_chunk_embed():
   """
-  Load data from S3, process the data, batch upload the generated embeddings.
+  Stream data from S3 through chunking and embedding into the Pinecone index.
   """
-  # Load the contents of the S3 bucket
-  s3_documents = aws_service.load_docs()
   print('Begin upload of embeddings')
-  pinecone_service.generate_and_async_batch_upload_embeddings(s3_documents)
+  ingestion_pipeline.run()
   print('Finished upload of embeddings')
 
 # load_chunk_embed()
 
-def handle_query(query):
+def _build_rag_chain(llm, formatted_context: str, curr_datetime: str):
+  """
+  Build the RAG chain that answers a query over an already formatted context.
+
+  Args:
+  - llm: The chat model used to generate the answer.
+  - formatted_context (str): The retrieved context, formatted for the prompt.
+  - curr_datetime (str): The current date and time to include in the prompt.
+
+  Returns:
+  - The runnable chain, invoked with the user query.
+  """
+  prompt = build_prompt()
+  chain = (
+    {'context': lambda x: formatted_context, 'current_datetime': lambda x: curr_datetime, 'query': RunnablePassthrough()}
+     | prompt
+     | llm
+     | StrOutputParser()
+  )
+  return chain
+
+def _race_list_response(contexts: List[str], tier: str) -> Dict[str, Any]:
+  """
+  Build the chat response used when generation didn't finish in time: the retrieved races as a list.
+  """
+  races = []
+  for context in contexts:
+    try:
+      races.append(json.loads(context))
+    except ValueError:
+      continue
+  return {'answer': format_race_list(contexts), 'races': races, 'tier': tier}
+
+def handle_query(query, deadline: Optional[Deadline] = None) -> Dict[str, Any]:
   """
   Retrieve relevant documents and run the given query through a RAG chain.
+
+  Every stage runs within the request deadline. A late rerank falls back to vector order and
+  a late generation to a plain race list; the response is tagged with the tier that served it.
+
+  Args:
+  - query (str): The user query.
+  - deadline (Optional[Deadline]): The request deadline. Defaults to a new REQUEST_DEADLINE_SECONDS deadline.
+
+  Returns:
+  - Dict[str, Any]: The answer and its tier. Race list answers also carry the races.
   """
-  llm = ChatGroq(temperature=0, model_name=LLM)
+  deadline = deadline or Deadline()
+  llm = LLM_ROUTER.as_runnable()
 
   print(f"Pinecone Index Name: {PINECONE_INDEX_NAME}")
 
   retriever = current_app.retriever
   print(f"Retriever Configuration: {retriever}")
 
-  retrieved_docs = retrieval_service.retrieve_docs_cohere_rerank(retriever=retriever, query=query)
+  retrieved_docs = retrieval_service.retrieve_docs_cohere_rerank(retriever=retriever, query=query, deadline=deadline)
+  if deadline.tier == TIER_UNAVAILABLE:
+    return {'answer': UNAVAILABLE_ANSWER, 'tier': deadline.tier}
   print("Retrieved Documents:")
   pretty_print_context(retrieved_docs)
   print('\n\n')
 
-  prompt = build_prompt()
   curr_datetime = get_current_datetime()
-  formatted_context = format_contexts(retrieved_docs)
- 
-  chain = (
-    {'context': lambda x: formatted_context, 'current_datetime': lambda x: curr_datetime, 'query': RunnablePassthrough()}
-     | prompt
-     | llm
-     | StrOutputParser()
-  )
+  formatted_context = pack_contexts(retrieved_docs, encode=True)
+  chain = _build_rag_chain(llm, formatted_context, curr_datetime)
 
-  return chain.invoke(query)
+  try:
+    answer = run_stage(deadline, 'generation', chain.invoke, query)
+  except Exception as e:
+    deadline.degrade(TIER_RACE_LIST, e)
+    return _race_list_response(retrieved_docs, deadline.tier)
 
-def get_recommendations(location: str, recent_stats, ytd_stats):
+  # the context refers to links by id, expand the ones it gave back into full links
+  return {'answer': expand_links(answer, known=link_ids(retrieved_docs)), 'tier': deadline.tier}
+
+async def ahandle_query(query: str, retriever: VectorStoreRetriever, deadline: Optional[Deadline] = None) -> Dict[str, Any]:
   """
-  Retrieve relevant documents based on user data.
+  Asynchronously retrieve relevant documents and run the given query through a RAG chain.
+  Degrades like handle_query when stages miss the deadline.
+
+  Args:
+  - query (str): The user query.
+  - retriever (VectorStoreRetriever): The retriever to use for document retrieval.
+  - deadline (Optional[Deadline]): The request deadline. Defaults to a new REQUEST_DEADLINE_SECONDS deadline.
+
+  Returns:
+  - Dict[str, Any]: The answer and its tier. Race list answers also carry the races.
   """
-  llm = ChatGroq(temperature=0, model_name=LLM)
-  retriever = current_app.retriever
-  prompt = get_recommendation_prompt(location=location, recent_stats=recent_stats, ytd_stats=ytd_stats)
-  retrieved_docs = retrieval_service.retrieve_docs_cohere_rerank(retriever=retriever, query=prompt)
-  race_jsons = [json.loads(json_str) for json_str in retrieved_docs]
+  deadline = deadline or Deadline()
+  llm = LLM_ROUTER.as_runnable()
+
+  retrieved_docs = await retrieval_service.aretrieve_docs_cohere_rerank(retriever=retriever, query=query, deadline=deadline)
+  if deadline.tier == TIER_UNAVAILABLE:
+    return {'answer': UNAVAILABLE_ANSWER, 'tier': deadline.tier}
   print("Retrieved Documents:")
   pretty_print_context(retrieved_docs)
   print('\n\n')
+
+  curr_datetime = get_current_datetime()
+  formatted_context = pack_contexts(retrieved_docs, encode=True)
+  chain = _build_rag_chain(llm, formatted_context, curr_datetime)
+
+  try:
+    answer = await arun_stage(deadline, 'generation', chain.ainvoke(query))
+  except Exception as e:
+    deadline.degrade(TIER_RACE_LIST, e)
+    return _race_list_response(retrieved_docs, deadline.tier)
+
+  return {'answer': expand_links(answer, known=link_ids(retrieved_docs)), 'tier': deadline.tier}
+
+def _location_filter(location: str) -> Optional[Dict[str, Any]]:
+  """
+  Build the metadata filter that keeps races in or near the athlete's state, None if the state is unknown.
+  Cancelled races and races whose date has passed are left out.
+  """
+  code = state_code(location)
+  if code is None:
+    return None
+  return {'state': {'$in': nearby_states(code)}, 'month': {'$nin': UNSCHEDULED_MONTHS}}
+
+def _view_candidates(location: str) -> Optional[List[str]]:
+  """
+  Read the candidates from the materialised views, None if they have nothing for the location.
+  """
+  try:
+    candidates = candidate_views.get_candidates(location, months=RETRIEVAL_MONTH_WINDOW)
+  except Exception as e:
+    print(f'Error reading candidate views: {e}')
+    return None
+  if candidates:
+    print(f'Serving {len(candidates)} candidates from the materialised views')
+  return candidates or None
+
+def _candidate_query(location: str, profile: Optional[Dict[str, float]]) -> str:
+  """
+  Build the canonical retrieval query for the athlete's region and fitness level.
+  """
+  bucket = fitness_bucket(profile)
+  return get_canonical_retrieval_query(location=location, bucket=bucket, distances=TARGET_DISTANCES[bucket])
+
+def get_candidates(location: str, retriever: Optional[VectorStoreRetriever] = None, deadline: Optional[Deadline] = None,
+                   profile: Optional[Dict[str, float]] = None) -> List[str]:
+  """
+  Retrieve candidate races in and around the athlete's state. Only the location and whatever
+  profile is already known locally are needed, so this can run while the athlete's stats are
+  still being fetched.
+
+  The candidates come from the materialised (region, month) views when ingestion has built
+  them, and otherwise from a similarity search with a canonical query, so similar athletes
+  hit the candidate cache.
+
+  Args:
+  - location (str): The athlete's location, formatted as "City, State".
+  - retriever (Optional[VectorStoreRetriever]): The retriever to use. Defaults to the app's retriever.
+  - deadline (Optional[Deadline]): The request deadline. Defaults to None (no timeouts).
+  - profile (Optional[Dict[str, float]]): The athlete's profile from athlete_profile, None if unknown.
+
+  Returns:
+  - List[str]: The candidate race contexts.
+  """
+  candidates = _view_candidates(location)
+  if candidates is not None:
+    return candidates
+  retriever = retriever or current_app.retriever
+  query = _candidate_query(location, profile)
+  print(f"Candidate query: {query}")
+  return retrieval_service.retrieve_candidates(retriever=retriever, query=query, deadline=deadline,
+                                               metadata_filter=_location_filter(location))
+
+async def aget_candidates(location: str, retriever: VectorStoreRetriever, deadline: Optional[Deadline] = None,
+                          profile: Optional[Dict[str, float]] = None) -> List[str]:
+  """
+  Asynchronously retrieve candidate races in and around the athlete's state. See get_candidates.
+
+  Args:
+  - location (str): The athlete's location, formatted as "City, State".
+  - retriever (VectorStoreRetriever): The retriever to use.
+  - deadline (Optional[Deadline]): The request deadline. Defaults to None (no timeouts).
+  - profile (Optional[Dict[str, float]]): The athlete's profile from athlete_profile, None if unknown.
+
+  Returns:
+  - List[str]: The candidate race contexts.
+  """
+  candidates = _view_candidates(location)
+  if candidates is not None:
+    return candidates
+  query = _candidate_query(location, profile)
+  print(f"Candidate query: {query}")
+  return await retrieval_service.aretrieve_candidates(retriever=retriever, query=query, deadline=deadline,
+                                                      metadata_filter=_location_filter(location))
+
+def rank_candidates(candidates: List[str], location: str, recent_stats, metrics=None) -> List[Dict[str, Any]]:
+  """
+  Score the candidate races for the athlete and keep the best RERANK_TOP_N.
+
+  Args:
+  - candidates (List[str]): The candidate race contexts.
+  - location (str): The athlete's location, formatted as "City, State".
+  - recent_stats (dict): The athlete's recent run totals, None if unavailable.
+  - metrics (Optional[Dict[str, np.ndarray]]): The athlete's training metrics, None if no runs are stored.
+
+  Returns:
+  - List[Dict[str, Any]]: The recommended races, best first, each with its score breakdown.
+  """
+  races = []
+  for candidate in candidates:
+    try:
+      races.append(json.loads(candidate))
+    except ValueError:
+      continue
+  profile = athlete_profile(recent_stats=recent_stats, metrics=metrics)
+  started = time.perf_counter()
+  race_jsons = score_races(races, location, profile, top_n=retrieval_service.RERANK_TOP_N)
+  print(f'Scored {len(races)} candidate races in {(time.perf_counter() - started) * 1000:.1f}ms')
+  print("Recommended Races:")
+  pretty_print_context([json.dumps(race) for race in race_jsons])
+  print('\n\n')
   return race_jsons
\ No newline at end of file
@@ -0,0 +1,250 @@
+import os
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, List, Optional
+from langchain_core.language_models import BaseChatModel
+from langchain_core.runnables import RunnableLambda
+from langchain_groq import ChatGroq
+from langchain_openai import ChatOpenAI
+from dotenv import load_dotenv
+from app.utils.deadline import STAGE_TIMEOUTS
+
+# Load environment variables from .env file
+load_dotenv()
+
+LLM = os.getenv('LLM')
+GROQ_API_BASE = os.getenv('GROQ_API_BASE')
+OPENAI_LLM = os.getenv('OPENAI_LLM')
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE')
+
+EWMA_ALPHA = float(os.getenv('LLM_EWMA_ALPHA', 0.2))
+# hedge a call once it has run longer than this percentile of the provider's recent latencies
+HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', 95))
+HEDGE_MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+# providers whose error EWMA is above this are skipped until the cooldown has passed
+MAX_ERROR_RATE = float(os.getenv('LLM_MAX_ERROR_RATE', 0.5))
+UNHEALTHY_COOLDOWN_SECONDS = float(os.getenv('LLM_UNHEALTHY_COOLDOWN_SECONDS', 30))
+
+class Provider:
+  """A chat model backend together with its observed latency and error rate."""
+
+  def __init__(self, name: str, llm: BaseChatModel):
+    self.name = name
+    self.llm = llm
+    self.ewma_latency = None
+    self.ewma_error_rate = 0.0
+    self.last_failure = 0.0
+    self.latencies = deque(maxlen=LATENCY_WINDOW)
+    self.lock = threading.Lock()
+
+  def _record_latency(self, latency: float) -> None:
+    self.latencies.append(latency)
+    if self.ewma_latency is None:
+      self.ewma_latency = latency
+    else:
+      self.ewma_latency = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma_latency
+
+  def record_success(self, latency: float) -> None:
+    with self.lock:
+      self._record_latency(latency)
+      self.ewma_error_rate = (1 - EWMA_ALPHA) * self.ewma_error_rate
+
+  def record_cancelled(self, elapsed: float) -> None:
+    """
+    Record a call cancelled after losing a hedge. It would have taken at least `elapsed`, so that
+    lower bound is counted as a latency sample; leaving it out would only keep the fast calls and
+    drag the EWMA and the hedge percentile down. The error rate is left as it is.
+    """
+    with self.lock:
+      self._record_latency(elapsed)
+
+  def record_failure(self) -> None:
+    with self.lock:
+      self.ewma_error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.ewma_error_rate
+      self.last_failure = time.monotonic()
+
+  def is_healthy(self) -> bool:
+    if self.ewma_error_rate < MAX_ERROR_RATE:
+      return True
+    # let an unhealthy provider take a probe request once it has cooled down
+    return time.monotonic() - self.last_failure > UNHEALTHY_COOLDOWN_SECONDS
+
+  def hedge_delay(self) -> Optional[float]:
+    """
+    Get how long to wait on this provider before hedging to another one.
+
+    Returns:
+    - Optional[float]: The delay in seconds, or None if there aren't enough samples yet.
+    """
+    with self.lock:
+      if len(self.latencies) < HEDGE_MIN_SAMPLES:
+        return None
+      ordered = sorted(self.latencies)
+    return ordered[min(len(ordered) - 1, int(HEDGE_PERCENTILE / 100 * len(ordered)))]
+
+  def stats(self) -> dict:
+    return {
+      'ewma_latency': self.ewma_latency,
+      'ewma_error_rate': self.ewma_error_rate,
+      'healthy': self.is_healthy(),
+      'hedge_delay': self.hedge_delay(),
+    }
+
+class LLMRouter:
+  """
+  Routes each LLM call to the fastest healthy provider and hedges slow calls.
+
+  Providers are ranked by EWMA latency among those whose EWMA error rate is acceptable.
+  If the chosen provider hasn't answered after its hedge delay, the call is also sent to
+  the next provider and whichever answers first wins.
+  """
+
+  def __init__(self, providers: List[Provider], max_workers: int = 32):
+    if not providers:
+      raise ValueError('LLMRouter needs at least one provider')
+    self.providers = providers
+    self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm-router')
+
+  def ranked_providers(self) -> List[Provider]:
+    """
+    Rank providers, fastest healthy provider first. Providers without samples are tried first.
+
+    Returns:
+    - List[Provider]: The providers in the order they should be tried.
+    """
+    healthy = [provider for provider in self.providers if provider.is_healthy()]
+    candidates = healthy or sorted(self.providers, key=lambda provider: provider.ewma_error_rate)[:1]
+    return sorted(candidates, key=lambda provider: provider.ewma_latency or 0.0)
+
+  def _call(self, provider: Provider, input: Any) -> Any:
+    start = time.perf_counter()
+    try:
+      result = provider.llm.invoke(input)
+    except Exception:
+      provider.record_failure()
+      raise
+    provider.record_success(time.perf_counter() - start)
+    return result
+
+  async def _acall(self, provider: Provider, input: Any) -> Any:
+    start = time.perf_counter()
+    try:
+      result = await provider.llm.ainvoke(input)
+    except asyncio.CancelledError:
+      provider.record_cancelled(time.perf_counter() - start)
+      raise
+    except Exception:
+      provider.record_failure()
+      raise
+    provider.record_success(time.perf_counter() - start)
+    return result
+
+  def invoke(self, input: Any) -> Any:
+    """
+    Invoke the fastest healthy provider, hedging to the next one if it is slow.
+
+    Args:
+    - input (Any): The chat model input, e.g. a prompt value.
+
+    Returns:
+    - Any: The first successful response.
+    """
+    ranked = self.ranked_providers()
+    primary, backups = ranked[0], ranked[1:]
+    pending = {self._executor.submit(self._call, primary, input)}
+
+    delay = primary.hedge_delay() if backups else None
+    done, pending = wait(pending, timeout=delay, return_when=FIRST_COMPLETED)
+    if not done and backups:
+      print(f'Hedging LLM call from {primary.name} to {backups[0].name} after {delay:.2f}s')
+      pending.add(self._executor.submit(self._call, backups[0], input))
+      backups = backups[1:]
+
+    error = None
+    while done or pending:
+      for future in done:
+        try:
+          return future.result()
+        except Exception as e:
+          error = e
+      if not pending and backups:
+        # every call in flight failed, fall over to the next provider
+        pending.add(self._executor.submit(self._call, backups[0], input))
+        backups = backups[1:]
+      done, pending = wait(pending, return_when=FIRST_COMPLETED)
+    raise error
+
+  async def ainvoke(self, input: Any) -> Any:
+    """
+    Asynchronously invoke the fastest healthy provider, hedging to the next one if it is slow.
+
+    Args:
+    - input (Any): The chat model input, e.g. a prompt value.
+
+    Returns:
+    - Any: The first successful response.
+    """
+    ranked = self.ranked_providers()
+    primary, backups = ranked[0], ranked[1:]
+    pending = {asyncio.ensure_future(self._acall(primary, input))}
+
+    delay = primary.hedge_delay() if backups else None
+    done, pending = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+    if not done and backups:
+      print(f'Hedging LLM call from {primary.name} to {backups[0].name} after {delay:.2f}s')
+      pending.add(asyncio.ensure_future(self._acall(backups[0], input)))
+      backups = backups[1:]
+
+    error = None
+    try:
+      while done or pending:
+        for task in done:
+          if task.exception() is None:
+            return task.result()
+          error = task.exception()
+        if not pending and backups:
+          pending.add(asyncio.ensure_future(self._acall(backups[0], input)))
+          backups = backups[1:]
+        if not pending:
+          break
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+      raise error
+    finally:
+      # the losing call is no longer needed
+      for task in pending:
+        task.cancel()
+
+  def as_runnable(self) -> RunnableLambda:
+    """
+    Wrap the router so it can be used in place of a chat model in a chain.
+
+    Returns:
+    - RunnableLambda: The router as a runnable supporting invoke and ainvoke.
+    """
+    return RunnableLambda(self.invoke, afunc=self.ainvoke, name='LLMRouter')
+
+  def stats(self) -> dict:
+    return {provider.name: provider.stats() for provider in self.providers}
+
+def build_router() -> LLMRouter:
+  """
+  Build the router from the configured providers. Groq is always configured; OpenAI is
+  added when OPENAI_LLM is set. The *_API_BASE variables point a provider at another
+  server, e.g. a local fake LLM server.
+
+  Returns:
+  - LLMRouter: The configured router.
+  """
+  # a call the generation stage gave up on ends at the same time instead of holding its thread;
+  # the router fails over between providers, so the clients don't retry on their own
+  limits = {'timeout': STAGE_TIMEOUTS['generation'], 'max_retries': 0}
+  groq_kwargs = {'base_url': GROQ_API_BASE} if GROQ_API_BASE else {}
+  providers = [Provider('groq', ChatGroq(temperature=0, model_name=LLM, **limits, **groq_kwargs))]
+  if OPENAI_LLM:
+    openai_kwargs = {'base_url': OPENAI_API_BASE} if OPENAI_API_BASE else {}
+    providers.append(Provider('openai', ChatOpenAI(temperature=0, model=OPENAI_LLM, **limits, **openai_kwargs)))
+  return LLMRouter(providers)
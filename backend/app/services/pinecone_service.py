@@ -4,22 +4,26 @@ from langchain_pinecone import PineconeVectorStore
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
 from langchain_core.documents import Document
-import json
-import re
 from typing import Iterable, List, Dict, Any
-import uuid
+import hashlib
 from dotenv import load_dotenv
 import itertools
+import numpy as np
+from app.services import embedding_executor, ingest_manifest, upsert_scheduler
+from app.utils import race_metadata
 
 # Load environment variables from .env file
 load_dotenv()
 
 PINECONE_API_KEY = os.getenv('PINECONE_API_KEY')
 PINECONE_INDEX_NAME = os.getenv('PINECONE_INDEX_NAME')
+# talk to this index host instead of looking the index up by name, e.g. a local stand-in such as
+# fakes/fake_pinecone_server.py at http://127.0.0.1:8005
+PINECONE_HOST = os.getenv('PINECONE_HOST')
 EMBEDDING_MODEL = OpenAIEmbeddings(model=os.getenv('EMBEDDING_MODEL'))
 
 pc = Pinecone(api_key=PINECONE_API_KEY)
-index = pc.Index(PINECONE_INDEX_NAME)
+index = pc.Index(PINECONE_INDEX_NAME, host=PINECONE_HOST or '')
 
 def print_index_name() -> None:
   """Print the name of the Pinecone index being used."""
@@ -71,105 +75,114 @@ def _chunk_docs_recursively(documents: Iterable[Document]) -> List[Document]:
   chunked_docs = splitter.split_documents(documents)
   return chunked_docs
 
-def _generate_vectors(chunks: List[Document]) -> List[List[float]]:
+def _generate_vectors(chunks: List[Document]) -> np.ndarray:
   """
-  Generate vector representations for each given chunk.
+  Generate vector representations for each given chunk, in token-packed batches embedded concurrently.
 
   Args:
   - chunks (List[Document]): The chunks to vectorize.
 
   Returns:
-  - List[List[float]]: A list of vectors corresponding to the chunks.
+  - np.ndarray: (len(chunks), dimensions) float32 vectors, in the order of the chunks.
   """
   page_contents = [chunk.page_content for chunk in chunks]
-  vectors = EMBEDDING_MODEL.embed_documents(page_contents)
+  vectors = embedding_executor.embed_texts(page_contents, EMBEDDING_MODEL.embed_documents)
   print("Successfully generated vectors.")
   return vectors
 
-def _extract_metadata(chunk: Document) -> Dict[str, Any]:
+def _extract_metadata(chunks: List[Document]) -> List[Dict[str, Any]]:
   """
-  Extract and process metadata from a given document chunk.
+  Extract and process the metadata of a batch of document chunks in one pass.
 
   Args:
-  - chunk (Document): The document chunk to process.
+  - chunks (List[Document]): The document chunks to process.
 
   Returns:
-  - Dict[str, Any]: The processed metadata.
-  """
-  metadata_dict = chunk.metadata
-  json_content = json.loads(chunk.page_content)
-
-  # process date
-  race_date = json_content['Race Date']
-  # check for cancelled race and short circuit if true
-  if "Cancelled" in race_date:
-    metadata_dict['month'] = "Cancelled"
-    metadata_dict['year'] = "Cancelled"
-    return metadata_dict
-  day_of_week, rest = race_date.split(' - ')
-  # Check for "tentative" race date
-  print(rest)
-  #TODO: handle "Unknown Year" adequately
-  if "Tentative" in rest or "TBD" in rest or "Unknown Year" in rest or "Past Date" in rest:
-    metadata_dict['month'] = "Tentative"
-    metadata_dict['year'] = "Tentative"
-    return metadata_dict
-  month_and_day, year = rest.split(', ')
-  month, day = month_and_day.split(' ')
-
-  # process location
-  race_location = json_content['Location']
-  try:
-    city, state = race_location.split(', ')
-  except Exception as e:
-    #TODO: fix scraping script to handle races such as Badwater Ultramarathon that has different start and finish
-    city = "check"
-    state = "details"
-
-  # process available distances
-  race_distances = json_content['Distances Available']
-  # match one or more digits, optional dot, optional more digits, optional whitespace, one or more distance units
-  distance_list = list(set(re.findall(r'\d+\.?\d*\s*(?:M|K)', race_distances)))
-
-  metadata_dict = chunk.metadata
-  metadata_dict['city'] = city
-  metadata_dict['state'] = state
-  metadata_dict['distances'] = distance_list
-  metadata_dict['text'] = chunk.page_content
-  metadata_dict['month'] = month
-  metadata_dict['year'] = year    
-  
-  return metadata_dict
+  - List[Dict[str, Any]]: The processed metadata, in the order of the chunks.
+  """
+  texts = [chunk.page_content for chunk in chunks]
+  columns = race_metadata.extract_metadata(texts)
+  return race_metadata.metadata_records(columns, texts, base=[chunk.metadata for chunk in chunks])
 
-def generate_embeddings(documents: Iterable[Document]) -> List[Dict[str, Any]]:
+def record_id(chunk: Document) -> str:
   """
-  Generate embeddings with metadata for the given documents.
+  Derive a chunk's record id from its source and contents, so upserting it again overwrites
+  the same record instead of adding a duplicate.
 
   Args:
-  - documents (Iterable[Document]): The documents to process and upload.
+  - chunk (Document): The chunk.
+
+  Returns:
+  - str: The record id.
   """
-  polished_embeddings = []
-  chunks = _chunk_docs_manually(documents)
-  vectors_list = _generate_vectors(chunks)
-  chunk_num = 0
-  print(f'Number of chunks: {len(chunks)}')
+  key = f"{chunk.metadata.get('source', '')}\n{chunk.page_content}"
+  return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+
+def build_records(chunks: List[Document], vectors: np.ndarray) -> List[Dict[str, Any]]:
+  """
+  Pair chunks with their vectors and metadata into index records.
 
-  for chunk in chunks:
-    # process chunk metadata
-    metadata = _extract_metadata(chunk)
+  Args:
+  - chunks (List[Document]): The chunks.
+  - vectors (np.ndarray): The chunks' vectors, in the same order.
 
+  Returns:
+  - List[Dict[str, Any]]: The records, with an id, values and metadata each.
+  """
+  records = []
+  for chunk, metadata, vector in zip(chunks, _extract_metadata(chunks), vectors):
     # create full embedding
-    embedding = {
-      'id': str(uuid.uuid4()),
-      'values': vectors_list[chunk_num],
+    records.append({
+      'id': record_id(chunk),
+      'values': np.asarray(vector, dtype=np.float32).tolist(),
       'metadata': metadata
-    }
+    })
+  return records
 
-    polished_embeddings.append(embedding)
-    chunk_num += 1
-  
-  return polished_embeddings
+def chunk_documents(documents: Iterable[Document]) -> List[Document]:
+  """
+  Split documents into one chunk per race, the chunking ingestion uses.
+
+  Args:
+  - documents (Iterable[Document]): The documents to split.
+
+  Returns:
+  - List[Document]: The chunks.
+  """
+  return _chunk_docs_manually(documents)
 
+def embed_chunks(chunks: List[Document]) -> List[Dict[str, Any]]:
+  """
+  Embed chunks and build their index records.
+
+  Args:
+  - chunks (List[Document]): The chunks to embed.
+
+  Returns:
+  - List[Dict[str, Any]]: The records, ready to upsert.
+  """
+  return build_records(chunks, _generate_vectors(chunks))
+
+def upsert_records(records: List[Dict[str, Any]]) -> None:
+  """
+  Upsert one batch of records into the index.
+
+  Args:
+  - records (List[Dict[str, Any]]): The records from embed_chunks.
+  """
+  index.upsert(vectors=records)
+
+def generate_embeddings(documents: Iterable[Document]) -> List[Dict[str, Any]]:
+  """
+  Generate embeddings with metadata for the given documents.
+
+  Args:
+  - documents (Iterable[Document]): The documents to process and upload.
+  """
+  chunks = _chunk_docs_manually(documents)
+  vectors_list = _generate_vectors(chunks)
+  print(f'Number of chunks: {len(chunks)}')
+  return build_records(chunks, vectors_list)
 
 def generate_and_upload_embeddings(documents: Iterable[Document]) -> None:
   """
@@ -216,25 +229,56 @@ def generate_and_batch_upload_embeddings(documents: Iterable[Document]) -> None:
   for embedding_batch in batches(polished_embeddings, batch_size=100):
     index.upsert(vectors=embedding_batch)
 
-def generate_and_async_batch_upload_embeddings(documents: Iterable[Document]) -> None:
+def generate_and_async_batch_upload_embeddings(documents: Iterable[Document], fresh: bool = False) -> None:
   """
   Generate embeddings with metadata for given documents and (asynchronously) **batch** upload to Pinecone index.
 
+  Every upserted batch is recorded in the ingestion manifest, so a rerun after a failure only
+  embeds and upserts the batches that didn't make it.
+
   Args:
   - documents (Iterable[Document]): The documents to process and upload.
+  - fresh (bool, optional): Ignore the manifest and upload everything, e.g. into a recreated index. Defaults to False.
   """
-  polished_embeddings = generate_embeddings(documents=documents)
-
-  # Batch upsert data with 100 vectors per upsert request asynchronously
-  with pc.Index(PINECONE_INDEX_NAME, pool_threads=30) as index:
-    # Send requests in parallel
-    async_results = [
-      index.upsert(vectors=embedding_batch, async_req=True)
-      for embedding_batch in batches(polished_embeddings, batch_size=100)
-    ]
-    # Wait for and retrieve responses (this raises in case of error)
-    [async_result.get() for async_result in async_results]
+  manifest = ingest_manifest.Manifest(PINECONE_INDEX_NAME, fresh=fresh)
+  chunks = _chunk_docs_manually(documents)
 
+  # batches never span two source objects, so each one is checkpointed with its source
+  pending, skipped = [], 0
+  for source, source_chunks in itertools.groupby(chunks, key=lambda chunk: chunk.metadata.get('source', '')):
+    for batch in batches(source_chunks, batch_size=100):
+      batch_hash = ingest_manifest.batch_hash(chunk.page_content for chunk in batch)
+      if manifest.done(source, batch_hash):
+        skipped += 1
+      else:
+        pending.append((source, batch_hash, batch))
+  print(f'{skipped} batches already upserted, {len(pending)} to upload')
+  if not pending:
+    return
+
+  # a few batches are embedded together, so the embedding executor packs and overlaps their
+  # requests, then each batch is submitted and checkpointed once its upsert lands; submit()
+  # blocks while the upsert window is full, which paces the embedding
+  scheduler = upsert_scheduler.UpsertScheduler(upsert_records)
+  error = None
+  try:
+    for start in range(0, len(pending), embedding_executor.EMBED_CONCURRENCY):
+      group = pending[start:start + embedding_executor.EMBED_CONCURRENCY]
+      records = embed_chunks([chunk for _, _, batch in group for chunk in batch])
+      for source, batch_hash, batch in group:
+        scheduler.submit(records[:len(batch)],
+                         on_done=lambda source=source, batch_hash=batch_hash: manifest.record(source, batch_hash))
+        records = records[len(batch):]
+  except Exception as e:
+    # the batches already in flight still finish and are checkpointed
+    error = e
+  try:
+    scheduler.close()
+  except Exception as e:
+    error = error or e
+  if error is not None:
+    print('Some batches failed, rerun to upload them')
+    raise error
 
 def upload_docs(chunks: List[Document], index_name: str) -> PineconeVectorStore:
   """
@@ -257,7 +301,8 @@ def load_index() -> PineconeVectorStore:
   Returns:
   - PineconeVectorStore: The loaded vector store.
   """
-  vector_store = PineconeVectorStore.from_existing_index(index_name=PINECONE_INDEX_NAME, embedding=EMBEDDING_MODEL)
+  # built on the index above so it follows PINECONE_HOST
+  vector_store = PineconeVectorStore(index=index, embedding=EMBEDDING_MODEL)
   return vector_store
 
 def delete_index(index_name: str) -> None:
@@ -0,0 +1,251 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Dict, Hashable, Optional, Tuple
+from app.services import strava_service, activity_store, best_efforts
+from app.utils.deadline import Deadline, TIER_FULL, TIER_UNAVAILABLE
+from app.utils.singleflight import normalize_query
+
+# prefetched recommendations are served for this long after the athlete logs in
+PREFETCH_TTL_SECONDS = float(os.getenv('PREFETCH_TTL_SECONDS', 300))
+PREFETCH_WORKERS = int(os.getenv('PREFETCH_WORKERS', 8))
+PREFETCH_MAX_ENTRIES = int(os.getenv('PREFETCH_MAX_ENTRIES', 10_000))
+# nobody is waiting on a prefetch, so it gets more time than a request before degrading
+PREFETCH_DEADLINE_SECONDS = float(os.getenv('PREFETCH_DEADLINE_SECONDS', 30))
+# a prefetch brought forward to a request's deadline returns just after its last stage times out
+PREFETCH_JOIN_GRACE_SECONDS = float(os.getenv('PREFETCH_JOIN_GRACE_SECONDS', 0.25))
+
+_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='prefetch')
+# key -> (expires_at, Future or asyncio.Task with the recommendations, the prefetch's Deadline,
+# an Event set once the syncs are done and the recommendations themselves are being computed)
+_entries: Dict[Hashable, Tuple[float, Any, Optional[Deadline], Optional[threading.Event]]] = {}
+_lock = threading.Lock()
+started, served, expired = 0, 0, 0
+
+def prefetch_key(athlete_id: Any, access_token: str, athlete_location: Optional[str]) -> Hashable:
+  """
+  Build the cache key of a prefetch. It includes the token so one athlete's session can't read another's.
+
+  Args:
+  - athlete_id (Any): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+  - athlete_location (Optional[str]): The athlete's location, formatted as "City, State".
+
+  Returns:
+  - Hashable: The key.
+  """
+  token_hash = hashlib.blake2b(access_token.encode('utf-8'), digest_size=8).digest()
+  return (str(athlete_id), normalize_query(athlete_location or ''), token_hash)
+
+def _prune(now: float) -> None:
+  global expired
+  stale = [key for key, (expires_at, _, _, _) in _entries.items() if expires_at <= now]
+  for key in stale:
+    del _entries[key]
+  expired += len(stale)
+  while len(_entries) > PREFETCH_MAX_ENTRIES:
+    del _entries[next(iter(_entries))]
+
+def _claim(key: Hashable) -> bool:
+  """
+  Reserve the slot for a new prefetch. Returns False if a live one already exists for the key.
+  """
+  global started
+  now = time.monotonic()
+  with _lock:
+    _prune(now)
+    if key in _entries:
+      return False
+    started += 1
+    # a placeholder until the job is submitted, so concurrent callers don't start a second one
+    _entries[key] = (now + PREFETCH_TTL_SECONDS, None, None, None)
+    return True
+
+def _run(app, athlete_id: Any, access_token: str, athlete_location: Optional[str], deadline: Deadline,
+         ready: threading.Event) -> Dict[str, Any]:
+  with app.app_context():
+    # warm the activity store and the best efforts too, the request path only reads them
+    try:
+      activity_store.sync_athlete(athlete_id, access_token, timeout=deadline.timeout('strava'))
+    except Exception as e:
+      print(f'Error syncing activities during prefetch: {e}')
+    try:
+      best_efforts.sync_athlete_best_efforts(athlete_id, access_token, timeout=deadline.timeout('strava'))
+    except Exception as e:
+      print(f'Error computing best efforts during prefetch: {e}')
+    ready.set()
+    return strava_service.get_recommendations(access_token=access_token, athlete_id=athlete_id,
+                                              athlete_location=athlete_location, deadline=deadline)
+
+def prefetch(app, athlete_id: Any, access_token: str, athlete_location: Optional[str]) -> bool:
+  """
+  Start computing an athlete's recommendations in a background worker.
+
+  Args:
+  - app: The Flask app, the worker runs in its app context.
+  - athlete_id (Any): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+  - athlete_location (Optional[str]): The athlete's location, formatted as "City, State".
+
+  Returns:
+  - bool: True if a prefetch was started, False if one is already running or cached.
+  """
+  key = prefetch_key(athlete_id, access_token, athlete_location)
+  if not _claim(key):
+    return False
+  deadline, ready = Deadline(PREFETCH_DEADLINE_SECONDS), threading.Event()
+  future = _executor.submit(_run, app, athlete_id, access_token, athlete_location, deadline, ready)
+  with _lock:
+    _entries[key] = (_entries[key][0], future, deadline, ready)
+  return True
+
+async def _arun(athlete_id: Any, access_token: str, athlete_location: Optional[str], retriever, deadline: Deadline,
+                ready: threading.Event) -> Dict[str, Any]:
+  try:
+    await asyncio.to_thread(activity_store.sync_athlete, athlete_id, access_token, timeout=deadline.timeout('strava'))
+  except Exception as e:
+    print(f'Error syncing activities during prefetch: {e}')
+  try:
+    await asyncio.to_thread(best_efforts.sync_athlete_best_efforts, athlete_id, access_token,
+                            timeout=deadline.timeout('strava'))
+  except Exception as e:
+    print(f'Error computing best efforts during prefetch: {e}')
+  ready.set()
+  return await strava_service.aget_recommendations(access_token=access_token, athlete_id=athlete_id,
+                                                   athlete_location=athlete_location, retriever=retriever,
+                                                   deadline=deadline)
+
+def aprefetch(athlete_id: Any, access_token: str, athlete_location: Optional[str], retriever) -> bool:
+  """
+  Start computing an athlete's recommendations as a background task on the running event loop.
+
+  Args:
+  - athlete_id (Any): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+  - athlete_location (Optional[str]): The athlete's location, formatted as "City, State".
+  - retriever (VectorStoreRetriever): The retriever to use for document retrieval.
+
+  Returns:
+  - bool: True if a prefetch was started, False if one is already running or cached.
+  """
+  key = prefetch_key(athlete_id, access_token, athlete_location)
+  if not _claim(key):
+    return False
+  deadline, ready = Deadline(PREFETCH_DEADLINE_SECONDS), threading.Event()
+  task = asyncio.ensure_future(_arun(athlete_id, access_token, athlete_location, retriever, deadline, ready))
+  with _lock:
+    _entries[key] = (_entries[key][0], task, deadline, ready)
+  return True
+
+def _lookup(key: Hashable, deadline: Optional[Deadline]):
+  """
+  Find the live job for a key. A request that is about to wait on it hurries it along to its own
+  deadline, unless the prefetch is still syncing: those stages don't watch the deadline, so the
+  request is better off computing its own recommendations from what is already stored.
+  """
+  with _lock:
+    entry = _entries.get(key)
+  if entry is None or entry[1] is None or entry[0] <= time.monotonic():
+    return None
+  if deadline is not None and not entry[1].done():
+    if not entry[3].is_set():
+      return None
+    entry[2].shorten(deadline)
+  return entry[1]
+
+def _drop(key: Hashable, job) -> None:
+  with _lock:
+    if _entries.get(key, (None, None, None, None))[1] is job:
+      del _entries[key]
+
+def _result(key: Hashable, job) -> Optional[Dict[str, Any]]:
+  global served
+  if job.cancelled() or job.exception() is not None:
+    # don't keep serving a failed prefetch, the request computes its own
+    _drop(key, job)
+    return None
+  result = job.result()
+  with _lock:
+    served += 1
+    # a prefetch hurried along by a request may have degraded, serve it once and let the next request compute
+    if result.get('tier') != TIER_FULL and _entries.get(key, (None, None, None, None))[1] is job:
+      del _entries[key]
+  return result
+
+def _late(key: Hashable, job, deadline: Deadline) -> Dict[str, Any]:
+  # the prefetch is still running, a second pipeline couldn't finish in time either. It was
+  # hurried along to this deadline so it can only finish degraded, the next request starts afresh
+  _drop(key, job)
+  deadline.degrade(TIER_UNAVAILABLE, 'prefetch still running at the request deadline')
+  return {'recommendations': [], 'tier': deadline.tier}
+
+def get_prefetched(athlete_id: Any, access_token: str, athlete_location: Optional[str],
+                   deadline: Optional[Deadline] = None) -> Optional[Dict[str, Any]]:
+  """
+  Get prefetched recommendations, joining a prefetch that is still running. The prefetch's
+  deadline is brought forward to the request's, so its stages degrade in time, and it is
+  waited on for what is left of the request deadline. A prefetch still syncing the athlete's
+  activities isn't joined.
+
+  Args:
+  - athlete_id (Any): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+  - athlete_location (Optional[str]): The athlete's location, formatted as "City, State".
+  - deadline (Optional[Deadline]): The request deadline. Defaults to waiting until the prefetch finishes.
+
+  Returns:
+  - Optional[Dict[str, Any]]: The recommendations, an empty list at the unavailable tier if the
+    prefetch didn't finish by the deadline, or None if there is no usable prefetch or it is still syncing.
+  """
+  key = prefetch_key(athlete_id, access_token, athlete_location)
+  job = _lookup(key, deadline)
+  if not isinstance(job, Future):
+    return None
+  try:
+    job.exception(timeout=None if deadline is None else deadline.remaining() + PREFETCH_JOIN_GRACE_SECONDS)
+  except FutureTimeoutError:
+    return _late(key, job, deadline)
+  except CancelledError:
+    return None
+  return _result(key, job)
+
+async def aget_prefetched(athlete_id: Any, access_token: str, athlete_location: Optional[str],
+                          deadline: Optional[Deadline] = None) -> Optional[Dict[str, Any]]:
+  """
+  Asynchronously get prefetched recommendations. See get_prefetched.
+
+  Args:
+  - athlete_id (Any): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+  - athlete_location (Optional[str]): The athlete's location, formatted as "City, State".
+  - deadline (Optional[Deadline]): The request deadline. Defaults to waiting until the prefetch finishes.
+
+  Returns:
+  - Optional[Dict[str, Any]]: The recommendations, an empty list at the unavailable tier if the
+    prefetch didn't finish by the deadline, or None if there is no usable prefetch or it is still syncing.
+  """
+  key = prefetch_key(athlete_id, access_token, athlete_location)
+  job = _lookup(key, deadline)
+  if job is None:
+    return None
+  waiter = asyncio.wrap_future(job) if isinstance(job, Future) else job
+  try:
+    await asyncio.wait_for(asyncio.shield(waiter), timeout=None if deadline is None else deadline.remaining() + PREFETCH_JOIN_GRACE_SECONDS)
+  except asyncio.TimeoutError:
+    return _late(key, job, deadline)
+  except Exception:
+    pass
+  return _result(key, job)
+
+def stats() -> Dict[str, int]:
+  """
+  Get the prefetch counters.
+
+  Returns:
+  - Dict[str, int]: The number of entries, prefetches started, prefetches served and entries expired.
+  """
+  with _lock:
+    return {'entries': len(_entries), 'started': started, 'served': served, 'expired': expired}
@@ -9,18 +9,39 @@ from langchain.retrievers.self_query.base import SelfQueryRetriever
 from langchain_community.cross_encoders import HuggingFaceCrossEncoder
 from langchain.chains.query_constructor.base import AttributeInfo
 from langchain_cohere import CohereRerank
-from typing import List
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Tuple
 import os
+import json
+import time
+import threading
 import cohere
+from app.utils.race_encoding import encode_context
+from app.utils.helper_functions import log_encoding_savings
+from app.utils.deadline import Deadline, run_stage, arun_stage, STAGE_TIMEOUTS, TIER_VECTOR_ORDER, TIER_UNAVAILABLE
+from app.utils.singleflight import SingleFlight
 
 SEARCH_TYPE = 'similarity'
 RETRIEVE_TOP_K = 20
 RERANK_TOP_N = 5
+# candidates fetched for /recommendations, they are scored locally instead of reranked
+RECOMMENDATION_CANDIDATES = int(os.getenv('RECOMMENDATION_CANDIDATES', 50))
+# candidate queries are canonical, so athletes with similar profiles share cached results
+CANDIDATE_CACHE_TTL_SECONDS = float(os.getenv('CANDIDATE_CACHE_TTL_SECONDS', 900))
+CANDIDATE_CACHE_MAX_ENTRIES = int(os.getenv('CANDIDATE_CACHE_MAX_ENTRIES', 4096))
 COHERE_API_KEY = os.getenv('COHERE_API_KEY')
 COHERE_MODEL = 'rerank-english-v3.0'
 CROSS_ENCODER_MODEL = 'BAAI/bge-reranker-base'
 
-co = cohere.Client(COHERE_API_KEY)
+# the client's own timeout ends a rerank that run_stage has given up on
+co = cohere.Client(COHERE_API_KEY, timeout=STAGE_TIMEOUTS['rerank'])
+aco = cohere.AsyncClient(COHERE_API_KEY, timeout=STAGE_TIMEOUTS['rerank'])
+
+# key -> (expires_at, candidate contents)
+_candidate_cache: "OrderedDict[Hashable, Tuple[float, List[str]]]" = OrderedDict()
+_candidate_lock = threading.Lock()
+_candidate_flights = SingleFlight("candidates")
+candidate_hits, candidate_misses = 0, 0
 
 def get_retriever(vector_store: PineconeVectorStore) -> VectorStoreRetriever:
   """
@@ -109,18 +130,42 @@ def retrieve_docs(retriever: VectorStoreRetriever, query: str) -> List[Document]
   retrieved_docs = retriever.invoke(query)
   return retrieved_docs
 
-def retrieve_docs_cohere_rerank(retriever: VectorStoreRetriever, query: str) -> List[str]:
+def _encode_rerank_documents(docs: List[Document]) -> List[str]:
+  """
+  Encode retrieved documents compactly to shrink the rerank request.
+
+  Args:
+  - docs (List[Document]): The retrieved documents.
+
+  Returns:
+  - List[str]: The compact encodings, in the same order as the documents.
+  """
+  encoded = [encode_context(doc.page_content) for doc in docs]
+  log_encoding_savings('rerank', "\n".join(doc.page_content for doc in docs), "\n".join(encoded))
+  return encoded
+
+def retrieve_docs_cohere_rerank(retriever: VectorStoreRetriever, query: str, deadline: Optional[Deadline] = None) -> List[str]:
   """
   Retrieves documents from the vector store and reranks them using the Cohere Reranker.
+
+  With a deadline, a late or failed retrieval returns no documents and a late or failed
+  rerank falls back to vector similarity order; the deadline records the degraded tier.
   
   Args:
   - retriever (VectorStoreRetriever): The retriever to use for document retrieval.
   - query (str): The query string to search for.
+  - deadline (Optional[Deadline]): The request deadline. Defaults to None (no timeouts).
   
   Returns:
   - List[str]: A list of reranked document contents.
   """
-  retrieved_docs = retrieve_docs(retriever=retriever, query=query)
+  try:
+    retrieved_docs = run_stage(deadline, 'retrieval', retrieve_docs, retriever=retriever, query=query)
+  except Exception as e:
+    if deadline is None:
+      raise
+    deadline.degrade(TIER_UNAVAILABLE, e)
+    return []
   if len(retrieved_docs) == 0:
     return []
   # compressor = CohereRerank()
@@ -128,13 +173,176 @@ def retrieve_docs_cohere_rerank(retriever: VectorStoreRetriever, query: str) ->
   #   base_compressor=compressor,
   #   base_retriever=retriever)
   # compression_retriever.invoke(query)
-  rerank_content = [doc.page_content for doc in retrieved_docs]
-  reranked_docs = co.rerank(model=COHERE_MODEL, query=query, 
-                            top_n=RERANK_TOP_N, documents=rerank_content,
-                            return_documents=True)
-  contexts = [doc.document.text for doc in reranked_docs.results]
+  rerank_content = _encode_rerank_documents(retrieved_docs)
+  try:
+    reranked_docs = run_stage(deadline, 'rerank', co.rerank, model=COHERE_MODEL, query=query,
+                              top_n=RERANK_TOP_N, documents=rerank_content,
+                              return_documents=False)
+  except Exception as e:
+    if deadline is None:
+      raise
+    deadline.degrade(TIER_VECTOR_ORDER, e)
+    return [doc.page_content for doc in retrieved_docs[:RERANK_TOP_N]]
+  # map results back to the original documents, the reranker only saw the compact encoding
+  contexts = [retrieved_docs[result.index].page_content for result in reranked_docs.results]
   return contexts
 
+async def aretrieve_docs(retriever: VectorStoreRetriever, query: str) -> List[Document]:
+  """
+  Asynchronously retrieves documents from the vector store based on a query.
+  
+  Args:
+  - retriever (VectorStoreRetriever): The retriever to use for document retrieval.
+  - query (str): The query string to search for.
+  
+  Returns:
+  - List[Document]: A list of retrieved documents.
+  """
+  retrieved_docs = await retriever.ainvoke(query)
+  return retrieved_docs
+
+async def aretrieve_docs_cohere_rerank(retriever: VectorStoreRetriever, query: str, deadline: Optional[Deadline] = None) -> List[str]:
+  """
+  Asynchronously retrieves documents from the vector store and reranks them using the Cohere Reranker.
+  Falls back like retrieve_docs_cohere_rerank when given a deadline.
+  
+  Args:
+  - retriever (VectorStoreRetriever): The retriever to use for document retrieval.
+  - query (str): The query string to search for.
+  - deadline (Optional[Deadline]): The request deadline. Defaults to None (no timeouts).
+  
+  Returns:
+  - List[str]: A list of reranked document contents.
+  """
+  try:
+    retrieved_docs = await arun_stage(deadline, 'retrieval', aretrieve_docs(retriever=retriever, query=query))
+  except Exception as e:
+    if deadline is None:
+      raise
+    deadline.degrade(TIER_UNAVAILABLE, e)
+    return []
+  if len(retrieved_docs) == 0:
+    return []
+  rerank_content = _encode_rerank_documents(retrieved_docs)
+  try:
+    reranked_docs = await arun_stage(deadline, 'rerank', aco.rerank(model=COHERE_MODEL, query=query,
+                                                                    top_n=RERANK_TOP_N, documents=rerank_content,
+                                                                    return_documents=False))
+  except Exception as e:
+    if deadline is None:
+      raise
+    deadline.degrade(TIER_VECTOR_ORDER, e)
+    return [doc.page_content for doc in retrieved_docs[:RERANK_TOP_N]]
+  contexts = [retrieved_docs[result.index].page_content for result in reranked_docs.results]
+  return contexts
+
+def _search_kwargs(k: int, metadata_filter: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+  return {'k': k} if metadata_filter is None else {'k': k, 'filter': metadata_filter}
+
+def _candidate_key(query: str, k: int, metadata_filter: Optional[Dict[str, Any]]) -> Hashable:
+  return (query, k, json.dumps(metadata_filter, sort_keys=True))
+
+def _cached_candidates(key: Hashable) -> Optional[List[str]]:
+  global candidate_hits
+  with _candidate_lock:
+    entry = _candidate_cache.get(key)
+    if entry is None or entry[0] <= time.monotonic():
+      return None
+    _candidate_cache.move_to_end(key)
+    candidate_hits += 1
+    return entry[1]
+
+def _store_candidates(key: Hashable, contents: List[str]) -> List[str]:
+  global candidate_misses
+  with _candidate_lock:
+    candidate_misses += 1
+    # an empty result is more likely an index hiccup than a real answer, don't serve it for the whole TTL
+    if contents:
+      _candidate_cache[key] = (time.monotonic() + CANDIDATE_CACHE_TTL_SECONDS, contents)
+      _candidate_cache.move_to_end(key)
+      while len(_candidate_cache) > CANDIDATE_CACHE_MAX_ENTRIES:
+        _candidate_cache.popitem(last=False)
+  return contents
+
+def _fetch_candidates(key: Hashable, retriever: VectorStoreRetriever, query: str, k: int,
+                      metadata_filter: Optional[Dict[str, Any]]) -> List[str]:
+  retrieved_docs = retriever.invoke(query, **_search_kwargs(k, metadata_filter))
+  return _store_candidates(key, [doc.page_content for doc in retrieved_docs])
+
+async def _afetch_candidates(key: Hashable, retriever: VectorStoreRetriever, query: str, k: int,
+                             metadata_filter: Optional[Dict[str, Any]]) -> List[str]:
+  retrieved_docs = await retriever.ainvoke(query, **_search_kwargs(k, metadata_filter))
+  return _store_candidates(key, [doc.page_content for doc in retrieved_docs])
+
+def retrieve_candidates(retriever: VectorStoreRetriever, query: str, deadline: Optional[Deadline] = None,
+                        k: int = RECOMMENDATION_CANDIDATES, metadata_filter: Optional[Dict[str, Any]] = None) -> List[str]:
+  """
+  Retrieves candidate documents from the vector store in vector similarity order, without reranking.
+
+  Results are cached for CANDIDATE_CACHE_TTL_SECONDS by query and filter, and concurrent misses
+  for the same key share one retrieval. With a deadline, a late or failed retrieval returns no documents.
+
+  Args:
+  - retriever (VectorStoreRetriever): The retriever to use for document retrieval.
+  - query (str): The query string to search for, should be canonical for the cache to hit.
+  - deadline (Optional[Deadline]): The request deadline. Defaults to None (no timeouts).
+  - k (int, optional): The number of candidates. Defaults to RECOMMENDATION_CANDIDATES.
+  - metadata_filter (Optional[Dict[str, Any]]): A Pinecone metadata filter, e.g. {"state": {"$in": ["CA"]}}.
+
+  Returns:
+  - List[str]: The candidate document contents.
+  """
+  key = _candidate_key(query, k, metadata_filter)
+  cached = _cached_candidates(key)
+  if cached is not None:
+    return cached
+  try:
+    return run_stage(deadline, 'retrieval', _candidate_flights.do, key, _fetch_candidates,
+                     key, retriever, query, k, metadata_filter)
+  except Exception as e:
+    if deadline is None:
+      raise
+    deadline.degrade(TIER_UNAVAILABLE, e)
+    return []
+
+async def aretrieve_candidates(retriever: VectorStoreRetriever, query: str, deadline: Optional[Deadline] = None,
+                               k: int = RECOMMENDATION_CANDIDATES, metadata_filter: Optional[Dict[str, Any]] = None) -> List[str]:
+  """
+  Asynchronously retrieves candidate documents without reranking. See retrieve_candidates.
+
+  Args:
+  - retriever (VectorStoreRetriever): The retriever to use for document retrieval.
+  - query (str): The query string to search for, should be canonical for the cache to hit.
+  - deadline (Optional[Deadline]): The request deadline. Defaults to None (no timeouts).
+  - k (int, optional): The number of candidates. Defaults to RECOMMENDATION_CANDIDATES.
+  - metadata_filter (Optional[Dict[str, Any]]): A Pinecone metadata filter, e.g. {"state": {"$in": ["CA"]}}.
+
+  Returns:
+  - List[str]: The candidate document contents.
+  """
+  key = _candidate_key(query, k, metadata_filter)
+  cached = _cached_candidates(key)
+  if cached is not None:
+    return cached
+  try:
+    return await arun_stage(deadline, 'retrieval', _candidate_flights.ado(key, _afetch_candidates,
+                                                                          key, retriever, query, k, metadata_filter))
+  except Exception as e:
+    if deadline is None:
+      raise
+    deadline.degrade(TIER_UNAVAILABLE, e)
+    return []
+
+def candidate_cache_stats() -> Dict[str, int]:
+  """
+  Get the candidate cache counters.
+
+  Returns:
+  - Dict[str, int]: The number of entries, hits and misses.
+  """
+  with _candidate_lock:
+    return {'entries': len(_candidate_cache), 'hits': candidate_hits, 'misses': candidate_misses}
+
 def retrieve_docs_crossencoder_rerank(retriever: VectorStoreRetriever, query: str) -> List[Document]:
   """
   Retrieves documents from the vector store and reranks them using a CrossEncoder model.
@@ -0,0 +1,303 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# point at a local fake Strava server with e.g. STRAVA_API_BASE=http://127.0.0.1:8003/api/v3
+STRAVA_API_BASE = os.getenv('STRAVA_API_BASE', 'https://www.strava.com/api/v3')
+POOL_SIZE = int(os.getenv('STRAVA_POOL_SIZE', 32))
+MAX_RETRIES = int(os.getenv('STRAVA_MAX_RETRIES', 2))
+BACKOFF_SECONDS = float(os.getenv('STRAVA_BACKOFF_SECONDS', 0.25))
+RETRY_STATUSES = (500, 502, 503, 504)
+# Strava's default read limits, replaced by X-RateLimit-Limit once a response has been seen
+DEFAULT_RATE_LIMITS = (100, 1000)
+# requests kept in reserve per window so we shed calls before Strava starts returning 429s
+RATE_LIMIT_HEADROOM = int(os.getenv('STRAVA_RATE_LIMIT_HEADROOM', 5))
+# calls that would have to queue longer than this for the next window are shed instead
+MAX_QUEUE_SECONDS = float(os.getenv('STRAVA_MAX_QUEUE_SECONDS', 1.0))
+SHORT_WINDOW_SECONDS = 15 * 60
+
+class StravaRateLimitError(Exception):
+  """Raised when a Strava call is shed to stay under the rate limit."""
+
+class RateLimitScheduler:
+  """
+  Token buckets mirroring Strava's 15-minute and daily rate limits.
+
+  Each call takes a token from both buckets; they refill when Strava's fixed windows
+  roll over (every quarter hour and at midnight UTC). The bucket sizes and our usage are
+  kept in sync with the X-RateLimit-Limit and X-RateLimit-Usage headers, so calls made
+  by other processes on the same app are accounted for too.
+  """
+
+  def __init__(self, limits=DEFAULT_RATE_LIMITS, headroom: int = RATE_LIMIT_HEADROOM,
+               max_queue_seconds: float = MAX_QUEUE_SECONDS):
+    self.short_limit, self.daily_limit = limits
+    self.short_used, self.daily_used = 0, 0
+    self.headroom = headroom
+    self.max_queue_seconds = max_queue_seconds
+    self.shed = 0
+    self._lock = threading.Lock()
+    self._short_window, self._day = self._windows()
+
+  @staticmethod
+  def _windows():
+    now = time.time()
+    return int(now // SHORT_WINDOW_SECONDS), datetime.now(timezone.utc).date()
+
+  def _roll(self) -> None:
+    short_window, day = self._windows()
+    if short_window != self._short_window:
+      self._short_window, self.short_used = short_window, 0
+    if day != self._day:
+      self._day, self.daily_used = day, 0
+
+  def reserve(self, max_queue_seconds: Optional[float] = None) -> float:
+    """
+    Take a token for one call.
+
+    Args:
+    - max_queue_seconds (Optional[float]): How long the caller is willing to queue. Defaults to MAX_QUEUE_SECONDS.
+
+    Returns:
+    - float: 0 if the call may go ahead, otherwise how long to wait before reserving again.
+
+    Raises:
+    - StravaRateLimitError: If the call is shed.
+    """
+    max_queue_seconds = self.max_queue_seconds if max_queue_seconds is None else max_queue_seconds
+    with self._lock:
+      self._roll()
+      if self.daily_used >= self.daily_limit - self.headroom:
+        self.shed += 1
+        raise StravaRateLimitError('Strava daily rate limit reached')
+      if self.short_used < self.short_limit - self.headroom:
+        self.short_used += 1
+        self.daily_used += 1
+        return 0.0
+      wait = SHORT_WINDOW_SECONDS - time.time() % SHORT_WINDOW_SECONDS
+      if wait > max_queue_seconds:
+        self.shed += 1
+        raise StravaRateLimitError(f'Strava 15-minute rate limit reached, next window in {wait:.0f}s')
+      return wait
+
+  def acquire(self, max_queue_seconds: Optional[float] = None) -> None:
+    """Block until a call may go ahead, or raise StravaRateLimitError if it is shed."""
+    wait = self.reserve(max_queue_seconds)
+    while wait > 0:
+      time.sleep(wait)
+      wait = self.reserve(max_queue_seconds)
+
+  async def aacquire(self, max_queue_seconds: Optional[float] = None) -> None:
+    """Wait until a call may go ahead, or raise StravaRateLimitError if it is shed."""
+    wait = self.reserve(max_queue_seconds)
+    while wait > 0:
+      await asyncio.sleep(wait)
+      wait = self.reserve(max_queue_seconds)
+
+  def update(self, status: int, headers) -> None:
+    """
+    Sync the buckets with the rate limit headers of a response.
+
+    Args:
+    - status (int): The response status code.
+    - headers: The response headers.
+    """
+    limit, usage = headers.get('X-RateLimit-Limit'), headers.get('X-RateLimit-Usage')
+    with self._lock:
+      self._roll()
+      try:
+        if limit:
+          self.short_limit, self.daily_limit = (int(value) for value in limit.split(','))
+        if usage:
+          short_usage, daily_usage = (int(value) for value in usage.split(','))
+          self.short_used = max(self.short_used, short_usage)
+          self.daily_used = max(self.daily_used, daily_usage)
+      except ValueError:
+        print(f'Unexpected Strava rate limit headers: {limit!r} {usage!r}')
+      if status == 429:
+        self.short_used = self.short_limit
+
+  def stats(self) -> Dict[str, int]:
+    with self._lock:
+      return {
+        'short_used': self.short_used, 'short_limit': self.short_limit,
+        'daily_used': self.daily_used, 'daily_limit': self.daily_limit,
+        'shed': self.shed,
+      }
+
+def _build_session() -> requests.Session:
+  """
+  Build the shared keep-alive session. It doesn't retry, get does, so that every attempt
+  takes a rate limit token and stays within the caller's timeout.
+  """
+  adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0)
+  session = requests.Session()
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
+
+session = _build_session()
+scheduler = RateLimitScheduler()
+
+# aiohttp session for the async serving path, created lazily on the running event loop
+_async_session = None
+
+def _back_off(attempt: int, expires_at: Optional[float]) -> bool:
+  """
+  Sleep before retrying a failed attempt. Returns False without sleeping if the retries or the time are used up.
+  """
+  backoff = BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5)
+  if attempt == MAX_RETRIES or (expires_at is not None and time.monotonic() + backoff >= expires_at):
+    return False
+  time.sleep(backoff)
+  return True
+
+def get(path: str, access_token: str, params: Optional[Dict[str, Any]] = None,
+        headers: Optional[Dict[str, str]] = None, timeout: Optional[float] = None) -> requests.Response:
+  """
+  Make a rate-limited GET request to the Strava API over the pooled session, retrying
+  connection errors and RETRY_STATUSES with jittered exponential backoff. Read timeouts
+  aren't retried, and each attempt takes its own rate limit token.
+
+  Args:
+  - path (str): The API path, e.g. "/athletes/123/stats".
+  - access_token (str): The athlete's Strava access token.
+  - params (Optional[Dict[str, Any]]): Query parameters.
+  - headers (Optional[Dict[str, str]]): Extra request headers.
+  - timeout (Optional[float]): The timeout in seconds of the whole call, retries and queueing included.
+
+  Returns:
+  - requests.Response: The response, the last one if every attempt got a RETRY_STATUSES status.
+
+  Raises:
+  - StravaRateLimitError: If the call is shed to stay under the rate limit.
+  """
+  expires_at = None if timeout is None else time.monotonic() + timeout
+  request_headers = {'Authorization': f'Bearer {access_token}', **(headers or {})}
+
+  def remaining() -> Optional[float]:
+    # urllib3 rejects a zero timeout, an expired call still gets one short attempt
+    return None if expires_at is None else max(0.001, expires_at - time.monotonic())
+
+  for attempt in range(MAX_RETRIES + 1):
+    scheduler.acquire(max_queue_seconds=None if expires_at is None else min(remaining(), MAX_QUEUE_SECONDS))
+    try:
+      response = session.get(f'{STRAVA_API_BASE}{path}', params=params, headers=request_headers, timeout=remaining())
+    except requests.ConnectionError:
+      if not _back_off(attempt, expires_at):
+        raise
+    else:
+      scheduler.update(response.status_code, response.headers)
+      if response.status_code not in RETRY_STATUSES or not _back_off(attempt, expires_at):
+        return response
+
+def get_athlete_stats(athlete_id: str, access_token: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+  """
+  Fetch an athlete's stats.
+
+  Args:
+  - athlete_id (str): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+  - timeout (Optional[float]): The request timeout in seconds.
+
+  Returns:
+  - Dict[str, Any]: The athlete stats.
+  """
+  response = get(f'/athletes/{athlete_id}/stats', access_token, timeout=timeout)
+  response.raise_for_status()
+  return response.json()
+
+async def _get_async_session() -> aiohttp.ClientSession:
+  """
+  Get the shared aiohttp session, creating it on first use.
+
+  Returns:
+  - aiohttp.ClientSession: The session used for Strava API calls.
+  """
+  global _async_session
+  if _async_session is None or _async_session.closed:
+    _async_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=POOL_SIZE))
+  return _async_session
+
+async def aclose_session() -> None:
+  """
+  Close the shared aiohttp session. Called when the ASGI app shuts down.
+  """
+  global _async_session
+  if _async_session is not None and not _async_session.closed:
+    await _async_session.close()
+  _async_session = None
+
+async def aget(path: str, access_token: str, params: Optional[Dict[str, Any]] = None,
+               headers: Optional[Dict[str, str]] = None) -> Tuple[int, Dict[str, str], Any]:
+  """
+  Make a rate-limited GET request to the Strava API, retrying transient errors with
+  jittered exponential backoff.
+
+  Args:
+  - path (str): The API path, e.g. "/athletes/123/stats".
+  - access_token (str): The athlete's Strava access token.
+  - params (Optional[Dict[str, Any]]): Query parameters.
+  - headers (Optional[Dict[str, str]]): Extra request headers.
+
+  Returns:
+  - Tuple[int, Dict[str, str], Any]: The status, response headers and decoded JSON body (None for a 304).
+
+  Raises:
+  - StravaRateLimitError: If the call is shed to stay under the rate limit.
+  - aiohttp.ClientResponseError: If Strava returns an error status.
+  """
+  session = await _get_async_session()
+  request_headers = {'Authorization': f'Bearer {access_token}', **(headers or {})}
+  for attempt in range(MAX_RETRIES + 1):
+    await scheduler.aacquire()
+    try:
+      async with session.get(f'{STRAVA_API_BASE}{path}', params=params, headers=request_headers) as response:
+        scheduler.update(response.status, response.headers)
+        response.raise_for_status()
+        body = None if response.status == 304 else await response.json()
+        return response.status, dict(response.headers), body
+    except (aiohttp.ClientConnectionError, aiohttp.ClientResponseError) as e:
+      retryable = not isinstance(e, aiohttp.ClientResponseError) or e.status in RETRY_STATUSES
+      if attempt == MAX_RETRIES or not retryable:
+        raise
+      await asyncio.sleep(BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5))
+
+async def aget_json(path: str, access_token: str, params: Optional[Dict[str, Any]] = None) -> Any:
+  """
+  Make a rate-limited GET request to the Strava API and return the JSON body.
+
+  Args:
+  - path (str): The API path, e.g. "/athletes/123/stats".
+  - access_token (str): The athlete's Strava access token.
+  - params (Optional[Dict[str, Any]]): Query parameters.
+
+  Returns:
+  - Any: The decoded JSON body.
+  """
+  _, _, body = await aget(path, access_token, params=params)
+  return body
+
+async def aget_athlete_stats(athlete_id: str, access_token: str) -> Dict[str, Any]:
+  """
+  Asynchronously fetch an athlete's stats.
+
+  Args:
+  - athlete_id (str): The Strava athlete id.
+  - access_token (str): The athlete's Strava access token.
+
+  Returns:
+  - Dict[str, Any]: The athlete stats.
+  """
+  return await aget_json(f'/athletes/{athlete_id}/stats', access_token)
@@ -1,29 +1,226 @@
-from flask import request, jsonify
-from app.services import langchain_service
-import requests
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from langchain_core.vectorstores import VectorStoreRetriever
+from app.services import langchain_service, athlete_stats_cache, activity_store, best_efforts, batch_recommendations
+from app.utils.deadline import Deadline, arun_stage, TIER_LOCATION_ONLY, TIER_UNAVAILABLE
+from app.utils.fitness_metrics import BEST_EFFORT_DISTANCES
+from app.utils.race_prediction import predict_race_times
+from app.utils.race_scoring import athlete_profile
+from typing import Any, Dict, List, Optional
 
-ATHLETES_ENDPOINT = 'https://www.strava.com/api/v3/athletes'
+# runs the candidate branch of the recommendation graph while the request thread runs the athlete branch
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix='candidates')
 
-def get_recommendations(access_token: str, athlete_id: str, athlete_location: str):
-  athlete_stats_url = f'{ATHLETES_ENDPOINT}/{athlete_id}/stats'
-  headers = {
-      'Authorization': f'Bearer {access_token}'
-  }
+def _training_metrics(athlete_id: str):
+  """
+  Get the athlete's training metrics from their stored activities, None if there are none.
+  """
+  try:
+    return activity_store.get_athlete_metrics(athlete_id)
+  except Exception as e:
+    print(f'Error computing training metrics: {e}')
+    return None
+
+def _add_predictions(recommendations: List[Dict[str, Any]], efforts: Optional[Dict[str, Optional[float]]]) -> None:
+  """
+  Add the athlete's predicted finish time for each distance to every recommended race.
+  """
+  if not efforts or not recommendations:
+    return
+  effort_times = [float('nan') if efforts.get(name) is None else efforts[name] for name in BEST_EFFORT_DISTANCES]
+  predictions = predict_race_times(recommendations, list(BEST_EFFORT_DISTANCES.values()), effort_times)
+  for race, predicted in zip(recommendations, predictions):
+    race['Predicted Finish Times'] = predicted
 
+def _known_profile(athlete_id: str, metrics) -> Optional[Dict[str, float]]:
+  """
+  The athlete's profile from what is already known locally (stored activities or cached
+  stats), for picking the candidate query before the athlete branch has fetched anything.
+  """
+  if metrics is not None:
+    return athlete_profile(metrics=metrics)
+  cached = athlete_stats_cache.peek_athlete_stats(athlete_id)
+  return athlete_profile(recent_stats=cached.get('recent_run_totals')) if cached else None
+
+def _athlete_branch(athlete_id: str, access_token: str, metrics, deadline: Deadline) -> Dict[str, Any]:
+  """
+  The athlete side of the recommendation graph: Strava stats, stored training metrics and cached best efforts.
+  Late or failed stats degrade the response to location only; missing efforts only skip predictions,
+  and are computed in the background for the next request.
+  """
+  athlete = {'recent_stats': None, 'ytd_stats': None, 'metrics': metrics, 'efforts': None}
   try:
-    response = requests.get(athlete_stats_url, headers=headers)
+    stats = athlete_stats_cache.get_athlete_stats(athlete_id, access_token, timeout=deadline.timeout('strava'))
+    athlete['recent_stats'] = stats.get('recent_run_totals')
+    athlete['ytd_stats'] = stats.get('ytd_run_totals')
+    print(f"recent stats: {athlete['recent_stats']}\n")
+    print(f"ytd stats: {athlete['ytd_stats']}\n")
+  except Exception as e:
+    print(f'Error fetching athlete stats: {e}')
+    deadline.degrade(TIER_LOCATION_ONLY, e)
 
-    if response.status_code != 200:
-      return jsonify({'error': 'Failed to fetch athlete stats'}), response.status_code
-    
-    stats = response.json()
-    recent_run_totals = stats.get('recent_run_totals')
-    ytd_run_totals = stats.get('ytd_run_totals')
-    print(f'recent stats: {recent_run_totals}\n')
-    print(f'ytd stats: {ytd_run_totals}\n')
+  try:
+    athlete['efforts'] = best_efforts.get_athlete_best_efforts(athlete_id, access_token=access_token)
+  except Exception as e:
+    print(f'Error reading best efforts: {e}')
+  return athlete
 
-    recommendations = langchain_service.get_recommendations(location=athlete_location, recent_stats=recent_run_totals, ytd_stats=ytd_run_totals)
-    return recommendations
+async def _aathlete_branch(athlete_id: str, access_token: str, metrics, deadline: Deadline) -> Dict[str, Any]:
+  """
+  The athlete side of the recommendation graph, asynchronously. See _athlete_branch.
+  """
+  athlete = {'recent_stats': None, 'ytd_stats': None, 'metrics': metrics, 'efforts': None}
+  try:
+    stats = await arun_stage(deadline, 'strava', athlete_stats_cache.aget_athlete_stats(athlete_id, access_token))
+    athlete['recent_stats'] = stats.get('recent_run_totals')
+    athlete['ytd_stats'] = stats.get('ytd_run_totals')
+    print(f"recent stats: {athlete['recent_stats']}\n")
+    print(f"ytd stats: {athlete['ytd_stats']}\n")
   except Exception as e:
     print(f'Error fetching athlete stats: {e}')
-    return jsonify({'error': 'Internal Server Error'}), 500
\ No newline at end of file
+    deadline.degrade(TIER_LOCATION_ONLY, e)
+
+  try:
+    # reading the cache loads activity columns from disk, keep it off the event loop
+    athlete['efforts'] = await asyncio.to_thread(best_efforts.get_athlete_best_efforts, athlete_id, access_token=access_token)
+  except Exception as e:
+    print(f'Error reading best efforts: {e}')
+  return athlete
+
+def _join(athlete: Dict[str, Any], candidates: List[str], athlete_location: str, deadline: Deadline) -> Dict[str, Any]:
+  """
+  Join the two branches of the recommendation graph: score the candidates for the athlete and add predictions.
+  """
+  try:
+    recommendations = langchain_service.rank_candidates(candidates, location=athlete_location,
+                                                        recent_stats=athlete['recent_stats'], metrics=athlete['metrics'])
+  except Exception as e:
+    print(f'Error ranking recommendations: {e}')
+    deadline.degrade(TIER_UNAVAILABLE, e)
+    recommendations = []
+
+  try:
+    _add_predictions(recommendations, athlete['efforts'])
+  except Exception as e:
+    print(f'Error predicting finish times: {e}')
+  return {'recommendations': recommendations, 'tier': deadline.tier}
+
+def _batch_served(athlete_id: str, access_token: str, athlete_location: str, deadline: Deadline) -> Optional[Dict[str, Any]]:
+  """
+  Serve the athlete's recommendations from the nightly batch, None to compute them online.
+  The batch is keyed by athlete id only, so the token is checked against the athlete's stats first.
+  """
+  recommendations = batch_recommendations.get_batch_recommendations(athlete_id, athlete_location)
+  if recommendations is None:
+    return None
+  try:
+    athlete_stats_cache.get_athlete_stats(athlete_id, access_token, timeout=deadline.timeout('strava'))
+  except Exception as e:
+    print(f'Error verifying athlete for batch recommendations: {e}')
+    return None
+  try:
+    _add_predictions(recommendations, best_efforts.get_athlete_best_efforts(athlete_id, access_token=access_token))
+  except Exception as e:
+    print(f'Error predicting finish times: {e}')
+  return {'recommendations': recommendations, 'tier': deadline.tier}
+
+async def _abatch_served(athlete_id: str, access_token: str, athlete_location: str, deadline: Deadline) -> Optional[Dict[str, Any]]:
+  """
+  Serve the athlete's recommendations from the nightly batch, asynchronously. See _batch_served.
+  """
+  recommendations = batch_recommendations.get_batch_recommendations(athlete_id, athlete_location)
+  if recommendations is None:
+    return None
+  try:
+    await arun_stage(deadline, 'strava', athlete_stats_cache.aget_athlete_stats(athlete_id, access_token))
+  except Exception as e:
+    print(f'Error verifying athlete for batch recommendations: {e}')
+    return None
+  try:
+    efforts = await asyncio.to_thread(best_efforts.get_athlete_best_efforts, athlete_id, access_token=access_token)
+    _add_predictions(recommendations, efforts)
+  except Exception as e:
+    print(f'Error predicting finish times: {e}')
+  return {'recommendations': recommendations, 'tier': deadline.tier}
+
+def get_recommendations(access_token: str, athlete_id: str, athlete_location: str, deadline: Optional[Deadline] = None,
+                        retriever: Optional[VectorStoreRetriever] = None):
+  """
+  Fetch the athlete's stats from Strava and retrieve race recommendations.
+
+  The pipeline is a small dependency graph. The athlete branch (Strava stats, training
+  metrics, best efforts) and the candidate branch (races near the athlete's location) don't
+  depend on each other and run concurrently. They only meet for the final scoring, so the
+  latency is that of the slower branch rather than the sum of both.
+
+  Recommendations from the nightly batch job are served first when they are fresh and were
+  scored for the athlete's current location.
+
+  Nothing here fails the request: if the stats are late or unavailable the recommendations
+  are based on location only, and if retrieval fails the list is empty.
+
+  Args:
+  - access_token (str): The athlete's Strava access token.
+  - athlete_id (str): The Strava athlete id.
+  - athlete_location (str): The athlete's location, formatted as "City, State".
+  - deadline (Optional[Deadline]): The request deadline. Defaults to a new REQUEST_DEADLINE_SECONDS deadline.
+  - retriever (Optional[VectorStoreRetriever]): The retriever to use. Defaults to the app's retriever.
+
+  Returns:
+  - dict: The recommended races and the tier that served them.
+  """
+  deadline = deadline or Deadline()
+  batch_recommendations.remember_location(athlete_id, athlete_location)
+  served = _batch_served(athlete_id, access_token, athlete_location, deadline)
+  if served is not None:
+    return served
+  retriever = retriever or current_app.retriever
+
+  metrics = _training_metrics(athlete_id)
+  candidates_future = _executor.submit(langchain_service.get_candidates, athlete_location, retriever, deadline,
+                                       _known_profile(athlete_id, metrics))
+  athlete = _athlete_branch(athlete_id, access_token, metrics, deadline)
+  try:
+    candidates = candidates_future.result()
+  except Exception as e:
+    print(f'Error fetching candidate races: {e}')
+    deadline.degrade(TIER_UNAVAILABLE, e)
+    candidates = []
+  return _join(athlete, candidates, athlete_location, deadline)
+
+async def aget_recommendations(access_token: str, athlete_id: str, athlete_location: str, retriever, deadline: Optional[Deadline] = None):
+  """
+  Asynchronously fetch the athlete's stats from Strava and retrieve race recommendations.
+  Serves the nightly batch first, runs the same two branches concurrently and degrades like
+  get_recommendations instead of failing the request.
+
+  Args:
+  - access_token (str): The athlete's Strava access token.
+  - athlete_id (str): The Strava athlete id.
+  - athlete_location (str): The athlete's location, formatted as "City, State".
+  - retriever (VectorStoreRetriever): The retriever to use for document retrieval.
+  - deadline (Optional[Deadline]): The request deadline. Defaults to a new REQUEST_DEADLINE_SECONDS deadline.
+
+  Returns:
+  - dict: The recommended races and the tier that served them.
+  """
+  deadline = deadline or Deadline()
+  batch_recommendations.remember_location(athlete_id, athlete_location)
+  served = await _abatch_served(athlete_id, access_token, athlete_location, deadline)
+  if served is not None:
+    return served
+  metrics = _training_metrics(athlete_id)
+
+  athlete, candidates = await asyncio.gather(
+    _aathlete_branch(athlete_id, access_token, metrics, deadline),
+    langchain_service.aget_candidates(athlete_location, retriever, deadline, _known_profile(athlete_id, metrics)),
+    return_exceptions=True,
+  )
+  if isinstance(athlete, BaseException):
+    raise athlete
+  if isinstance(candidates, BaseException):
+    print(f'Error fetching candidate races: {candidates}')
+    deadline.degrade(TIER_UNAVAILABLE, candidates)
+    candidates = []
+  return _join(athlete, candidates, athlete_location, deadline)
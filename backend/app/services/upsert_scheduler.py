@@ -0,0 +1,200 @@
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+# concurrent upsert requests, adjusted between these bounds
+UPSERT_MIN_CONCURRENCY = int(os.getenv('UPSERT_MIN_CONCURRENCY', 1))
+UPSERT_MAX_CONCURRENCY = int(os.getenv('UPSERT_MAX_CONCURRENCY', 32))
+UPSERT_INITIAL_CONCURRENCY = int(os.getenv('UPSERT_INITIAL_CONCURRENCY', 4))
+# vectors per upsert request; Pinecone caps a request at 2MB, about 100 vectors of 1536 dimensions
+UPSERT_MIN_BATCH = int(os.getenv('UPSERT_MIN_BATCH', 10))
+UPSERT_MAX_BATCH = int(os.getenv('UPSERT_MAX_BATCH', 100))
+UPSERT_BATCH_STEP = int(os.getenv('UPSERT_BATCH_STEP', 10))
+# requests slower than this count as congestion, the same as an error
+UPSERT_TARGET_LATENCY_SECONDS = float(os.getenv('UPSERT_TARGET_LATENCY_SECONDS', 1.0))
+UPSERT_RETRIES = int(os.getenv('UPSERT_RETRIES', 5))
+UPSERT_RETRY_BASE_SECONDS = float(os.getenv('UPSERT_RETRY_BASE_SECONDS', 0.5))
+# errors that retrying won't fix
+PERMANENT_STATUSES = {400, 401, 403, 404, 413}
+
+def _status(error: BaseException) -> Optional[int]:
+  status = getattr(error, 'status', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+  return int(status) if status else None
+
+class UpsertScheduler:
+  """
+  Upserts records with concurrency and request size tuned by AIMD: every request that comes back
+  in time grows the window by about one request per round trip (and the request size by
+  UPSERT_BATCH_STEP), an error halves the window and a slow request halves both. Failed
+  requests are retried on their own with jittered backoff.
+
+  submit() blocks while the window is full, which holds back whatever produces the records.
+  """
+
+  def __init__(self, upsert: Callable[[List[Dict[str, Any]]], Any],
+               min_concurrency: int = UPSERT_MIN_CONCURRENCY, max_concurrency: int = UPSERT_MAX_CONCURRENCY,
+               concurrency: int = UPSERT_INITIAL_CONCURRENCY, min_batch: int = UPSERT_MIN_BATCH,
+               max_batch: int = UPSERT_MAX_BATCH, target_latency: float = UPSERT_TARGET_LATENCY_SECONDS,
+               retries: int = UPSERT_RETRIES):
+    """
+    Args:
+    - upsert (Callable[[List[Dict[str, Any]]], Any]): Upserts one request's records, e.g. pinecone_service.upsert_records.
+    - min_concurrency (int, optional): The smallest window. Defaults to UPSERT_MIN_CONCURRENCY.
+    - max_concurrency (int, optional): The largest window. Defaults to UPSERT_MAX_CONCURRENCY.
+    - concurrency (int, optional): The starting window. Defaults to UPSERT_INITIAL_CONCURRENCY.
+    - min_batch (int, optional): The smallest request. Defaults to UPSERT_MIN_BATCH.
+    - max_batch (int, optional): The largest request, also the starting size. Defaults to UPSERT_MAX_BATCH.
+    - target_latency (float, optional): The latency above which requests count as congestion. Defaults to UPSERT_TARGET_LATENCY_SECONDS.
+    - retries (int, optional): The retries per request. Defaults to UPSERT_RETRIES.
+    """
+    self.upsert = upsert
+    self.min_concurrency, self.max_concurrency = min_concurrency, max_concurrency
+    self.min_batch, self.max_batch = min_batch, max_batch
+    self.target_latency = target_latency
+    self.retries = retries
+    self.window = float(max(min_concurrency, min(concurrency, max_concurrency)))
+    self.batch_size = float(max_batch)
+    self.in_flight = 0
+    self.errors: List[BaseException] = []
+    self.counts = {'requests': 0, 'records': 0, 'retries': 0, 'slow': 0, 'decreases': 0}
+    # smoothed request latency, the round trip the window is measured in
+    self.round_trip = 0.0
+    self._last_decrease = 0.0
+    self._condition = threading.Condition()
+    self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='upsert')
+    self.started = time.perf_counter()
+
+  def submit(self, records: List[Dict[str, Any]], on_done: Optional[Callable[[], None]] = None) -> None:
+    """
+    Queue records for upserting, split into requests of the current size. Blocks until the window
+    has room for each request.
+
+    Args:
+    - records (List[Dict[str, Any]]): The records.
+    - on_done (Optional[Callable[[], None]]): Called once every record was upserted, e.g. to checkpoint them.
+
+    Raises:
+    - Exception: An earlier request's or on_done's error; no more records are accepted after one.
+    """
+    pending = {'requests': 0, 'submitted': False}
+    start = 0
+    while start < len(records):
+      with self._condition:
+        while not self.errors and self.in_flight >= int(self.window):
+          self._condition.wait()
+        if self.errors:
+          raise self.errors[0]
+        request = records[start:start + int(self.batch_size)]
+        self.in_flight += 1
+        pending['requests'] += 1
+      start += len(request)
+      self._pool.submit(self._run, request, pending, on_done)
+    with self._condition:
+      pending['submitted'] = True
+      finished = pending['requests'] == 0
+    if finished and on_done is not None:
+      on_done()
+
+  def _run(self, request: List[Dict[str, Any]], pending: Dict[str, Any], on_done: Optional[Callable[[], None]]) -> None:
+    try:
+      for attempt in range(self.retries + 1):
+        started = time.perf_counter()
+        try:
+          self.upsert(request)
+        except Exception as e:
+          # a rejected request says nothing about load, don't shrink the window for it
+          if _status(e) in PERMANENT_STATUSES:
+            raise
+          self._congested(len(request), time.perf_counter() - started)
+          if attempt == self.retries:
+            raise
+          delay = UPSERT_RETRY_BASE_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5)
+          print(f'Upsert of {len(request)} records failed ({e}), retrying in {delay:.2f}s')
+          with self._condition:
+            self.counts['retries'] += 1
+          time.sleep(delay)
+          continue
+        latency = time.perf_counter() - started
+        if latency > self.target_latency:
+          self._congested(len(request), latency, slow=True)
+        else:
+          self._grow(latency)
+        break
+    except Exception as e:
+      with self._condition:
+        self.errors.append(e)
+        self.in_flight -= 1
+        self._condition.notify_all()
+      return
+
+    with self._condition:
+      self.counts['requests'] += 1
+      self.counts['records'] += len(request)
+      pending['requests'] -= 1
+      finished = pending['submitted'] and pending['requests'] == 0
+    # still counted in flight, so close() waits for on_done and raises what it raised
+    error = None
+    if finished and on_done is not None:
+      try:
+        on_done()
+      except Exception as e:
+        error = e
+    with self._condition:
+      if error is not None:
+        self.errors.append(error)
+      self.in_flight -= 1
+      self._condition.notify_all()
+
+  def _observe(self, latency: float) -> None:
+    self.round_trip = latency if not self.round_trip else 0.8 * self.round_trip + 0.2 * latency
+
+  def _grow(self, latency: float) -> None:
+    with self._condition:
+      self._observe(latency)
+      # additive increase: one more request per window's worth of successes
+      self.window = min(self.max_concurrency, self.window + 1.0 / self.window)
+      self.batch_size = min(float(self.max_batch), self.batch_size + UPSERT_BATCH_STEP / self.window)
+      self._condition.notify_all()
+
+  def _congested(self, size: int, latency: float, slow: bool = False) -> None:
+    with self._condition:
+      self._observe(latency)
+      if slow:
+        self.counts['slow'] += 1
+      # requests sent before the last decrease report the same congestion, halve once per round trip
+      now = time.perf_counter()
+      if now - self._last_decrease < self.round_trip:
+        return
+      self._last_decrease = now
+      self.counts['decreases'] += 1
+      self.window = max(float(self.min_concurrency), self.window / 2)
+      # errors say too many requests, slow requests that each request is too large as well
+      if slow:
+        self.batch_size = max(float(self.min_batch), min(self.batch_size, size) / 2)
+
+  def close(self) -> Dict[str, Any]:
+    """
+    Wait for every queued request.
+
+    Returns:
+    - Dict[str, Any]: The requests, records, retries, slow requests and decreases, the final
+      window and request size, and records/s.
+
+    Raises:
+    - Exception: The first request that failed after its retries, or the first on_done error.
+    """
+    with self._condition:
+      while self.in_flight:
+        self._condition.wait()
+    self._pool.shutdown()
+    seconds = time.perf_counter() - self.started
+    stats = {**self.counts, 'window': round(self.window, 1), 'batch_size': int(self.batch_size),
+             'records_per_second': self.counts['records'] / seconds if seconds else 0.0}
+    print(f"Upserted {stats['records']} records in {stats['requests']} requests in {seconds:.2f}s "
+          f"({stats['records_per_second']:.0f} records/s, {stats['retries']} retries, window {stats['window']}, batch {stats['batch_size']})")
+    if self.errors:
+      raise self.errors[0]
+    return stats
@@ -0,0 +1,138 @@
+import os
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Optional
+
+# end-to-end time budget for a request
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', 10))
+# per-stage caps, each stage also gets no more than what is left of the request deadline
+STAGE_TIMEOUTS = {
+  'strava': float(os.getenv('STRAVA_TIMEOUT_SECONDS', 2)),
+  'retrieval': float(os.getenv('RETRIEVAL_TIMEOUT_SECONDS', 2)),
+  'rerank': float(os.getenv('RERANK_TIMEOUT_SECONDS', 1.5)),
+  'generation': float(os.getenv('GENERATION_TIMEOUT_SECONDS', 6)),
+}
+# threads per stage for run_stage. A call that times out keeps its thread until the client's own
+# timeout ends it, so a stage whose threads are all taken by stuck calls fails fast instead of
+# queueing behind them, and can't take threads from the other stages
+STAGE_WORKERS = {
+  'strava': int(os.getenv('STRAVA_STAGE_WORKERS', 16)),
+  'retrieval': int(os.getenv('RETRIEVAL_STAGE_WORKERS', 16)),
+  'rerank': int(os.getenv('RERANK_STAGE_WORKERS', 16)),
+  'generation': int(os.getenv('GENERATION_STAGE_WORKERS', 16)),
+}
+
+# tiers a response can be served at, from best to worst
+TIER_FULL = 'full'
+TIER_VECTOR_ORDER = 'vector_order'      # rerank was late, contexts are in vector similarity order
+TIER_LOCATION_ONLY = 'location_only'    # athlete stats were unavailable, recommendations use location only
+TIER_RACE_LIST = 'race_list'            # generation was late, the answer is a structured race list
+TIER_UNAVAILABLE = 'unavailable'        # retrieval was late, nothing could be served
+TIERS = [TIER_FULL, TIER_VECTOR_ORDER, TIER_LOCATION_ONLY, TIER_RACE_LIST, TIER_UNAVAILABLE]
+
+_executors = {stage: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'stage-{stage}')
+              for stage, workers in STAGE_WORKERS.items()}
+_slots = {stage: threading.BoundedSemaphore(workers) for stage, workers in STAGE_WORKERS.items()}
+
+class Deadline:
+  """
+  A per-request deadline passed down through the pipeline stages.
+
+  Each stage runs with a timeout of at most its cap and what is left of the deadline.
+  Stages that time out or fail fall back and record the degraded tier here, so the
+  response can be tagged with the tier that served it.
+  """
+
+  def __init__(self, seconds: float = REQUEST_DEADLINE_SECONDS):
+    self.expires_at = time.monotonic() + seconds
+    self.tier = TIER_FULL
+
+  def remaining(self) -> float:
+    return max(0.0, self.expires_at - time.monotonic())
+
+  def expired(self) -> bool:
+    return self.remaining() == 0.0
+
+  def shorten(self, other: 'Deadline') -> None:
+    """
+    Bring this deadline forward to another one's if that expires sooner, e.g. when a request
+    starts waiting on work that was started with a longer deadline.
+
+    Args:
+    - other (Deadline): The deadline to finish by.
+    """
+    self.expires_at = min(self.expires_at, other.expires_at)
+
+  def timeout(self, stage: str) -> float:
+    """
+    Get the timeout for a stage.
+
+    Args:
+    - stage (str): The stage name, a key of STAGE_TIMEOUTS.
+
+    Returns:
+    - float: The timeout in seconds.
+    """
+    return min(STAGE_TIMEOUTS[stage], self.remaining())
+
+  def degrade(self, tier: str, reason: Any = None) -> None:
+    """
+    Record that the response is served at a lower tier. The worst tier recorded wins.
+
+    Args:
+    - tier (str): The tier the response drops to.
+    - reason (Any, optional): Why, for the logs.
+    """
+    print(f'Degrading to {tier}: {reason!r}')
+    if TIERS.index(tier) > TIERS.index(self.tier):
+      self.tier = tier
+
+def _run_in_slot(stage: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+  try:
+    return fn(*args, **kwargs)
+  finally:
+    _slots[stage].release()
+
+def run_stage(deadline: Optional[Deadline], stage: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+  """
+  Run a blocking stage on the stage's own threads, giving up once its timeout has passed.
+  The call itself isn't interrupted, fn should pass a timeout of its own to its client.
+
+  Args:
+  - deadline (Optional[Deadline]): The request deadline. If None, fn runs without a timeout.
+  - stage (str): The stage name.
+  - fn (Callable[..., Any]): The stage function.
+
+  Returns:
+  - Any: The result of fn.
+
+  Raises:
+  - concurrent.futures.TimeoutError: If the stage doesn't finish in time, or all its threads are taken.
+  """
+  if deadline is None:
+    return fn(*args, **kwargs)
+  if not _slots[stage].acquire(blocking=False):
+    raise FutureTimeoutError(f'all {STAGE_WORKERS[stage]} {stage} threads are busy')
+  future = _executors[stage].submit(_run_in_slot, stage, fn, *args, **kwargs)
+  return future.result(timeout=deadline.timeout(stage))
+
+async def arun_stage(deadline: Optional[Deadline], stage: str, awaitable) -> Any:
+  """
+  Await a stage, cancelling it once its timeout has passed.
+
+  Args:
+  - deadline (Optional[Deadline]): The request deadline. If None, the stage runs without a timeout.
+  - stage (str): The stage name.
+  - awaitable: The stage coroutine.
+
+  Returns:
+  - Any: The result of the stage.
+
+  Raises:
+  - asyncio.TimeoutError: If the stage doesn't finish in time.
+  """
+  if deadline is None:
+    return await awaitable
+  return await asyncio.wait_for(awaitable, timeout=deadline.timeout(stage))
@@ -0,0 +1,221 @@
+import time
+from typing import Dict, Optional, Sequence, Union
+import numpy as np
+
+METERS_PER_MILE = 1609.344
+FEET_PER_METER = 3.28084
+SECONDS_PER_DAY = 86400
+ACUTE_DAYS = 7
+CHRONIC_DAYS = 28
+PACE_PERCENTILES = (10, 25, 50, 75, 90)
+
+ArrayLike = Union[float, Sequence[float], np.ndarray]
+
+def meters_to_miles(meters: ArrayLike) -> np.ndarray:
+  """
+  Convert distances from meters to miles.
+
+  Args:
+  - meters (ArrayLike): A distance or array of distances in meters.
+
+  Returns:
+  - np.ndarray: The distances in miles.
+  """
+  return np.asarray(meters, dtype=np.float64) / METERS_PER_MILE
+
+def meters_to_feet(meters: ArrayLike) -> np.ndarray:
+  """
+  Convert distances from meters to feet.
+
+  Args:
+  - meters (ArrayLike): A distance or array of distances in meters.
+
+  Returns:
+  - np.ndarray: The distances in feet.
+  """
+  return np.asarray(meters, dtype=np.float64) * FEET_PER_METER
+
+def pace_seconds_per_mile(distance_meters: ArrayLike, moving_time_seconds: ArrayLike) -> np.ndarray:
+  """
+  Compute paces in seconds per mile. Activities without distance get NaN instead of dividing by zero.
+
+  Args:
+  - distance_meters (ArrayLike): Distances in meters.
+  - moving_time_seconds (ArrayLike): Moving times in seconds.
+
+  Returns:
+  - np.ndarray: The paces in seconds per mile.
+  """
+  miles = meters_to_miles(distance_meters)
+  seconds = np.asarray(moving_time_seconds, dtype=np.float64)
+  return np.divide(seconds, miles, out=np.full(np.broadcast(seconds, miles).shape, np.nan), where=miles > 0)
+
+def format_pace(seconds_per_mile: float) -> str:
+  """
+  Format a pace as 'MM:SS/mile'.
+
+  Args:
+  - seconds_per_mile (float): The pace in seconds per mile.
+
+  Returns:
+  - str: The formatted pace, or 'N/A' if it is unknown.
+  """
+  if not np.isfinite(seconds_per_mile):
+    return 'N/A'
+  minutes, seconds = divmod(int(seconds_per_mile), 60)
+  return f"{minutes:02d}:{seconds:02d}/mile"
+
+def _rolling_mean(daily: np.ndarray, window: int) -> np.ndarray:
+  """Trailing rolling mean along the last axis, using a cumulative sum."""
+  padded = np.concatenate([np.zeros(daily.shape[:-1] + (window,)), daily], axis=-1)
+  totals = np.cumsum(padded, axis=-1)
+  return (totals[..., window:] - totals[..., :-window]) / window
+
+def compute_metrics(start_date: np.ndarray, distance: np.ndarray, moving_time: np.ndarray,
+                    elevation: Optional[np.ndarray] = None, athlete_index: Optional[np.ndarray] = None,
+                    n_athletes: int = 1, weeks: int = 12, now: Optional[float] = None) -> Dict[str, np.ndarray]:
+  """
+  Compute training metrics for one athlete or a batch of athletes in one vectorised pass.
+
+  Activities of all athletes are passed as flat arrays, with `athlete_index` saying which
+  athlete each belongs to. Every metric has the athletes on its first axis.
+
+  Args:
+  - start_date (np.ndarray): Activity start times in epoch seconds.
+  - distance (np.ndarray): Activity distances in meters.
+  - moving_time (np.ndarray): Activity moving times in seconds.
+  - elevation (Optional[np.ndarray]): Activity elevation gains in meters.
+  - athlete_index (Optional[np.ndarray]): The athlete (0..n_athletes-1) of each activity. Defaults to all 0.
+  - n_athletes (int, optional): The number of athletes. Defaults to 1.
+  - weeks (int, optional): How many weeks back to look. Defaults to 12.
+  - now (Optional[float]): The reference time in epoch seconds. Defaults to the current time.
+
+  Returns:
+  - Dict[str, np.ndarray]:
+    - weekly_miles (n_athletes, weeks): miles per week, oldest week first
+    - weekly_long_run_miles (n_athletes, weeks): longest run per week in miles
+    - weekly_elevation_feet (n_athletes, weeks): elevation gain per week in feet
+    - acute_load, chronic_load (n_athletes, days): trailing 7 and 28 day mean of daily moving minutes
+    - acute_chronic_ratio (n_athletes,): latest acute over chronic load
+    - pace_percentiles (n_athletes, len(PACE_PERCENTILES)): seconds per mile, NaN without runs
+    - long_run_trend (n_athletes,): weekly change of the long run in miles (least squares slope)
+    - mileage_trend (n_athletes,): weekly change of weekly mileage in miles
+  """
+  now = time.time() if now is None else now
+  n_days = weeks * 7
+  start_date = np.asarray(start_date, dtype=np.int64)
+  distance = np.asarray(distance, dtype=np.float64)
+  moving_time = np.asarray(moving_time, dtype=np.float64)
+  elevation = np.zeros_like(distance) if elevation is None else np.asarray(elevation, dtype=np.float64)
+  athlete_index = np.zeros(len(distance), dtype=np.int64) if athlete_index is None else np.asarray(athlete_index, dtype=np.int64)
+
+  # day slot of each activity, 0 = oldest day in the window, n_days - 1 = today
+  age_days = (int(now) // SECONDS_PER_DAY) - start_date // SECONDS_PER_DAY
+  in_window = (age_days >= 0) & (age_days < n_days)
+  slot = (n_days - 1 - age_days[in_window])
+  athlete = athlete_index[in_window]
+  flat = athlete * n_days + slot
+  size = n_athletes * n_days
+
+  daily_meters = np.bincount(flat, weights=distance[in_window], minlength=size).reshape(n_athletes, n_days)
+  daily_minutes = np.bincount(flat, weights=moving_time[in_window] / 60, minlength=size).reshape(n_athletes, n_days)
+  daily_elevation = np.bincount(flat, weights=elevation[in_window], minlength=size).reshape(n_athletes, n_days)
+
+  weekly_miles = meters_to_miles(daily_meters.reshape(n_athletes, weeks, 7).sum(axis=2))
+  weekly_elevation_feet = meters_to_feet(daily_elevation.reshape(n_athletes, weeks, 7).sum(axis=2))
+  weekly_long_run = np.zeros(n_athletes * weeks)
+  np.maximum.at(weekly_long_run, athlete * weeks + slot // 7, distance[in_window])
+  weekly_long_run_miles = meters_to_miles(weekly_long_run.reshape(n_athletes, weeks))
+
+  acute_load = _rolling_mean(daily_minutes, ACUTE_DAYS)
+  chronic_load = _rolling_mean(daily_minutes, CHRONIC_DAYS)
+  acute_chronic_ratio = np.divide(acute_load[:, -1], chronic_load[:, -1],
+                                  out=np.full(n_athletes, np.nan), where=chronic_load[:, -1] > 0)
+
+  # per-athlete pace percentiles: sort paces within each athlete, then index into each segment
+  paces = pace_seconds_per_mile(distance[in_window], moving_time[in_window])
+  valid = np.isfinite(paces)
+  pace_athlete, paces = athlete[valid], paces[valid]
+  order = np.lexsort((paces, pace_athlete))
+  paces = paces[order]
+  counts = np.bincount(pace_athlete, minlength=n_athletes)
+  starts = np.cumsum(counts) - counts
+  quantiles = np.asarray(PACE_PERCENTILES, dtype=np.float64) / 100
+  positions = starts[:, None] + np.rint(quantiles * np.maximum(counts - 1, 0)[:, None]).astype(np.int64)
+  has_runs = counts > 0
+  pace_percentiles = np.full((n_athletes, len(PACE_PERCENTILES)), np.nan)
+  pace_percentiles[has_runs] = paces[positions[has_runs]]
+
+  # least squares slope over the weeks, for every athlete at once
+  week_offsets = np.arange(weeks, dtype=np.float64) - (weeks - 1) / 2
+  denominator = np.sum(week_offsets ** 2)
+  long_run_trend = (weekly_long_run_miles - weekly_long_run_miles.mean(axis=1, keepdims=True)) @ week_offsets / denominator
+  mileage_trend = (weekly_miles - weekly_miles.mean(axis=1, keepdims=True)) @ week_offsets / denominator
+
+  return {
+    'weekly_miles': weekly_miles,
+    'weekly_long_run_miles': weekly_long_run_miles,
+    'weekly_elevation_feet': weekly_elevation_feet,
+    'acute_load': acute_load,
+    'chronic_load': chronic_load,
+    'acute_chronic_ratio': acute_chronic_ratio,
+    'pace_percentiles': pace_percentiles,
+    'long_run_trend': long_run_trend,
+    'mileage_trend': mileage_trend,
+  }
+
+# race distances best efforts are extracted for, in meters
+BEST_EFFORT_DISTANCES = {
+  '1 mile': METERS_PER_MILE,
+  '5K': 5000.0,
+  '10K': 10000.0,
+  'Half Marathon': 21097.5,
+}
+
+def best_efforts(streams: Sequence, targets: Sequence[float] = tuple(BEST_EFFORT_DISTANCES.values())) -> np.ndarray:
+  """
+  Find the fastest time over each target distance in a batch of activity streams.
+
+  All streams are laid end to end in one array, with a gap larger than the longest target
+  between activities, so a single cumulative distance array and one `searchsorted` call per
+  target find the end of the window starting at every sample. Windows that would run into the
+  next activity are dropped, and the time at the exact target distance is interpolated between
+  the two samples either side of it.
+
+  Args:
+  - streams (Sequence): (time, distance) pairs of per-sample arrays, in seconds and cumulative meters.
+  - targets (Sequence[float], optional): The target distances in meters. Defaults to BEST_EFFORT_DISTANCES.
+
+  Returns:
+  - np.ndarray: (len(streams), len(targets)) best times in seconds, NaN where an activity is too short.
+  """
+  targets = np.asarray(targets, dtype=np.float64)
+  results = np.full((len(streams), len(targets)), np.nan)
+  lengths = np.array([len(distance) for _, distance in streams], dtype=np.int64)
+  if not lengths.sum():
+    return results
+
+  times = np.concatenate([np.asarray(t, dtype=np.float64) for t, _ in streams])
+  distances = np.concatenate([np.asarray(d, dtype=np.float64) for _, d in streams])
+  activity = np.repeat(np.arange(len(streams)), lengths)
+  starts = np.cumsum(lengths) - lengths
+  # distance from each activity's first sample, shifted past the end of the previous activity
+  relative = distances - np.repeat(distances[np.minimum(starts, len(distances) - 1)], lengths)
+  # GPS distance can step back slightly, windows need it non-decreasing
+  distances = np.maximum.accumulate(relative + activity * (relative.max() + targets.max() + 1))
+
+  non_empty = lengths > 0
+  for k, target in enumerate(targets):
+    end = np.searchsorted(distances, distances + target, side='left')
+    valid = end < len(distances)
+    end_clipped = np.minimum(end, len(distances) - 1)
+    valid &= activity[end_clipped] == activity
+    # interpolate the time the target distance was crossed between samples end - 1 and end
+    previous = np.maximum(end_clipped - 1, 0)
+    span = distances[end_clipped] - distances[previous]
+    fraction = np.divide(distances + target - distances[previous], span, out=np.ones_like(span), where=span > 0)
+    crossing = times[previous] + fraction * (times[end_clipped] - times[previous])
+    durations = np.where(valid, crossing - times, np.inf)
+    best = np.minimum.reduceat(durations, starts[non_empty])
+    results[non_empty, k] = np.where(np.isfinite(best), best, np.nan)
+  return results
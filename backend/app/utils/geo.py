@@ -0,0 +1,96 @@
+from typing import List, Optional
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+# states whose centers are this close to the athlete's count as nearby
+NEARBY_STATES_KM = 600.0
+
+# approximate geographic centers, used as the location of every race and athlete in a state
+STATE_CENTROIDS = {
+  'AL': (32.8, -86.8), 'AK': (61.4, -152.3), 'AZ': (34.3, -111.7), 'AR': (34.9, -92.4),
+  'CA': (37.2, -119.5), 'CO': (39.0, -105.5), 'CT': (41.6, -72.7), 'DE': (39.0, -75.5),
+  'DC': (38.9, -77.0), 'FL': (28.6, -82.4), 'GA': (32.7, -83.4), 'HI': (20.8, -156.3),
+  'ID': (44.4, -114.6), 'IL': (40.0, -89.2), 'IN': (39.9, -86.3), 'IA': (42.1, -93.5),
+  'KS': (38.5, -98.4), 'KY': (37.5, -85.3), 'LA': (31.1, -92.0), 'ME': (45.4, -69.2),
+  'MD': (39.0, -76.8), 'MA': (42.3, -71.8), 'MI': (44.3, -85.4), 'MN': (46.3, -94.3),
+  'MS': (32.7, -89.7), 'MO': (38.4, -92.5), 'MT': (47.0, -109.6), 'NE': (41.5, -99.8),
+  'NV': (39.3, -116.6), 'NH': (43.7, -71.6), 'NJ': (40.2, -74.7), 'NM': (34.4, -106.1),
+  'NY': (42.9, -75.5), 'NC': (35.6, -79.4), 'ND': (47.5, -100.5), 'OH': (40.3, -82.8),
+  'OK': (35.6, -97.5), 'OR': (43.9, -120.6), 'PA': (40.9, -77.8), 'RI': (41.7, -71.6),
+  'SC': (33.9, -80.9), 'SD': (44.4, -100.2), 'TN': (35.9, -86.4), 'TX': (31.5, -99.3),
+  'UT': (39.3, -111.7), 'VT': (44.1, -72.7), 'VA': (37.5, -78.9), 'WA': (47.4, -120.5),
+  'WV': (38.6, -80.6), 'WI': (44.6, -89.9), 'WY': (43.0, -107.6),
+}
+
+STATE_NAMES = {
+  'AL': 'Alabama', 'AK': 'Alaska', 'AZ': 'Arizona', 'AR': 'Arkansas', 'CA': 'California',
+  'CO': 'Colorado', 'CT': 'Connecticut', 'DE': 'Delaware', 'DC': 'District of Columbia',
+  'FL': 'Florida', 'GA': 'Georgia', 'HI': 'Hawaii', 'ID': 'Idaho', 'IL': 'Illinois',
+  'IN': 'Indiana', 'IA': 'Iowa', 'KS': 'Kansas', 'KY': 'Kentucky', 'LA': 'Louisiana',
+  'ME': 'Maine', 'MD': 'Maryland', 'MA': 'Massachusetts', 'MI': 'Michigan', 'MN': 'Minnesota',
+  'MS': 'Mississippi', 'MO': 'Missouri', 'MT': 'Montana', 'NE': 'Nebraska', 'NV': 'Nevada',
+  'NH': 'New Hampshire', 'NJ': 'New Jersey', 'NM': 'New Mexico', 'NY': 'New York',
+  'NC': 'North Carolina', 'ND': 'North Dakota', 'OH': 'Ohio', 'OK': 'Oklahoma', 'OR': 'Oregon',
+  'PA': 'Pennsylvania', 'RI': 'Rhode Island', 'SC': 'South Carolina', 'SD': 'South Dakota',
+  'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah', 'VT': 'Vermont', 'VA': 'Virginia',
+  'WA': 'Washington', 'WV': 'West Virginia', 'WI': 'Wisconsin', 'WY': 'Wyoming',
+}
+_CODES_BY_NAME = {name.lower(): code for code, name in STATE_NAMES.items()}
+
+def state_code(location: Optional[str]) -> Optional[str]:
+  """
+  Get the two-letter state code of a "City, State" location. The state may be a code or a full name.
+
+  Args:
+  - location (Optional[str]): The location, e.g. "West Sacramento, CA" or "Boulder, Colorado".
+
+  Returns:
+  - Optional[str]: The state code, or None if the state isn't recognised.
+  """
+  if not location:
+    return None
+  state = location.rsplit(',', 1)[-1].strip()
+  if state.upper() in STATE_CENTROIDS:
+    return state.upper()
+  return _CODES_BY_NAME.get(state.lower())
+
+def centroids(codes) -> np.ndarray:
+  """
+  Look up the centroids of many states at once.
+
+  Args:
+  - codes: State codes, None for unknown states.
+
+  Returns:
+  - np.ndarray: (len(codes), 2) latitudes and longitudes, NaN for unknown states.
+  """
+  return np.array([STATE_CENTROIDS.get(code, (np.nan, np.nan)) for code in codes], dtype=np.float64).reshape(-1, 2)
+
+def haversine_km(lat1, lon1, lat2, lon2) -> np.ndarray:
+  """
+  Great-circle distances in kilometers between arrays of points.
+
+  Returns:
+  - np.ndarray: The distances, NaN where a point is unknown.
+  """
+  lat1, lon1, lat2, lon2 = (np.radians(np.asarray(value, dtype=np.float64)) for value in (lat1, lon1, lat2, lon2))
+  a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+  return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def nearby_states(code: str, radius_km: float = NEARBY_STATES_KM) -> List[str]:
+  """
+  List the states whose centers lie within a radius of a state's center, nearest first.
+
+  Args:
+  - code (str): The state code.
+  - radius_km (float, optional): The radius in kilometers. Defaults to NEARBY_STATES_KM.
+
+  Returns:
+  - List[str]: The nearby state codes, starting with the state itself.
+  """
+  codes = list(STATE_CENTROIDS)
+  coordinates = centroids(codes)
+  lat, lon = STATE_CENTROIDS[code]
+  kilometers = haversine_km(lat, lon, coordinates[:, 0], coordinates[:, 1])
+  order = np.argsort(kilometers, kind='stable')
+  return [codes[i] for i in order if kilometers[i] <= radius_km]
@@ -1,7 +1,23 @@
 from langchain_core.prompts import PromptTemplate
-from datetime import datetime
+from datetime import date, datetime
 from langchain_core.documents import Document
-from typing import List
+from typing import List, Optional
+import os
+import json
+import tiktoken
+from app.utils.race_encoding import encode_race, ENCODING_LEGEND
+from app.utils.geo import STATE_NAMES, state_code
+from app.utils.fitness_metrics import format_pace, meters_to_feet, meters_to_miles, pace_seconds_per_mile
+
+# max number of tokens of retrieved context placed in the RAG prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 1500))
+# the served models don't publish a tokenizer, cl100k is a close enough proxy for budgeting
+TOKENIZER_ENCODING = 'cl100k_base'
+CONTEXT_SEPARATOR = "\n\n"
+# months of upcoming races the canonical retrieval query asks for, starting with the current one
+RETRIEVAL_MONTH_WINDOW = int(os.getenv('RETRIEVAL_MONTH_WINDOW', 3))
+
+_tokenizer = None
 
 PROMPT_TEMPLATE = """Use the following pieces of context to answer the question at the end.
 If you don't know the answer, just say that you don't know, don't try to make up an answer.
@@ -31,52 +47,6 @@ def build_prompt() -> PromptTemplate:
   prompt = PromptTemplate.from_template(PROMPT_TEMPLATE)
   return prompt
 
-def get_recommendation_prompt(location, recent_stats, ytd_stats) -> str:
-
-  current_datetime = get_current_datetime()
-
-  # recent stats
-  recent_meters = recent_stats.get('distance')
-  recent_distance = convert_meters_to_miles(recent_meters)
-  recent_moving_time = recent_stats.get('moving_time')
-  recent_run_count = recent_stats.get('count')
-  recent_elevation_gain = round(convert_meters_to_feet(recent_stats.get('elevation_gain')), 2)
-  recent_average_pace = calculate_average_pace(recent_meters, recent_moving_time)
-
-  # ytd stats
-  ytd_meters = ytd_stats.get('distance')
-  ytd_distance = convert_meters_to_miles(ytd_meters)
-  ytd_moving_time = ytd_stats.get('moving_time')
-  ytd_run_count = ytd_stats.get('count')
-  ytd_elevation_gain = round(convert_meters_to_feet(ytd_stats.get('elevation_gain')), 2)
-  ytd_average_pace = calculate_average_pace(ytd_meters, ytd_moving_time)
-
-  prompt = f"""
-  
-  Here is the fitness data of a runner.
-  
-  The runner is located in: {location}
-  The current date and time is: {current_datetime}
-
-  **Recent Activity stats (Last 4 weeks):**
-  - Total distance ran: {recent_distance} miles
-  - Total runs: {recent_run_count}
-  - Total elevation gain: {recent_elevation_gain} ft
-  - Average pace: {recent_average_pace}
-
-  **Year-To-Date Activity stats:**
-  - Total distance ran: {ytd_distance} miles
-  - Total runs: {ytd_run_count}
-  - Total elevation gain: {ytd_elevation_gain} ft
-  - Average pace: {ytd_average_pace}
-
-  What upcoming local races would you recommend this runner participate in?
-  """
-
-  print(prompt)
-  return prompt
-
-
 def pretty_print_docs(docs: (List[Document])) -> None:
   """
   Helper function for printing Documents in a readable format.
@@ -127,6 +97,173 @@ def format_contexts(contexts: (List[str])) -> str:
   """
   return "\n\n".join(contexts)
 
+def count_tokens(text: str) -> int:
+  """
+  Count the number of tokens in a piece of text.
+
+  Args:
+  - text (str): The text to count.
+
+  Returns:
+  - int: The number of tokens.
+  """
+  global _tokenizer
+  if _tokenizer is None:
+    _tokenizer = tiktoken.get_encoding(TOKENIZER_ENCODING)
+  return len(_tokenizer.encode(text, disallowed_special=()))
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+  """
+  Count the number of tokens in many pieces of text at once.
+
+  Args:
+  - texts (List[str]): The texts to count.
+
+  Returns:
+  - List[int]: The number of tokens of each text.
+  """
+  global _tokenizer
+  if _tokenizer is None:
+    _tokenizer = tiktoken.get_encoding(TOKENIZER_ENCODING)
+  return [len(tokens) for tokens in _tokenizer.encode_batch(texts, disallowed_special=())]
+
+def _trim_race(race: dict) -> dict:
+  """
+  Drop the fields of a race record that add tokens without helping the answer.
+  Empty fields are removed, and the info link is dropped when a signup link is available.
+
+  Args:
+  - race (dict): The race record.
+
+  Returns:
+  - dict: The trimmed race record.
+  """
+  trimmed = {key: value for key, value in race.items() if value not in (None, '', [])}
+  if trimmed.get('Race Signup'):
+    trimmed.pop('Race Info', None)
+  return trimmed
+
+def log_encoding_savings(label: str, original: str, encoded: str) -> None:
+  """
+  Log the token and byte reduction achieved by encoding a payload.
+
+  Args:
+  - label (str): What the payload is used for, e.g. "rerank" or "prompt".
+  - original (str): The payload before encoding.
+  - encoded (str): The payload after encoding.
+  """
+  original_bytes, encoded_bytes = len(original.encode('utf-8')), len(encoded.encode('utf-8'))
+  original_tokens, encoded_tokens = count_tokens(original), count_tokens(encoded)
+  print(f'{label} payload: {original_tokens} -> {encoded_tokens} tokens, '
+        f'{original_bytes} -> {encoded_bytes} bytes '
+        f'({(1 - encoded_bytes / max(original_bytes, 1)) * 100:.1f}% smaller)')
+
+def pack_contexts(contexts: List[str], token_budget: int = CONTEXT_TOKEN_BUDGET, encode: bool = False) -> str:
+  """
+  Pack reranked contexts into a prompt context that fits within a token budget.
+
+  Duplicate races are removed, low-value fields are trimmed and the remaining contexts
+  are added in rank order for as long as they fit in the budget.
+
+  Args:
+  - contexts (List[str]): The reranked contexts, highest ranked first.
+  - token_budget (int, optional): The max number of context tokens. Defaults to CONTEXT_TOKEN_BUDGET.
+  - encode (bool, optional): Whether to use the compact race encoding. Defaults to False.
+
+  Returns:
+  - str: The packed context.
+  """
+  separator_tokens = count_tokens(CONTEXT_SEPARATOR)
+  packed, seen = [], set()
+  used_tokens = 0
+  if encode:
+    # the legend tells the model how to read the short keys and link ids
+    packed.append(ENCODING_LEGEND)
+    used_tokens += count_tokens(ENCODING_LEGEND)
+
+  for context in contexts:
+    try:
+      race = json.loads(context)
+    except ValueError:
+      race = None
+
+    if isinstance(race, dict):
+      key = (race.get('Race Name', '').strip().lower(), race.get('Race Date', ''))
+      trimmed = _trim_race(race)
+      text = encode_race(trimmed) if encode else json.dumps(trimmed, separators=(',', ':'), ensure_ascii=False)
+    else:
+      key = context.strip()
+      text = context.strip()
+
+    if key in seen:
+      continue
+    seen.add(key)
+
+    tokens = count_tokens(text) + (separator_tokens if packed else 0)
+    if used_tokens + tokens > token_budget:
+      continue
+    packed.append(text)
+    used_tokens += tokens
+
+  original = format_contexts(contexts)
+  packed_context = CONTEXT_SEPARATOR.join(packed)
+  print(f'Packed {len(packed) - int(encode)}/{len(contexts)} contexts into {used_tokens} tokens '
+        f'({count_tokens(original) - used_tokens} tokens saved, budget {token_budget})')
+  log_encoding_savings('prompt', original, packed_context)
+  return packed_context
+
+def format_race_list(contexts: List[str]) -> str:
+  """
+  Format contexts as a plain list of races, used when no generated answer is available.
+
+  Args:
+  - contexts (List[str]): The race contexts.
+
+  Returns:
+  - str: A markdown list with one race per line.
+  """
+  lines = []
+  for context in contexts:
+    try:
+      race = json.loads(context)
+    except ValueError:
+      continue
+    if not isinstance(race, dict):
+      continue
+    link = race.get('Race Signup') or race.get('Race Info', '')
+    lines.append(f"- **{race.get('Race Name', '')}** ({race.get('Race Date', '')}, {race.get('Location', '')}): "
+                 f"{race.get('Distances Available', '')} {link}".rstrip())
+  return "\n".join(lines)
+
+def get_canonical_retrieval_query(location: str, bucket: str, distances, today: Optional[date] = None,
+                                  months: int = RETRIEVAL_MONTH_WINDOW) -> str:
+  """
+  Build the retrieval query for race recommendations from quantised features only: region,
+  month window, fitness level and target distances. Unlike the full prompt it has no exact
+  stats or timestamp, so athletes with similar profiles send the same query and share cached
+  results for the whole month.
+
+  Args:
+  - location (str): The runner's location, formatted as "City, State".
+  - bucket (str): The runner's fitness level from race_scoring.fitness_bucket.
+  - distances: The target distances, e.g. ("10K", "Half Marathon").
+  - today (Optional[date]): The reference date. Defaults to today.
+  - months (int, optional): The number of months in the window. Defaults to RETRIEVAL_MONTH_WINDOW.
+
+  Returns:
+  - str: The canonical query.
+  """
+  code = state_code(location)
+  # the state covers the city, finer regions would split the cache for no better candidates
+  region = STATE_NAMES[code] if code else (location or '').strip().title() or 'the United States'
+  today = today or date.today()
+  window = []
+  for offset in range(max(months, 1)):
+    year, month = divmod(today.month - 1 + offset, 12)
+    window.append(date(today.year + year, month + 1, 1).strftime('%B %Y'))
+  return (f"Upcoming running races in {region} from {window[0]} to {window[-1]}. "
+          f"Distances: {', '.join(distances)}. Runner level: {bucket}.")
+
 def get_current_datetime() -> str:
   """
   Get the current date and time formatted as a string.
@@ -141,80 +278,39 @@ def get_current_datetime() -> str:
 def convert_meters_to_miles(meters: float) -> float:
   """
   Convert a distance from meters to miles, rounded to two decimal places.
+  Scalar wrapper around fitness_metrics.meters_to_miles.
 
   Args:
   - meters (float): The distance in meters that needs to be converted to miles.
 
   Returns:
   - float: The distance in miles, rounded to two decimal places.
-
-  Example:
-  >>> meters_run = 5000.0
-  >>> miles_run = meters_to_miles(meters_run)
-  >>> print(f"{meters_run} meters is approximately {miles_run} miles.")
-  5000.0 meters is approximately 3.11 miles.
   """
-  # There are 1609.344 meters in a mile
-  miles = meters / 1609.344
-  # Limit the result to two decimal places
-  miles_rounded = round(miles, 2)
-  return miles_rounded
+  return round(float(meters_to_miles(meters)), 2)
 
 def convert_meters_to_feet(meters: float) -> float:
   """
   Convert a distance from meters to feet.
+  Scalar wrapper around fitness_metrics.meters_to_feet.
 
   Args:
   - meters (float): The distance in meters that needs to be converted to feet.
 
   Returns:
   - float: The distance in feet.
-
-  Example:
-  >>> meters = 10.0
-  >>> feet = meters_to_feet(meters)
-  >>> print(f"{meters} meters is approximately {feet} feet.")
-  10.0 meters is approximately 32.81 feet.
-
-  Notes:
-  - 1 meter is equivalent to approximately 3.28084 feet.
   """
-  # Conversion factor from meters to feet
-  meters_to_feet_conversion_factor = 3.28084
-  # Convert meters to feet
-  feet = meters * meters_to_feet_conversion_factor
-  return feet
-
+  return float(meters_to_feet(meters))
 
 def calculate_average_pace(distance_meters: float, elapsed_time_seconds: float) -> str:
   """
   Calculate the average pace per mile given the elapsed time and distance covered.
+  Scalar wrapper around fitness_metrics.pace_seconds_per_mile.
 
   Args:
-  elapsed_time_seconds (float): The elapsed time in seconds.
-  distance_meters (float): The distance covered in meters.
+  - distance_meters (float): The distance covered in meters.
+  - elapsed_time_seconds (float): The elapsed time in seconds.
 
   Returns:
-  str: The average pace per mile in the format 'MM:SS' (minutes:seconds).
-
-  Example:
-  >>> elapsed_time_seconds = 1800.0
-  >>> distance_meters = 1609.344 * 3  # Assuming 3 miles
-  >>> pace = pace_per_mile(elapsed_time_seconds, distance_meters)
-  >>> print(f"The average pace per mile is: {pace}")
-  The average pace per mile is: 10:00
-
-  Notes:
-  - 1 mile is equivalent to 1609.344 meters.
-  """
-  # Convert elapsed time to minutes
-  elapsed_time_minutes = elapsed_time_seconds / 60
-  # Calculate total miles covered
-  miles_covered = convert_meters_to_miles(distance_meters)
-  # Calculate pace per mile in minutes
-  pace_per_mile_minutes = elapsed_time_minutes / miles_covered
-  # Convert pace to MM:SS format
-  pace_minutes = int(pace_per_mile_minutes)
-  pace_seconds = int((pace_per_mile_minutes - pace_minutes) * 60)
-  pace_formatted = f"{pace_minutes:02d}:{pace_seconds:02d}/mile"
-  return pace_formatted
\ No newline at end of file
+  - str: The average pace per mile in the format 'MM:SS/mile', or 'N/A' if no distance was covered.
+  """
+  return format_pace(float(pace_seconds_per_mile(distance_meters or 0, elapsed_time_seconds or 0)))
@@ -0,0 +1,115 @@
+import re
+import json
+from typing import Any, Dict, Iterable, Optional, Set
+
+# short keys used in place of the scraped field names
+FIELD_KEYS = {
+  'Race Date': 'd',
+  'Race Name': 'n',
+  'Distances Available': 'x',
+  'Location': 'l',
+  'Race Info': 'i',
+  'Race Signup': 's',
+}
+EXPANDED_KEYS = {short: field for field, short in FIELD_KEYS.items()}
+
+# link prefixes shared by every race, collapsed into an id such as L291364
+LINK_PREFIXES = {
+  'L': 'https://runningintheusa.com/redirector/listing/',
+  'D': 'https://runningintheusa.com/details/',
+}
+LINK_PATTERN = re.compile('(' + '|'.join(re.escape(prefix) for prefix in LINK_PREFIXES.values()) + r')(\d+)')
+LINK_ID_PATTERN = re.compile(r'\b([' + ''.join(LINK_PREFIXES) + r'])(\d{3,})\b')
+PREFIX_IDS = {prefix: link_id for link_id, prefix in LINK_PREFIXES.items()}
+
+ENCODING_LEGEND = (
+  "Races are encoded as JSON with keys d=date, n=name, x=distances, l=location, "
+  "i=info link, s=signup link. Links are ids such as L123 or D123; write them exactly as given."
+)
+
+def collapse_links(text: str) -> str:
+  """
+  Replace known link prefixes with their short id.
+
+  Args:
+  - text (str): The text containing full links.
+
+  Returns:
+  - str: The text with links collapsed into ids, e.g. L291364.
+  """
+  return LINK_PATTERN.sub(lambda m: PREFIX_IDS[m.group(1)] + m.group(2), text)
+
+def link_ids(texts: Iterable[str]) -> Set[str]:
+  """
+  Get the ids collapse_links gives the links in some texts, e.g. the contexts of a prompt.
+
+  Args:
+  - texts (Iterable[str]): The texts containing full links.
+
+  Returns:
+  - Set[str]: The link ids, e.g. {"L291364"}.
+  """
+  return {PREFIX_IDS[m.group(1)] + m.group(2) for text in texts for m in LINK_PATTERN.finditer(text)}
+
+def expand_links(text: str, known: Optional[Set[str]] = None) -> str:
+  """
+  Expand link ids back into full links, e.g. after generation.
+
+  Args:
+  - text (str): The text containing link ids.
+  - known (Optional[Set[str]]): Only expand these ids, e.g. the link_ids of the prompt's contexts,
+    so an answer's other tokens that look like ids (say "L100") are left alone. Defaults to every id.
+
+  Returns:
+  - str: The text with ids expanded into full links.
+  """
+  def expand(m: re.Match) -> str:
+    if known is not None and m.group(0) not in known:
+      return m.group(0)
+    return LINK_PREFIXES[m.group(1)] + m.group(2)
+
+  return LINK_ID_PATTERN.sub(expand, text)
+
+def encode_race(race: Dict[str, Any]) -> str:
+  """
+  Encode a race record compactly, with short keys and collapsed links.
+
+  Args:
+  - race (Dict[str, Any]): The race record.
+
+  Returns:
+  - str: The compact encoding of the race.
+  """
+  compact = {FIELD_KEYS.get(field, field): value for field, value in race.items()}
+  return collapse_links(json.dumps(compact, separators=(',', ':'), ensure_ascii=False))
+
+def encode_context(context: str) -> str:
+  """
+  Encode a raw JSON race context compactly. Contexts that aren't race records are returned as is.
+
+  Args:
+  - context (str): The raw context.
+
+  Returns:
+  - str: The compact encoding of the context.
+  """
+  try:
+    race = json.loads(context)
+  except ValueError:
+    return context
+  if not isinstance(race, dict):
+    return context
+  return encode_race(race)
+
+def decode_race(encoded: str) -> Dict[str, Any]:
+  """
+  Decode a compactly encoded race back into a race record.
+
+  Args:
+  - encoded (str): The compact encoding of the race.
+
+  Returns:
+  - Dict[str, Any]: The race record with full field names and links.
+  """
+  compact = json.loads(expand_links(encoded))
+  return {EXPANDED_KEYS.get(key, key): value for key, value in compact.items()}
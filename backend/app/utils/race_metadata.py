@@ -0,0 +1,223 @@
+import re
+import json
+from datetime import date
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from app.utils.geo import STATE_CENTROIDS, state_code
+
+try:
+  import orjson
+  _loads = orjson.loads
+except ImportError:
+  orjson = None
+  _loads = json.loads
+
+# "Saturday - May 4, 2024", the month may be spelled out or abbreviated
+DATE_PATTERN = re.compile(r'^(?:[A-Za-z]+\s*-\s*)?([A-Za-z]+)\.?\s+(\d{1,2}),\s*(\d{4})$')
+# same distances pinecone_service has always stored, e.g. "13.1M" or "50 K"
+DISTANCE_PATTERN = re.compile(r'\d+\.?\d*\s*(?:M|K)')
+UNDATED_PATTERN = re.compile(r'Tentative|TBD|Unknown Year')
+MONTHS = {name: i + 1 for i, name in enumerate((
+  'january', 'february', 'march', 'april', 'may', 'june',
+  'july', 'august', 'september', 'october', 'november', 'december',
+))}
+MONTHS.update({name[:3]: month for name, month in MONTHS.items()})
+MONTHS['sept'] = 9
+
+# date_status values
+DATED, TENTATIVE, CANCELLED, MALFORMED, PAST = 0, 1, 2, 3, 4
+# month and year stored for races without a date, the retriever filters on these
+UNDATED_LABELS = {TENTATIVE: 'Tentative', CANCELLED: 'Cancelled', MALFORMED: 'Tentative', PAST: 'Past Date'}
+# months of races that won't take place, the retriever leaves them out
+UNSCHEDULED_MONTHS = [UNDATED_LABELS[CANCELLED], UNDATED_LABELS[PAST]]
+# city and state stored when the location isn't "City, State", e.g. races with a separate start and finish
+MALFORMED_CITY, MALFORMED_STATE = 'check', 'details'
+STATE_CODES = tuple(sorted(STATE_CENTROIDS))
+_STATE_INDEX = {code: i for i, code in enumerate(STATE_CODES)}
+
+def _decode(texts: Sequence[str]) -> List[Optional[dict]]:
+  """
+  Decode every text as a JSON object, in a single decoder call when they are all well formed.
+  """
+  try:
+    decoded = _loads('[' + ','.join(texts) + ']')
+    if len(decoded) == len(texts):
+      return [race if isinstance(race, dict) else None for race in decoded]
+  except ValueError:
+    pass
+  # a malformed text (or one holding several values) poisons the joined array, decode one by one
+  races = []
+  for text in texts:
+    try:
+      race = _loads(text)
+    except ValueError:
+      race = None
+    races.append(race if isinstance(race, dict) else None)
+  return races
+
+def _parse_date(race_date: str) -> Tuple[int, Optional[str], Optional[str], int]:
+  """
+  Parse one "Race Date" into its status, month and year as written and date.toordinal().
+  """
+  if 'Cancelled' in race_date:
+    return CANCELLED, None, None, 0
+  if 'Past Date' in race_date:
+    return PAST, None, None, 0
+  if UNDATED_PATTERN.search(race_date):
+    return TENTATIVE, None, None, 0
+  match = DATE_PATTERN.match(race_date.strip())
+  month = MONTHS.get(match.group(1).lower()) if match else None
+  if month is None:
+    return MALFORMED, None, None, 0
+  try:
+    ordinal = date(int(match.group(3)), month, int(match.group(2))).toordinal()
+  except ValueError:
+    # "February 30" and the like parse but don't exist
+    return MALFORMED, None, None, 0
+  return DATED, match.group(1), match.group(3), ordinal
+
+def parse_dates(race_dates: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+  """
+  Parse race dates like "Saturday - May 4, 2024" into their status and date, each distinct value once.
+
+  Args:
+  - race_dates (Sequence[str]): The "Race Date" values.
+
+  Returns:
+  - Tuple[np.ndarray, np.ndarray]: The date_status (uint8) and the datetime64[D] date (NaT unless DATED) of every race.
+  """
+  parsed = {}
+  statuses, ordinals = [], []
+  for race_date in race_dates:
+    race_date = race_date or ''
+    if race_date not in parsed:
+      status, _, _, ordinal = _parse_date(race_date)
+      parsed[race_date] = (status, ordinal)
+    status, ordinal = parsed[race_date]
+    statuses.append(status)
+    ordinals.append(ordinal)
+  statuses = np.array(statuses, dtype=np.uint8)
+  # date.toordinal() counts from 0001-01-01 as day 1
+  days = np.datetime64('0001-01-01', 'D') + (np.array(ordinals, dtype=np.int64) - 1)
+  return statuses, np.where(statuses == DATED, days, np.datetime64('NaT', 'D'))
+
+def _parse_location(location: str) -> Tuple[str, str, int]:
+  """
+  Split one "Location" into its city, state and index into STATE_CODES.
+  """
+  city, _, state = location.rpartition(', ')
+  if not city or not state:
+    return MALFORMED_CITY, MALFORMED_STATE, -1
+  code = state_code(state)
+  return city, state, _STATE_INDEX[code] if code is not None else -1
+
+def extract_metadata(texts: Sequence[str]) -> Dict[str, Any]:
+  """
+  Extract the index metadata of a batch of race chunks in one pass, as columns.
+
+  A corpus repeats the same few hundred dates, locations and distance lists, so each distinct
+  value is parsed once. Dates are DATED, TENTATIVE (Tentative, TBD or Unknown Year), PAST,
+  CANCELLED or MALFORMED (not JSON, or a date that doesn't parse). Locations that aren't
+  "City, State" keep the MALFORMED_CITY and MALFORMED_STATE placeholders; with more than one
+  comma the last part is the state.
+
+  Args:
+  - texts (Sequence[str]): The chunk texts, one JSON race each.
+
+  Returns:
+  - Dict[str, Any]: Per chunk: date_status (uint8), date_ordinals (int32, 0 if undated),
+    state_codes (int8 index into STATE_CODES, -1 if unknown) and distance_masks (uint8 bits packed
+    over distance_labels), plus the city, state, month, year and distances stored in the index.
+  """
+  texts = list(texts)
+  dates, locations, distance_lists = {}, {}, {}
+  label_index = {}
+  parsed_dates, parsed_locations, parsed_distances = [], [], []
+  malformed = (MALFORMED, None, None, 0)
+  no_location = (MALFORMED_CITY, MALFORMED_STATE, -1)
+
+  for race in _decode(texts):
+    if race is None:
+      parsed_dates.append(malformed)
+      parsed_locations.append(no_location)
+      parsed_distances.append(())
+      continue
+
+    race_date = race.get('Race Date') or ''
+    parsed = dates.get(race_date)
+    if parsed is None:
+      parsed = dates[race_date] = _parse_date(race_date)
+    parsed_dates.append(parsed)
+
+    location = race.get('Location') or ''
+    parsed = locations.get(location)
+    if parsed is None:
+      parsed = locations[location] = _parse_location(location)
+    parsed_locations.append(parsed)
+
+    available = race.get('Distances Available') or ''
+    parsed = distance_lists.get(available)
+    if parsed is None:
+      parsed = distance_lists[available] = tuple(dict.fromkeys(DISTANCE_PATTERN.findall(available)))
+      for label in parsed:
+        label_index.setdefault(label, len(label_index))
+    parsed_distances.append(parsed)
+
+  n = len(texts)
+  status, month_names, years, date_ordinals = zip(*parsed_dates) if n else ((), (), (), ())
+  cities, states, state_codes = zip(*parsed_locations) if n else ((), (), ())
+  status = np.array(status, dtype=np.uint8)
+
+  counts = np.fromiter((len(found) for found in parsed_distances), dtype=np.int64, count=n)
+  columns = np.fromiter((label_index[label] for found in parsed_distances for label in found), dtype=np.int64, count=int(counts.sum()))
+  bits = np.zeros((n, len(label_index)), dtype=bool)
+  bits[np.repeat(np.arange(n), counts), columns] = True
+
+  return {
+    'date_status': status,
+    'date_ordinals': np.array(date_ordinals, dtype=np.int32),
+    'state_codes': np.array(state_codes, dtype=np.int8),
+    'distance_masks': np.packbits(bits, axis=1),
+    'distance_labels': list(label_index),
+    'city': list(cities),
+    'state': list(states),
+    'month': [month or UNDATED_LABELS[code] for month, code in zip(month_names, status.tolist())],
+    'year': [year or UNDATED_LABELS[code] for year, code in zip(years, status.tolist())],
+    'distances': [list(found) for found in parsed_distances],
+  }
+
+def has_distance(columns: Dict[str, Any], label: str) -> np.ndarray:
+  """
+  Find the chunks offering a distance from their bitmasks.
+
+  Args:
+  - columns (Dict[str, Any]): The output of extract_metadata.
+  - label (str): The distance label, e.g. "13.1M".
+
+  Returns:
+  - np.ndarray: A boolean per chunk.
+  """
+  masks = columns['distance_masks']
+  if label not in columns['distance_labels']:
+    return np.zeros(len(masks), dtype=bool)
+  bit = columns['distance_labels'].index(label)
+  return (masks[:, bit // 8] & (0x80 >> (bit % 8))) != 0
+
+def metadata_records(columns: Dict[str, Any], texts: Sequence[str], base: Optional[Sequence[Dict[str, Any]]] = None) -> List[Dict[str, Any]]:
+  """
+  Turn extracted columns into the metadata dict stored with each vector.
+
+  Args:
+  - columns (Dict[str, Any]): The output of extract_metadata.
+  - texts (Sequence[str]): The chunk texts, stored as the text field.
+  - base (Optional[Sequence[Dict[str, Any]]]): Metadata to start from per chunk, e.g. the source.
+
+  Returns:
+  - List[Dict[str, Any]]: The metadata of every chunk.
+  """
+  base = base if base is not None else [{}] * len(texts)
+  return [
+    {**extra, 'city': city, 'state': state, 'distances': found, 'text': text, 'month': month, 'year': year}
+    for extra, text, city, state, found, month, year in zip(
+      base, texts, columns['city'], columns['state'], columns['distances'], columns['month'], columns['year'])
+  ]
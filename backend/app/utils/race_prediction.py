@@ -0,0 +1,126 @@
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from app.utils.fitness_metrics import METERS_PER_MILE
+
+# same pattern race_metadata uses for the stored distances, with the number and unit captured
+DISTANCE_PATTERN = re.compile(r'(\d+\.?\d*)\s*(M|K)')
+UNIT_METERS = {'M': METERS_PER_MILE, 'K': 1000.0}
+# Riegel's fatigue exponent, used when an athlete's efforts don't allow fitting their own
+RIEGEL_EXPONENT = 1.06
+# fitted exponents outside this range come from noisy efforts, not from the athlete
+EXPONENT_BOUNDS = (1.01, 1.15)
+
+def parse_distances(distances_available: Sequence[str]) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+  """
+  Parse the distances of a batch of races into meters.
+
+  Args:
+  - distances_available (Sequence[str]): Each race's "Distances Available" text, e.g. "13.1M, 10K, 5K run".
+
+  Returns:
+  - Tuple[np.ndarray, np.ndarray, List[str]]: Flat arrays with the race index and distance in meters
+    of every (race, distance) pair, and the distance labels ("13.1M", "10K", ...).
+  """
+  matches = [list(dict.fromkeys(DISTANCE_PATTERN.findall(text or ''))) for text in distances_available]
+  counts = np.fromiter((len(found) for found in matches), dtype=np.int64, count=len(matches))
+  pairs = [pair for found in matches for pair in found]
+  values = np.array([value for value, _ in pairs], dtype=np.float64)
+  unit_meters = np.array([UNIT_METERS[unit] for _, unit in pairs], dtype=np.float64)
+  labels = [f'{value}{unit}' for value, unit in pairs]
+  return np.repeat(np.arange(len(matches)), counts), values * unit_meters, labels
+
+def fit_exponents(effort_distances: Sequence[float], effort_times: np.ndarray) -> np.ndarray:
+  """
+  Fit each athlete's fatigue exponent b in t = a * d^b by least squares on log time against log distance.
+
+  Args:
+  - effort_distances (Sequence[float]): The effort distances in meters.
+  - effort_times (np.ndarray): (n_athletes, len(effort_distances)) best times in seconds, NaN where unknown.
+
+  Returns:
+  - np.ndarray: (n_athletes,) exponents, RIEGEL_EXPONENT for athletes with fewer than two efforts.
+  """
+  effort_times = np.atleast_2d(np.asarray(effort_times, dtype=np.float64))
+  known = np.isfinite(effort_times)
+  n = known.sum(axis=1)
+  x = np.where(known, np.log(np.asarray(effort_distances, dtype=np.float64)), 0.0)
+  y = np.where(known, np.log(np.where(known, effort_times, 1.0)), 0.0)
+  x_mean = np.divide(x.sum(axis=1), n, out=np.zeros(len(n)), where=n > 0)
+  y_mean = np.divide(y.sum(axis=1), n, out=np.zeros(len(n)), where=n > 0)
+  dx = np.where(known, x - x_mean[:, None], 0.0)
+  dy = np.where(known, y - y_mean[:, None], 0.0)
+  variance = (dx ** 2).sum(axis=1)
+  slope = np.divide((dx * dy).sum(axis=1), variance, out=np.full(len(n), RIEGEL_EXPONENT), where=(n >= 2) & (variance > 0))
+  return np.clip(slope, *EXPONENT_BOUNDS)
+
+def predict_times(distances: np.ndarray, effort_distances: Sequence[float], effort_times: Sequence[float],
+                  exponent: Optional[float] = None) -> np.ndarray:
+  """
+  Predict finish times for many distances at once from one athlete's best efforts.
+
+  Each distance is predicted from the known effort closest to it (in log distance), scaled
+  with t2 = t1 * (d2 / d1) ^ b.
+
+  Args:
+  - distances (np.ndarray): The distances to predict, in meters.
+  - effort_distances (Sequence[float]): The effort distances in meters.
+  - effort_times (Sequence[float]): The best times in seconds, NaN where unknown.
+  - exponent (Optional[float]): The fatigue exponent. Defaults to one fitted from the efforts.
+
+  Returns:
+  - np.ndarray: The predicted times in seconds, NaN if the athlete has no efforts.
+  """
+  distances = np.asarray(distances, dtype=np.float64)
+  effort_distances = np.asarray(effort_distances, dtype=np.float64)
+  effort_times = np.asarray(effort_times, dtype=np.float64)
+  known = np.isfinite(effort_times)
+  if not known.any() or distances.size == 0:
+    return np.full(distances.shape, np.nan)
+  if exponent is None:
+    exponent = float(fit_exponents(effort_distances, effort_times)[0])
+
+  reference_distances, reference_times = effort_distances[known], effort_times[known]
+  gaps = np.abs(np.log(distances)[:, None] - np.log(reference_distances)[None, :])
+  nearest = gaps.argmin(axis=1)
+  return reference_times[nearest] * (distances / reference_distances[nearest]) ** exponent
+
+def format_duration(seconds: float) -> Optional[str]:
+  """
+  Format a duration as 'H:MM:SS', or 'MM:SS' under an hour.
+
+  Args:
+  - seconds (float): The duration in seconds.
+
+  Returns:
+  - Optional[str]: The formatted duration, None if it is unknown.
+  """
+  if not np.isfinite(seconds):
+    return None
+  hours, remainder = divmod(int(round(seconds)), 3600)
+  minutes, seconds = divmod(remainder, 60)
+  return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes:02d}:{seconds:02d}'
+
+def predict_race_times(races: List[Dict[str, Any]], effort_distances: Sequence[float],
+                       effort_times: Sequence[float]) -> List[Dict[str, str]]:
+  """
+  Predict the athlete's finish time for every distance of every race in one vectorised call.
+
+  Args:
+  - races (List[Dict[str, Any]]): The race records.
+  - effort_distances (Sequence[float]): The athlete's effort distances in meters.
+  - effort_times (Sequence[float]): The athlete's best times in seconds, NaN where unknown.
+
+  Returns:
+  - List[Dict[str, str]]: Per race, the predicted finish time per distance label, e.g. {"10K": "48:10"}.
+  """
+  if not races:
+    return []
+  race_index, distances, labels = parse_distances([race.get('Distances Available', '') for race in races])
+  predictions = predict_times(distances, effort_distances, effort_times)
+  formatted = [format_duration(seconds) for seconds in predictions.tolist()]
+  boundaries = np.searchsorted(race_index, np.arange(1, len(races)))
+  label_groups = np.split(np.array(labels, dtype=object), boundaries)
+  time_groups = np.split(np.array(formatted, dtype=object), boundaries)
+  return [{label: time for label, time in zip(group_labels, group_times) if time is not None}
+          for group_labels, group_times in zip(label_groups, time_groups)]
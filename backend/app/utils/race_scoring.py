@@ -0,0 +1,263 @@
+from datetime import date
+from typing import Any, Dict, List, Optional
+import numpy as np
+from app.utils.fitness_metrics import meters_to_feet, meters_to_miles
+from app.utils.geo import centroids, haversine_km, state_code
+from app.utils.race_metadata import DATED, TENTATIVE, parse_dates
+from app.utils.race_prediction import parse_distances
+
+# how much each component counts towards the suitability score, they sum to 1
+SCORE_WEIGHTS = {'distance': 0.35, 'build_up': 0.25, 'geo': 0.3, 'terrain': 0.1}
+# width of the distance fit around the athlete's comfortable distance, in log miles
+DISTANCE_FIT_WIDTH = 0.6
+# the long run can safely grow by about a mile a week, plus a taper before race day
+LONG_RUN_GROWTH_MILES_PER_WEEK = 1.0
+TAPER_WEEKS = 2.0
+# races further out than this start losing points, plans rarely look that far ahead
+PLANNING_HORIZON_WEEKS = 26.0
+# the geo score halves about every 175 km
+GEO_SCALE_KM = 250.0
+# elevation gain per mile at which a runner counts as fully trail-ready
+HILLY_FEET_PER_MILE = 100.0
+# share of weekly volume a typical long run takes, used when only Strava totals are known
+LONG_RUN_SHARE = 0.3
+SHORTEST_RACE_MILES = 3.1
+# coarse fitness levels by weekly miles, the retrieval query only carries the level so it stays cacheable
+FITNESS_BUCKETS = ((10.0, 'beginner'), (25.0, 'intermediate'), (45.0, 'advanced'), (float('inf'), 'high mileage'))
+TARGET_DISTANCES = {
+  'unknown': ('5K', '10K', 'Half Marathon'),
+  'beginner': ('5K', '10K'),
+  'intermediate': ('10K', 'Half Marathon'),
+  'advanced': ('Half Marathon', 'Marathon'),
+  'high mileage': ('Marathon', 'Ultra'),
+}
+
+def athlete_profiles(metrics: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+  """
+  Summarise the current training of a batch of athletes from their stored activities.
+
+  Args:
+  - metrics (Dict[str, np.ndarray]): The athletes' metrics from fitness_metrics.compute_metrics.
+
+  Returns:
+  - Dict[str, np.ndarray]: (n_athletes,) weekly_miles, long_run_miles and elevation_per_mile.
+  """
+  total_miles = metrics['weekly_miles'].sum(axis=1)
+  total_feet = metrics['weekly_elevation_feet'].sum(axis=1)
+  return {
+    'weekly_miles': metrics['weekly_miles'][:, -4:].mean(axis=1),
+    'long_run_miles': metrics['weekly_long_run_miles'][:, -4:].max(axis=1),
+    'elevation_per_mile': np.divide(total_feet, total_miles, out=np.zeros(len(total_miles)), where=total_miles > 0),
+  }
+
+def athlete_profile(recent_stats: Optional[Dict[str, Any]] = None, metrics: Optional[Dict[str, np.ndarray]] = None) -> Optional[Dict[str, float]]:
+  """
+  Summarise an athlete's current training for scoring, from their stored activities when
+  available and otherwise from their recent (last 4 weeks) Strava totals.
+
+  Args:
+  - recent_stats (Optional[Dict[str, Any]]): The athlete's recent run totals.
+  - metrics (Optional[Dict[str, np.ndarray]]): The athlete's metrics from fitness_metrics.compute_metrics.
+
+  Returns:
+  - Optional[Dict[str, float]]: weekly_miles, long_run_miles and elevation_per_mile, None if nothing is known.
+  """
+  if metrics is not None:
+    return {name: float(values[0]) for name, values in athlete_profiles(metrics).items()}
+  if not recent_stats:
+    return None
+  recent_miles = float(meters_to_miles(recent_stats.get('distance') or 0))
+  weekly_miles = recent_miles / 4
+  long_run_miles = weekly_miles * LONG_RUN_SHARE
+  elevation_feet = float(meters_to_feet(recent_stats.get('elevation_gain') or 0))
+  elevation_per_mile = elevation_feet / recent_miles if recent_miles else 0.0
+  return {'weekly_miles': weekly_miles, 'long_run_miles': long_run_miles, 'elevation_per_mile': elevation_per_mile}
+
+def fitness_bucket(profile: Optional[Dict[str, float]]) -> str:
+  """
+  Quantise an athlete's profile into one of the FITNESS_BUCKETS levels.
+
+  Args:
+  - profile (Optional[Dict[str, float]]): The athlete's profile from athlete_profile.
+
+  Returns:
+  - str: The fitness level, "unknown" without a profile.
+  """
+  if profile is None:
+    return 'unknown'
+  for upper_miles, bucket in FITNESS_BUCKETS:
+    if profile['weekly_miles'] < upper_miles:
+      return bucket
+  return FITNESS_BUCKETS[-1][1]
+
+def prepare_races(races: List[Dict[str, Any]], today: Optional[date] = None) -> Dict[str, Any]:
+  """
+  Parse a race catalogue into the arrays score_matrix works on. Duplicate races, cancelled races,
+  races in the past ("Past Date" or dated before today) and races whose date doesn't parse are
+  dropped; only tentative races (Tentative, TBD, Unknown Year) are kept without a date.
+
+  Args:
+  - races (List[Dict[str, Any]]): The race records.
+  - today (Optional[date]): The reference date. Defaults to today.
+
+  Returns:
+  - Dict[str, Any]: The unique upcoming races and, per race, weeks_to_race (NaN if undated), undated,
+    coordinates and is_trail, plus (n_races, max distances) miles (NaN padded) and
+    pairs, the index of each distance label (-1 padded).
+  """
+  # the index holds some races more than once
+  unique = {}
+  for race in races:
+    unique.setdefault((race.get('Race Name', '').strip().lower(), race.get('Race Date', '')), race)
+  races = list(unique.values())
+  today = np.datetime64(today or date.today(), 'D')
+  statuses, race_dates = parse_dates([race.get('Race Date', '') for race in races])
+  with np.errstate(invalid='ignore'):
+    keep = (statuses == TENTATIVE) | ((statuses == DATED) & (race_dates >= today))
+  races = [race for race, kept in zip(races, keep.tolist()) if kept]
+  race_dates = race_dates[keep]
+  undated = statuses[keep] == TENTATIVE
+  n = len(races)
+
+  weeks_to_race = np.where(undated, np.nan, (race_dates - today).astype(np.float64) / 7)
+  race_index, meters, labels = parse_distances([race.get('Distances Available', '') for race in races])
+
+  # pad the (race, distance) pairs into one row per race so every athlete can be scored at once
+  counts = np.bincount(race_index, minlength=n)
+  width = max(int(counts.max()) if n else 0, 1)
+  starts = np.cumsum(counts) - counts
+  slots = np.arange(len(race_index)) - starts[race_index]
+  pairs = np.full((n, width), -1)
+  pairs[race_index, slots] = np.arange(len(race_index))
+  miles = np.full((n, width), np.nan)
+  miles[race_index, slots] = meters_to_miles(meters)
+
+  return {
+    'races': races,
+    'weeks_to_race': weeks_to_race,
+    'undated': undated,
+    'miles': miles,
+    'pairs': pairs,
+    'labels': labels,
+    'coordinates': centroids([state_code(race.get('Location')) for race in races]),
+    'is_trail': np.array(['trail' in (race.get('Distances Available') or '').lower() for race in races], dtype=bool),
+  }
+
+def score_matrix(catalogue: Dict[str, Any], profiles: Dict[str, np.ndarray], locations: List[Optional[str]]) -> Dict[str, np.ndarray]:
+  """
+  Score every race in a catalogue for a batch of athletes at once.
+
+  Args:
+  - catalogue (Dict[str, Any]): The races from prepare_races.
+  - profiles (Dict[str, np.ndarray]): (n_athletes,) weekly_miles, long_run_miles and elevation_per_mile,
+    NaN for athletes without a profile.
+  - locations (List[Optional[str]]): Each athlete's location, "City, State".
+
+  Returns:
+  - Dict[str, np.ndarray]: (n_athletes, n_races) matrices: the distance, build_up, geo and terrain
+    components, the score, best_pair (the label index of each race's best
+    distance, -1 if none) and km_away (NaN if unknown).
+  """
+  long_run = np.asarray(profiles['long_run_miles'], dtype=np.float64)
+  has_profile = ~np.isnan(long_run)
+  miles = catalogue['miles'][None, :, :]
+  valid = ~np.isnan(miles)
+
+  comfortable = np.maximum(np.where(has_profile, long_run * 1.2, SHORTEST_RACE_MILES), SHORTEST_RACE_MILES)[:, None, None]
+  with np.errstate(invalid='ignore'):
+    distance_fit = np.where(has_profile[:, None, None], np.exp(-0.5 * (np.log(miles / comfortable) / DISTANCE_FIT_WIDTH) ** 2), 1.0)
+    needed_weeks = np.where(has_profile[:, None, None], np.maximum(miles - comfortable, 0) / LONG_RUN_GROWTH_MILES_PER_WEEK + TAPER_WEEKS, TAPER_WEEKS)
+    pair_weeks = catalogue['weeks_to_race'][None, :, None]
+    build_up = np.clip(pair_weeks / needed_weeks, 0, 1) * np.exp(-np.maximum(pair_weeks - PLANNING_HORIZON_WEEKS, 0) / PLANNING_HORIZON_WEEKS)
+  # tentative dates can't be planned for, they get half the build-up points
+  build_up = np.where(np.isnan(pair_weeks), 0.5, build_up)
+
+  # keep each race's best distance, races without a parsed distance get no distance or build-up points
+  pair_score = np.where(valid, SCORE_WEIGHTS['distance'] * distance_fit + SCORE_WEIGHTS['build_up'] * build_up, -np.inf)
+  best = pair_score.argmax(axis=2)[:, :, None]
+  has_distance = valid[:, :, 0]
+  best_distance_fit = np.where(has_distance, np.take_along_axis(distance_fit, best, axis=2)[:, :, 0], 0.0)
+  best_build_up = np.where(has_distance, np.take_along_axis(build_up, best, axis=2)[:, :, 0], 0.0)
+  best_pair = np.where(has_distance, catalogue['pairs'][np.arange(miles.shape[1])[None, :], best[:, :, 0]], -1)
+
+  athletes = centroids([state_code(location) for location in locations])
+  race_coordinates = catalogue['coordinates']
+  kilometers = haversine_km(athletes[:, :1], athletes[:, 1:], race_coordinates[None, :, 0], race_coordinates[None, :, 1])
+  geo = np.where(np.isnan(kilometers), 0.0, np.exp(-np.nan_to_num(kilometers) / GEO_SCALE_KM))
+
+  hilliness = np.where(has_profile, np.minimum(np.nan_to_num(np.asarray(profiles['elevation_per_mile'], dtype=np.float64)) / HILLY_FEET_PER_MILE, 1.0), 0.5)[:, None]
+  terrain = np.where(catalogue['is_trail'][None, :], hilliness, 1.0 - 0.3 * hilliness)
+
+  components = {'distance': best_distance_fit, 'build_up': best_build_up, 'geo': geo, 'terrain': terrain}
+  scores = sum(SCORE_WEIGHTS[name] * values for name, values in components.items())
+  return {**components, 'score': scores, 'best_pair': best_pair, 'km_away': kilometers}
+
+def profile_arrays(profiles: List[Optional[Dict[str, float]]]) -> Dict[str, np.ndarray]:
+  """
+  Stack athlete_profile results into the arrays score_matrix takes, NaN for missing profiles.
+  """
+  return {name: np.array([np.nan if profile is None else profile[name] for profile in profiles], dtype=np.float64)
+          for name in ('weekly_miles', 'long_run_miles', 'elevation_per_mile')}
+
+def suitability(catalogue: Dict[str, Any], scored: Dict[str, np.ndarray], i: int) -> Dict[str, Any]:
+  """
+  Build the "Suitability" score breakdown of race i from one athlete's row of score_matrix.
+  """
+  breakdown = {name: round(float(scored[name][i]), 3) for name in SCORE_WEIGHTS}
+  breakdown['score'] = round(float(scored['score'][i]), 3)
+  best_pair = int(scored['best_pair'][i])
+  breakdown['best_distance'] = str(catalogue['labels'][best_pair]) if best_pair >= 0 else None
+  breakdown['weeks_to_race'] = None if catalogue['undated'][i] else round(float(catalogue['weeks_to_race'][i]), 1)
+  kilometers = scored['km_away'][i]
+  breakdown['km_away'] = None if np.isnan(kilometers) else round(float(kilometers))
+  return breakdown
+
+def top_races(catalogue: Dict[str, Any], scored: Dict[str, np.ndarray], top_n: int) -> List[Dict[str, Any]]:
+  """
+  Pick one athlete's best upcoming races from their row of score_matrix.
+
+  Args:
+  - catalogue (Dict[str, Any]): The races from prepare_races.
+  - scored (Dict[str, np.ndarray]): The athlete's row of every score_matrix output.
+  - top_n (int): How many races to return.
+
+  Returns:
+  - List[Dict[str, Any]]: The top races, best first, each with a "Suitability" score breakdown.
+  """
+  scores = scored['score']
+  top_n = min(top_n, int(np.isfinite(scores).sum()))
+  if top_n == 0:
+    return []
+  top = np.argpartition(-scores, top_n - 1)[:top_n]
+  top = top[np.argsort(-scores[top], kind='stable')]
+  return [{**catalogue['races'][i], 'Suitability': suitability(catalogue, scored, i)} for i in top.tolist()]
+
+def score_races(races: List[Dict[str, Any]], location: Optional[str], profile: Optional[Dict[str, float]],
+                top_n: int = 5, today: Optional[date] = None) -> List[Dict[str, Any]]:
+  """
+  Score every candidate race for an athlete in one vectorised pass and return the best ones.
+
+  The score is a weighted sum (SCORE_WEIGHTS) of:
+  - distance: how well the race's best distance fits the athlete's current long run
+  - build_up: whether the weeks until race day leave enough time to build up to that distance
+  - geo: how close the race's state is to the athlete's state
+  - terrain: trail races suit athletes who train on hills, road races suit everyone
+
+  Cancelled races, races in the past and duplicate races are left out. Without a profile the distance, build-up
+  and terrain components are neutral and races are ranked by proximity.
+
+  Args:
+  - races (List[Dict[str, Any]]): The candidate race records.
+  - location (Optional[str]): The athlete's location, "City, State".
+  - profile (Optional[Dict[str, float]]): The athlete's profile from athlete_profile.
+  - top_n (int, optional): How many races to return. Defaults to 5.
+  - today (Optional[date]): The reference date. Defaults to today.
+
+  Returns:
+  - List[Dict[str, Any]]: The top races, best first, each with a "Suitability" score breakdown.
+  """
+  catalogue = prepare_races(races, today=today)
+  if not catalogue['races']:
+    return []
+  scored = {name: values[0] for name, values in score_matrix(catalogue, profile_arrays([profile]), [location]).items()}
+  return top_races(catalogue, scored, top_n)
@@ -0,0 +1,119 @@
+import asyncio
+import threading
+from typing import Any, Callable, Dict, Hashable
+
+class _Call:
+  """An in-flight computation shared by every caller with the same key."""
+  __slots__ = ('done', 'result', 'error')
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+class SingleFlight:
+  """
+  Coalesces concurrent calls with the same key into a single computation.
+
+  The first caller for a key (the leader) runs the function; callers that arrive while
+  it is still running wait for it and receive the same result or exception. Nothing is
+  cached once the computation finishes.
+  """
+
+  def __init__(self, name: str):
+    self.name = name
+    self._lock = threading.Lock()
+    self._calls: Dict[Hashable, _Call] = {}
+    self._tasks: Dict[Hashable, asyncio.Task] = {}
+    self.leaders = 0
+    self.coalesced = 0
+
+  def do(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Run fn, or wait for the in-flight call with the same key, from a worker thread.
+
+    Args:
+    - key (Hashable): The normalised request key.
+    - fn (Callable[..., Any]): The function to run.
+
+    Returns:
+    - Any: The result of the shared computation.
+    """
+    with self._lock:
+      call = self._calls.get(key)
+      is_leader = call is None
+      if is_leader:
+        call = _Call()
+        self._calls[key] = call
+        self.leaders += 1
+      else:
+        self.coalesced += 1
+
+    if not is_leader:
+      call.done.wait()
+      if call.error is not None:
+        raise call.error
+      return call.result
+
+    try:
+      call.result = fn(*args, **kwargs)
+      return call.result
+    except BaseException as e:
+      call.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+
+  async def ado(self, key: Hashable, fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Await fn, or the in-flight call with the same key, on the running event loop.
+
+    The computation runs as its own task, so a caller disconnecting doesn't cancel it
+    for the others.
+
+    Args:
+    - key (Hashable): The normalised request key.
+    - fn (Callable[..., Any]): The coroutine function to run.
+
+    Returns:
+    - Any: The result of the shared computation.
+    """
+    task = self._tasks.get(key)
+    if task is None:
+      task = asyncio.ensure_future(fn(*args, **kwargs))
+      self._tasks[key] = task
+      task.add_done_callback(lambda _: self._tasks.pop(key, None))
+      with self._lock:
+        self.leaders += 1
+    else:
+      with self._lock:
+        self.coalesced += 1
+    return await asyncio.shield(task)
+
+  def stats(self) -> Dict[str, int]:
+    """
+    Get the coalescing counters.
+
+    Returns:
+    - Dict[str, int]: The number of computations run, requests coalesced into one and calls in flight.
+    """
+    with self._lock:
+      return {
+        'computations': self.leaders,
+        'coalesced': self.coalesced,
+        'in_flight': len(self._calls) + len(self._tasks),
+      }
+
+def normalize_query(query: str) -> str:
+  """
+  Normalise a chat query so trivially different phrasings share a key.
+
+  Args:
+  - query (str): The user query.
+
+  Returns:
+  - str: The lowercased query with collapsed whitespace.
+  """
+  return ' '.join(query.lower().split())
@@ -0,0 +1,117 @@
+"""
+Compare the batch metadata extractor in race_metadata with the per-chunk extraction
+pinecone_service used before it.
+
+Builds a synthetic corpus from lambdas/race_information.json with a share of tentative,
+cancelled and malformed races mixed in, checks both extractors agree on the well-formed races
+and times them.
+
+Usage (from backend/): python benchmarks/metadata_extraction_benchmark.py --chunks 100000 --repeat 3
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from app.utils import race_metadata
+
+def legacy_extract_metadata(text: str, metadata_dict: dict) -> dict:
+  """
+  The previous pinecone_service._extract_metadata, without its print of every date, and
+  with malformed dates reported as None instead of raising.
+  """
+  json_content = json.loads(text)
+  race_date = json_content['Race Date']
+  if "Cancelled" in race_date:
+    metadata_dict['month'] = "Cancelled"
+    metadata_dict['year'] = "Cancelled"
+    return metadata_dict
+  day_of_week, rest = race_date.split(' - ')
+  if "Tentative" in rest or "TBD" in rest or "Unknown Year" in rest or "Past Date" in rest:
+    metadata_dict['month'] = "Tentative"
+    metadata_dict['year'] = "Tentative"
+    return metadata_dict
+  try:
+    month_and_day, year = rest.split(', ')
+    month, day = month_and_day.split(' ')
+  except ValueError:
+    return None
+  race_location = json_content['Location']
+  try:
+    city, state = race_location.split(', ')
+  except Exception as e:
+    city = "check"
+    state = "details"
+  race_distances = json_content['Distances Available']
+  distance_list = list(set(re.findall(r'\d+\.?\d*\s*(?:M|K)', race_distances)))
+  metadata_dict['city'] = city
+  metadata_dict['state'] = state
+  metadata_dict['distances'] = distance_list
+  metadata_dict['text'] = text
+  metadata_dict['month'] = month
+  metadata_dict['year'] = year
+  return metadata_dict
+
+def make_corpus(chunks: int, irregular: float) -> list:
+  with open(os.path.join(BACKEND_DIR, 'lambdas', 'race_information.json')) as f:
+    samples = json.load(f)
+  rng = random.Random(0)
+  texts = []
+  for _ in range(chunks):
+    race = dict(rng.choice(samples))
+    if rng.random() < irregular:
+      kind = rng.randrange(3)
+      if kind == 0:
+        race['Race Date'] = 'Saturday - Cancelled'
+      elif kind == 1:
+        race['Race Date'] = 'Saturday - Jun 1, Tentative'
+      else:
+        race['Location'] = 'Lone Pine, CA to Death Valley, CA'
+    texts.append(json.dumps(race))
+  return texts
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--chunks', type=int, default=100_000)
+  parser.add_argument('--irregular', type=float, default=0.05, help='share of cancelled, tentative and multi-part locations')
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  texts = make_corpus(args.chunks, args.irregular)
+  print(f"JSON decoder: {'orjson' if race_metadata.orjson else 'json'}")
+
+  legacy = [legacy_extract_metadata(text, {}) for text in texts]
+  columns = race_metadata.extract_metadata(texts)
+  batch = race_metadata.metadata_records(columns, texts)
+  compared = mismatched = 0
+  for old, new, status in zip(legacy, batch, columns['date_status']):
+    # the old extractor stored only month and year for undated races
+    if status != race_metadata.DATED or old['city'] == race_metadata.MALFORMED_CITY:
+      continue
+    compared += 1
+    if {**old, 'distances': sorted(old['distances'])} != {**new, 'distances': sorted(new['distances'])}:
+      mismatched += 1
+  print(f'Compared {compared} dated races, {mismatched} mismatches')
+
+  def best_of(fn):
+    timings = []
+    for _ in range(args.repeat):
+      started = time.perf_counter()
+      fn()
+      timings.append(time.perf_counter() - started)
+    return min(timings)
+
+  legacy_seconds = best_of(lambda: [legacy_extract_metadata(text, {}) for text in texts])
+  batch_seconds = best_of(lambda: race_metadata.metadata_records(race_metadata.extract_metadata(texts), texts))
+  columns_seconds = best_of(lambda: race_metadata.extract_metadata(texts))
+  for name, seconds in (('per chunk', legacy_seconds), ('batch (dicts)', batch_seconds), ('batch (columns)', columns_seconds)):
+    print(f'{name:>16}: {seconds:.3f}s ({len(texts) / seconds:,.0f} chunks/s, {legacy_seconds / seconds:.2f}x)')
+
+if __name__ == '__main__':
+  main()
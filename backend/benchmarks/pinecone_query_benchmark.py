@@ -0,0 +1,109 @@
+"""
+Measure filtered query latency and throughput through pinecone_service's index at several
+concurrency levels.
+
+Starts fakes/fake_pinecone_server.py and points pinecone_service at it through PINECONE_HOST,
+unless PINECONE_HOST (or --host) already names an index. Seeds the NAMESPACE namespace with
+random vectors carrying the metadata of the races in lambdas/race_information.json, then runs
+the filters the retriever sends: by state, by state and month, and by distance.
+
+Usage (from backend/): python benchmarks/pinecone_query_benchmark.py --records 20000 --queries 500 --concurrency 1,4,16
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'fakes'))
+
+import fake_pinecone_server
+
+NAMESPACE = 'query-benchmark'
+
+def race_metadata(records: int) -> list:
+  from app.utils import race_metadata
+  with open(os.path.join(BACKEND_DIR, 'lambdas', 'race_information.json')) as f:
+    texts = [json.dumps(race) for race in json.load(f)]
+  columns = race_metadata.extract_metadata(texts)
+  metadata = race_metadata.metadata_records(columns, texts)
+  return [metadata[i % len(metadata)] for i in range(records)]
+
+def make_filters(metadata: list, n: int) -> list:
+  rng = random.Random(0)
+  filters = []
+  for _ in range(n):
+    race = rng.choice(metadata)
+    kind = rng.randrange(3)
+    if kind == 0:
+      filters.append({'state': race['state'], 'month': {'$nin': ['Cancelled', 'Past Date']}})
+    elif kind == 1:
+      filters.append({'$and': [{'state': race['state']}, {'month': {'$in': [race['month'], 'Tentative']}}]})
+    else:
+      filters.append({'distances': {'$in': race['distances'] or ['5K']}})
+  return filters
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--records', type=int, default=20_000)
+  parser.add_argument('--dimensions', type=int, default=256)
+  parser.add_argument('--queries', type=int, default=500)
+  parser.add_argument('--concurrency', default='1,4,16')
+  parser.add_argument('--top-k', type=int, default=6)
+  parser.add_argument('--latency', type=float, default=0.02)
+  parser.add_argument('--port', type=int, default=8006)
+  parser.add_argument('--host', default=os.getenv('PINECONE_HOST'), help='an index host to use instead of starting the stand-in')
+  args = parser.parse_args()
+
+  server = None
+  if args.host is None:
+    server = fake_pinecone_server.serve(args.port, latency=args.latency, capacity=1024)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    args.host = f'http://127.0.0.1:{args.port}'
+  # pinecone_service reads these when it is imported
+  os.environ['PINECONE_HOST'] = args.host
+  os.environ.setdefault('PINECONE_API_KEY', 'local')
+  from app.services import pinecone_service
+
+  metadata = race_metadata(args.records)
+  rng = np.random.default_rng(0)
+  vectors = rng.standard_normal((args.records, args.dimensions)).astype(np.float32)
+  pinecone_service.index.delete(delete_all=True, namespace=NAMESPACE)
+  started = time.perf_counter()
+  for start in range(0, args.records, 100):
+    pinecone_service.index.upsert(vectors=[
+      {'id': f'race-{i}', 'values': vectors[i].tolist(), 'metadata': metadata[i]}
+      for i in range(start, min(start + 100, args.records))
+    ], namespace=NAMESPACE)
+  print(f'Seeded {args.records} vectors in {time.perf_counter() - started:.2f}s')
+
+  filters = make_filters(metadata, args.queries)
+  queries = rng.standard_normal((args.queries, args.dimensions)).astype(np.float32)
+
+  def query(i):
+    started = time.perf_counter()
+    response = pinecone_service.index.query(vector=queries[i].tolist(), top_k=args.top_k, filter=filters[i],
+                                            include_metadata=True, namespace=NAMESPACE)
+    return time.perf_counter() - started, len(response.matches)
+
+  for concurrency in (int(level) for level in args.concurrency.split(',')):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+      results = list(pool.map(query, range(args.queries)))
+    seconds = time.perf_counter() - started
+    latencies = np.array([latency for latency, _ in results]) * 1000
+    print(f'concurrency {concurrency:>3}: {args.queries / seconds:7.1f} queries/s, p50 {np.percentile(latencies, 50):.1f}ms, '
+          f'p95 {np.percentile(latencies, 95):.1f}ms, {np.mean([matches for _, matches in results]):.1f} matches per query')
+
+  if server is not None:
+    print(f'Stand-in saw {server.index.counts}')
+    server.shutdown()
+
+if __name__ == '__main__':
+  main()
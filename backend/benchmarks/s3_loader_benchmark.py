@@ -0,0 +1,80 @@
+"""
+Compare the parallel S3 loader in aws_service with LangChain's S3DirectoryLoader.
+
+Writes a synthetic race corpus to a temporary directory, serves it with fakes/fake_s3_server.py
+and loads it with both loaders. S3DirectoryLoader needs the `unstructured` package; it is
+skipped if that isn't installed.
+
+Usage (from backend/): python benchmarks/s3_loader_benchmark.py --objects 200 --races 50 --latency 0.02
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'fakes'))
+
+import fake_s3_server
+
+BUCKET = 'benchmark'
+PREFIX = 'race-data'
+
+def write_corpus(root: str, objects: int, races: int) -> int:
+  with open(os.path.join(BACKEND_DIR, 'lambdas', 'race_information.json')) as f:
+    samples = json.load(f)
+  rng = random.Random(0)
+  total = 0
+  for i in range(objects):
+    directory = os.path.join(root, BUCKET, PREFIX, f'state_{i % 50}')
+    os.makedirs(directory, exist_ok=True)
+    text = '\n\n'.join(json.dumps(rng.choice(samples)) for _ in range(races))
+    with open(os.path.join(directory, f'races_{i}.txt'), 'w') as f:
+      f.write(text)
+    total += len(text)
+  return total
+
+def report(name: str, seconds: float, documents: int, total_bytes: int) -> None:
+  print(f'{name:>20}: {documents} objects in {seconds:.2f}s '
+        f'({documents / seconds:.1f} objects/s, {total_bytes / seconds / 1e6:.2f} MB/s)')
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--objects', type=int, default=200)
+  parser.add_argument('--races', type=int, default=50)
+  parser.add_argument('--latency', type=float, default=0.02)
+  parser.add_argument('--port', type=int, default=8004)
+  args = parser.parse_args()
+
+  root = tempfile.mkdtemp(prefix='fake-s3-')
+  total_bytes = write_corpus(root, args.objects, args.races)
+  server = fake_s3_server.serve(args.port, root, args.latency)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+
+  endpoint_url = f'http://127.0.0.1:{args.port}'
+  os.environ.update({'S3_ENDPOINT_URL': endpoint_url, 'S3_BUCKET': BUCKET,
+                     'AWS_ACCESS_KEY_ID': 'fake', 'AWS_SECRET_ACCESS_KEY': 'fake', 'AWS_DEFAULT_REGION': 'us-east-1'})
+  from app.services import aws_service
+
+  started = time.perf_counter()
+  documents = aws_service.load_docs(prefix=PREFIX, bucket=BUCKET)
+  report('parallel loader', time.perf_counter() - started, len(documents), total_bytes)
+
+  try:
+    from langchain_community.document_loaders import S3DirectoryLoader
+    loader = S3DirectoryLoader(bucket=BUCKET, prefix=PREFIX, endpoint_url=endpoint_url,
+                               aws_access_key_id='fake', aws_secret_access_key='fake', region_name='us-east-1')
+    started = time.perf_counter()
+    documents = loader.load()
+    report('S3DirectoryLoader', time.perf_counter() - started, len(documents), total_bytes)
+  except ImportError as e:
+    print(f'Skipping S3DirectoryLoader: {e}')
+  server.shutdown()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,109 @@
+"""
+Compare the adaptive UpsertScheduler with the fixed 30 threads x 100 vectors upload it replaced,
+against fakes/fake_pinecone_server.py throttling above --capacity concurrent requests.
+
+The fixed upload sends every batch once, as before, and reports how many were lost. With --host
+(or PINECONE_HOST) both run against that index instead, e.g. a stand-in started separately; they
+only write to and clear the NAMESPACE namespace.
+
+Usage (from backend/): python benchmarks/upsert_scheduler_benchmark.py --records 20000 --capacity 8 --error-rate 0.02
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import requests
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, 'fakes'))
+
+import fake_pinecone_server
+from app.services import upsert_scheduler
+
+NAMESPACE = 'upsert-benchmark'
+HEADERS = {'Api-Key': os.getenv('PINECONE_API_KEY') or 'local'}
+
+def make_records(n: int, dimensions: int) -> list:
+  rng = np.random.default_rng(0)
+  vectors = rng.standard_normal((n, dimensions)).astype(np.float32)
+  return [{'id': f'race-{i}', 'values': vector.tolist(), 'metadata': {'state': 'CA'}} for i, vector in enumerate(vectors)]
+
+def make_upsert(host: str):
+  def upsert(records):
+    response = requests.post(f'{host}/vectors/upsert', json={'vectors': records, 'namespace': NAMESPACE}, headers=HEADERS, timeout=30)
+    response.raise_for_status()
+    return response.json()
+  return upsert
+
+def index_request(host: str, path: str, body: dict) -> dict:
+  # the bookkeeping requests are retried through injected errors and throttling
+  for attempt in range(10):
+    response = requests.post(f'{host}{path}', json=body, headers=HEADERS, timeout=30)
+    if response.status_code not in (429, 503):
+      break
+    time.sleep(0.1 * 2 ** attempt)
+  response.raise_for_status()
+  return response.json()
+
+def fixed(upsert, records: list) -> dict:
+  batches = [records[start:start + 100] for start in range(0, len(records), 100)]
+  failed = []
+
+  def send(batch):
+    try:
+      upsert(batch)
+    except requests.HTTPError:
+      failed.append(batch)
+
+  with ThreadPoolExecutor(max_workers=30) as pool:
+    list(pool.map(send, batches))
+  return {'lost_batches': len(failed), 'lost_records': sum(len(batch) for batch in failed)}
+
+def adaptive(upsert, records: list) -> dict:
+  scheduler = upsert_scheduler.UpsertScheduler(upsert)
+  # submit in the pipeline's batches of 100, like the embed stage does
+  for start in range(0, len(records), 100):
+    scheduler.submit(records[start:start + 100])
+  return scheduler.close()
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--records', type=int, default=20_000)
+  parser.add_argument('--dimensions', type=int, default=256)
+  parser.add_argument('--capacity', type=int, default=8)
+  parser.add_argument('--latency', type=float, default=0.05)
+  parser.add_argument('--latency-per-vector', type=float, default=0.0005)
+  parser.add_argument('--error-rate', type=float, default=0.02)
+  parser.add_argument('--port', type=int, default=8005)
+  parser.add_argument('--host', default=os.getenv('PINECONE_HOST'), help='an index host to use instead of starting the stand-in')
+  args = parser.parse_args()
+
+  records = make_records(args.records, args.dimensions)
+  for name, upload in (('fixed 30 x 100', fixed), ('adaptive', adaptive)):
+    server = None
+    host = args.host
+    if host is None:
+      server = fake_pinecone_server.serve(args.port, args.latency, args.latency_per_vector, args.capacity, args.error_rate)
+      threading.Thread(target=server.serve_forever, daemon=True).start()
+      host = f'http://127.0.0.1:{args.port}'
+    index_request(host, '/vectors/delete', {'deleteAll': True, 'namespace': NAMESPACE})
+    started = time.perf_counter()
+    try:
+      result = upload(make_upsert(host), records)
+    except Exception as e:
+      result = {'error': str(e)}
+    seconds = time.perf_counter() - started
+    namespaces = index_request(host, '/describe_index_stats', {}).get('namespaces', {})
+    stored = namespaces.get(NAMESPACE, {}).get('vectorCount', 0)
+    print(f'{name:>16}: {stored}/{len(records)} records stored in {seconds:.2f}s ({stored / seconds:.0f} records/s), '
+          f"server saw {server.index.counts if server else 'n/a'}, {result}")
+    if server is not None:
+      server.shutdown()
+      server.server_close()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,88 @@
+"""
+Check the UpsertScheduler against fakes/fake_pinecone_server.py: with injected 503s and
+throttling every record still ends up stored and the window shrinks, and a 4xx is given up on
+without a retry.
+
+Exits non-zero on the first failed check.
+
+Usage (from backend/): python benchmarks/upsert_scheduler_check.py --records 5000 --error-rate 0.2
+"""
+import os
+import sys
+import random
+import argparse
+import threading
+import requests
+
+# retry quickly, the checks only care whether a request is retried
+os.environ.setdefault('UPSERT_RETRY_BASE_SECONDS', '0.02')
+
+from upsert_scheduler_benchmark import NAMESPACE, fake_pinecone_server, index_request, make_records, make_upsert, upsert_scheduler
+
+def start(port: int, capacity: int, error_rate: float):
+  server = fake_pinecone_server.serve(port, latency=0.01, latency_per_vector=0.0, capacity=capacity, error_rate=error_rate)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server, f'http://127.0.0.1:{port}'
+
+def stop(server) -> None:
+  server.shutdown()
+  server.server_close()
+
+def check_stores_everything(port: int, records: int, error_rate: float) -> None:
+  # a window of 8 against a capacity of 2 is throttled straight away
+  server, host = start(port, capacity=2, error_rate=error_rate)
+  try:
+    scheduler = upsert_scheduler.UpsertScheduler(make_upsert(host), concurrency=8)
+    batch = make_records(records, 16)
+    for start_at in range(0, len(batch), 100):
+      scheduler.submit(batch[start_at:start_at + 100])
+    stats = scheduler.close()
+    stored = index_request(host, '/describe_index_stats', {})['namespaces'].get(NAMESPACE, {}).get('vectorCount', 0)
+    assert stored == records, f'{stored}/{records} records stored'
+    assert server.index.counts['throttled'] and server.index.counts['failed'], f'no 429 or no 503 was injected: {server.index.counts}'
+    assert stats['retries'] > 0, f'no request was retried, server saw {server.index.counts}'
+    assert stats['decreases'] > 0 and stats['window'] < 8, f"window never shrank: {stats}"
+    print(f'ok: {stored}/{records} stored through {server.index.counts["throttled"]} 429s and '
+          f'{server.index.counts["failed"]} 503s, {stats["decreases"]} decreases, final window {stats["window"]}')
+  finally:
+    stop(server)
+
+def check_permanent_error(port: int) -> None:
+  server, host = start(port, capacity=8, error_rate=0.0)
+  try:
+    upsert = make_upsert(host)
+    # the first upsert fixes the index dimension, the next one doesn't match it and gets a 400
+    upsert(make_records(1, 16))
+    requests_before = server.index.counts['requests']
+    scheduler = upsert_scheduler.UpsertScheduler(upsert, concurrency=1)
+    scheduler.submit(make_records(10, 8))
+    try:
+      scheduler.close()
+    except requests.HTTPError as e:
+      assert e.response.status_code == 400, f'expected a 400, got {e.response.status_code}'
+    else:
+      raise AssertionError('a dimension mismatch was accepted')
+    sent = server.index.counts['requests'] - requests_before
+    assert scheduler.counts['retries'] == 0 and sent == 1, f"a 400 was retried: {sent} requests, {scheduler.counts['retries']} retries"
+    print('ok: a 400 failed the upload after 1 request, without retries')
+  finally:
+    stop(server)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--records', type=int, default=5000)
+  parser.add_argument('--error-rate', type=float, default=0.2)
+  parser.add_argument('--port', type=int, default=8007)
+  args = parser.parse_args()
+
+  # the stand-in draws its injected failures from the global generator
+  random.seed(0)
+  check_stores_everything(args.port, args.records, args.error_rate)
+  check_permanent_error(args.port + 1)
+
+if __name__ == '__main__':
+  try:
+    main()
+  except AssertionError as e:
+    print(f'FAILED: {e}')
+    sys.exit(1)
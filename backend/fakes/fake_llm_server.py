@@ -0,0 +1,69 @@
+"""
+Local stand-in for an OpenAI-compatible chat completions API (OpenAI, Groq).
+
+Point a provider at it with OPENAI_API_BASE=http://127.0.0.1:8001/v1 or
+GROQ_API_BASE=http://127.0.0.1:8002 to exercise the LLM router offline.
+
+Usage: python fakes/fake_llm_server.py --port 8001 --latency 0.5 --jitter 0.3 --error-rate 0.1
+"""
+import json
+import time
+import random
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def make_handler(name: str, latency: float, jitter: float, error_rate: float):
+  class FakeLLMHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+      if not self.path.endswith('/chat/completions'):
+        self.send_error(404)
+        return
+      length = int(self.headers.get('Content-Length', 0))
+      body = json.loads(self.rfile.read(length) or b'{}')
+
+      time.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+      if random.random() < error_rate:
+        self.send_error(503, 'injected failure')
+        return
+
+      response = {
+        'id': f'chatcmpl-{random.getrandbits(32):x}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', name),
+        'choices': [{
+          'index': 0,
+          'message': {'role': 'assistant', 'content': f'answer from {name}'},
+          'finish_reason': 'stop',
+        }],
+        'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+      }
+      payload = json.dumps(response).encode('utf-8')
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(payload)))
+      self.end_headers()
+      self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+      pass
+
+  return FakeLLMHandler
+
+def serve(port: int, name: str = 'fake', latency: float = 0.2, jitter: float = 0.0, error_rate: float = 0.0) -> ThreadingHTTPServer:
+  """
+  Create a fake LLM server. Call serve_forever() on the result, e.g. from a thread.
+  """
+  return ThreadingHTTPServer(('127.0.0.1', port), make_handler(name, latency, jitter, error_rate))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--port', type=int, default=8001)
+  parser.add_argument('--name', default='fake')
+  parser.add_argument('--latency', type=float, default=0.2)
+  parser.add_argument('--jitter', type=float, default=0.0)
+  parser.add_argument('--error-rate', type=float, default=0.0)
+  args = parser.parse_args()
+  server = serve(args.port, args.name, args.latency, args.jitter, args.error_rate)
+  print(f'Fake LLM server "{args.name}" listening on http://127.0.0.1:{args.port}')
+  server.serve_forever()
@@ -0,0 +1,319 @@
+"""
+Local stand-in for the Pinecone data plane, so upserts, queries and caching can be exercised and
+benchmarked offline.
+
+Serves upsert, query (by vector or id, with metadata filters), fetch, delete (by ids, filter or
+all) and describe_index_stats over an in-memory index searched with NumPy. The Pinecone client
+and pinecone_service talk to it with PINECONE_HOST=http://127.0.0.1:8005 and any PINECONE_API_KEY.
+
+Every request sleeps --latency, upserts another --latency-per-vector per vector. Requests fail
+with a 503 at --error-rate and with a 429 while more than --capacity are in flight, like a
+throttling index.
+
+Usage: python fakes/fake_pinecone_server.py --port 8005 --metric cosine --latency 0.05 --capacity 8 --error-rate 0.02
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+def _matches_condition(value, operator: str, operand) -> bool:
+  # list fields such as distances match when any element does, the way Pinecone treats them
+  values = value if isinstance(value, list) else [value]
+  if operator == '$exists':
+    return (value is not None) == bool(operand)
+  if operator == '$eq':
+    return operand in values
+  if operator == '$ne':
+    return operand not in values
+  if operator == '$in':
+    return any(item in operand for item in values)
+  if operator == '$nin':
+    return not any(item in operand for item in values)
+  if value is None or isinstance(value, (list, str, bool)):
+    return False
+  if operator == '$gt':
+    return value > operand
+  if operator == '$gte':
+    return value >= operand
+  if operator == '$lt':
+    return value < operand
+  if operator == '$lte':
+    return value <= operand
+  raise ValueError(f'Unsupported filter operator {operator}')
+
+def matches_filter(metadata: dict, metadata_filter: dict) -> bool:
+  """
+  Evaluate a Pinecone metadata filter, e.g. {"state": "CA", "month": {"$in": ["May", "June"]}}.
+  """
+  for key, condition in (metadata_filter or {}).items():
+    if key == '$and':
+      if not all(matches_filter(metadata, clause) for clause in condition):
+        return False
+    elif key == '$or':
+      if not any(matches_filter(metadata, clause) for clause in condition):
+        return False
+    elif isinstance(condition, dict):
+      if metadata.get(key) is None and not set(condition) & {'$ne', '$nin', '$exists'}:
+        return False
+      if not all(_matches_condition(metadata.get(key), operator, operand) for operator, operand in condition.items()):
+        return False
+    elif metadata.get(key) is None or not _matches_condition(metadata.get(key), '$eq', condition):
+      return False
+  return True
+
+class FakeNamespace:
+  """
+  One namespace's vectors. Queries read a snapshot of them (ids, entries and matrix) that is
+  rebuilt on the first query after a write and never changed, so it can be scored without the
+  index lock, along with the rows each filter matched in it.
+  """
+
+  def __init__(self):
+    self.vectors = {}
+    self._snapshot = None
+    self._rows = {}
+
+  def write(self) -> None:
+    self._snapshot = None
+    self._rows = {}
+
+  def snapshot(self):
+    if self._snapshot is None:
+      ids = list(self.vectors)
+      # upserts replace an id's entry instead of changing it, so the entries stay as they were
+      entries = [self.vectors[id] for id in ids]
+      matrix = np.array([entry['values'] for entry in entries], dtype=np.float32).reshape(len(ids), -1)
+      self._snapshot = (ids, entries, matrix)
+    return self._snapshot
+
+  def cached_rows(self, key: str):
+    return self._rows.get(key)
+
+  def cache_rows(self, snapshot, key: str, rows: np.ndarray) -> None:
+    # a write since the rows were computed makes them stale
+    if snapshot is self._snapshot:
+      self._rows[key] = rows
+
+def filter_rows(entries: list, metadata_filter: dict) -> np.ndarray:
+  """
+  The rows of a snapshot whose metadata matches a filter.
+  """
+  if not metadata_filter:
+    return np.arange(len(entries))
+  return np.array([i for i, entry in enumerate(entries) if matches_filter(entry['metadata'], metadata_filter)], dtype=np.int64)
+
+class FakeIndex:
+  """
+  The vectors by namespace, plus the request counters the benchmarks report.
+  """
+
+  def __init__(self, capacity: int, metric: str = 'cosine', dimension: int = 0):
+    self.capacity = capacity
+    self.metric = metric
+    self.dimension = dimension
+    self.lock = threading.Lock()
+    self.namespaces = {}
+    self.in_flight = 0
+    self.counts = {'requests': 0, 'throttled': 0, 'failed': 0, 'upserted': 0, 'queries': 0, 'deleted': 0}
+
+  def enter(self) -> bool:
+    with self.lock:
+      self.counts['requests'] += 1
+      if self.in_flight >= self.capacity:
+        self.counts['throttled'] += 1
+        return False
+      self.in_flight += 1
+      return True
+
+  def leave(self) -> None:
+    with self.lock:
+      self.in_flight -= 1
+
+  def upsert(self, vectors: list, namespace: str) -> dict:
+    with self.lock:
+      # check every vector first, a rejected request leaves the index as it was
+      dimension = self.dimension
+      if not dimension and vectors:
+        dimension = len(vectors[0].get('values') or [])
+      for vector in vectors:
+        values = vector.get('values') or []
+        if len(values) != dimension:
+          raise ValueError(f'Vector dimension {len(values)} does not match the dimension of the index {dimension}')
+      self.dimension = dimension
+      stored = self.namespaces.setdefault(namespace, FakeNamespace())
+      for vector in vectors:
+        stored.vectors[vector['id']] = {'values': vector.get('values') or [], 'metadata': vector.get('metadata') or {}}
+      stored.write()
+      self.counts['upserted'] += len(vectors)
+    return {'upsertedCount': len(vectors)}
+
+  def query(self, body: dict) -> dict:
+    namespace = body.get('namespace', '')
+    top_k = int(body.get('topK', 10))
+    key = json.dumps(body.get('filter') or {}, sort_keys=True)
+    with self.lock:
+      self.counts['queries'] += 1
+      stored = self.namespaces.get(namespace)
+      if stored is None:
+        return {'matches': [], 'namespace': namespace, 'usage': {'readUnits': 1}}
+      vector = body.get('vector')
+      if vector is None and body.get('id') in stored.vectors:
+        vector = stored.vectors[body['id']]['values']
+      if vector is None or not stored.vectors:
+        return {'matches': [], 'namespace': namespace, 'usage': {'readUnits': 1}}
+      snapshot = stored.snapshot()
+      rows = stored.cached_rows(key)
+
+    # filter and score outside the lock, so queries run in parallel
+    ids, entries, matrix = snapshot
+    if rows is None:
+      rows = filter_rows(entries, body.get('filter'))
+      with self.lock:
+        stored.cache_rows(snapshot, key, rows)
+    scores = self._scores(matrix[rows], np.asarray(vector, dtype=np.float32))
+    order = np.argsort(-scores, kind='stable')[:top_k]
+    matches = []
+    for i in order.tolist():
+      entry = entries[rows[i]]
+      match = {'id': ids[rows[i]], 'score': float(scores[i]), 'values': entry['values'] if body.get('includeValues') else []}
+      if body.get('includeMetadata'):
+        match['metadata'] = entry['metadata']
+      matches.append(match)
+    return {'matches': matches, 'namespace': namespace, 'usage': {'readUnits': 1 + len(ids) // 1000}}
+
+  def _scores(self, matrix: np.ndarray, vector: np.ndarray) -> np.ndarray:
+    if self.metric == 'euclidean':
+      # higher is better for every metric, so euclidean ranks by negative distance
+      return -np.linalg.norm(matrix - vector, axis=1)
+    scores = matrix @ vector
+    if self.metric == 'cosine':
+      norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+      scores = np.divide(scores, norms, out=np.zeros_like(scores), where=norms > 0)
+    return scores
+
+  def fetch(self, ids: list, namespace: str) -> dict:
+    with self.lock:
+      stored = self.namespaces.get(namespace)
+      vectors = {id: {'id': id, **stored.vectors[id]} for id in ids if stored and id in stored.vectors}
+    return {'vectors': vectors, 'namespace': namespace, 'usage': {'readUnits': 1}}
+
+  def delete(self, body: dict) -> dict:
+    namespace = body.get('namespace', '')
+    with self.lock:
+      stored = self.namespaces.get(namespace)
+      if stored is None:
+        return {}
+      if body.get('deleteAll'):
+        ids = list(stored.vectors)
+      elif body.get('filter'):
+        ids = [id for id, vector in stored.vectors.items() if matches_filter(vector['metadata'], body['filter'])]
+      else:
+        ids = body.get('ids') or []
+      for id in ids:
+        stored.vectors.pop(id, None)
+      stored.write()
+      self.counts['deleted'] += len(ids)
+    return {}
+
+  def describe(self, metadata_filter: dict = None) -> dict:
+    with self.lock:
+      namespaces = {
+        name: {'vectorCount': sum(1 for vector in stored.vectors.values() if matches_filter(vector['metadata'], metadata_filter))}
+        for name, stored in self.namespaces.items()
+      }
+    return {'namespaces': namespaces, 'dimension': self.dimension, 'indexFullness': 0.0,
+            'totalVectorCount': sum(namespace['vectorCount'] for namespace in namespaces.values()),
+            'metric': self.metric, 'vectorType': 'dense'}
+
+def make_handler(index: FakeIndex, latency: float, latency_per_vector: float, error_rate: float):
+  class FakePineconeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status: int, body: dict):
+      payload = json.dumps(body).encode('utf-8')
+      self.send_response(status)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(payload)))
+      self.end_headers()
+      self.wfile.write(payload)
+
+    def _read_json(self) -> dict:
+      length = int(self.headers.get('Content-Length', 0))
+      return json.loads(self.rfile.read(length) or b'{}')
+
+    def _route(self, path: str, params: dict, body: dict) -> dict:
+      if path == '/vectors/upsert':
+        return index.upsert(body.get('vectors', []), body.get('namespace', ''))
+      if path == '/query':
+        return index.query(body)
+      if path == '/vectors/fetch':
+        return index.fetch(params.get('ids', []), params.get('namespace', [''])[0])
+      if path == '/vectors/delete':
+        return index.delete(body)
+      if path == '/describe_index_stats':
+        return index.describe(body.get('filter'))
+      return None
+
+    def _handle(self, body: dict):
+      url = urlparse(self.path)
+      params = parse_qs(url.query)
+      if not index.enter():
+        return self._send_json(429, {'code': 8, 'message': 'Too many requests, the index is throttling'})
+      try:
+        time.sleep(latency + latency_per_vector * len(body.get('vectors', [])))
+        if random.random() < error_rate:
+          with index.lock:
+            index.counts['failed'] += 1
+          return self._send_json(503, {'code': 14, 'message': 'injected failure'})
+        try:
+          response = self._route(url.path, params, body)
+        except ValueError as e:
+          return self._send_json(400, {'code': 3, 'message': str(e)})
+        if response is None:
+          return self._send_json(404, {'code': 5, 'message': f'Not found: {url.path}'})
+        self._send_json(200, response)
+      finally:
+        index.leave()
+
+    def do_POST(self):
+      self._handle(self._read_json())
+
+    def do_GET(self):
+      self._handle({})
+
+    def do_DELETE(self):
+      self._handle({})
+
+    def log_message(self, format, *args):
+      pass
+
+  return FakePineconeHandler
+
+def serve(port: int, latency: float = 0.05, latency_per_vector: float = 0.0005, capacity: int = 8,
+          error_rate: float = 0.0, metric: str = 'cosine') -> ThreadingHTTPServer:
+  """
+  Create a fake Pinecone index server. Call serve_forever() on the result, e.g. from a thread;
+  its `index` attribute holds the stored vectors and request counters.
+  """
+  index = FakeIndex(capacity, metric)
+  server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(index, latency, latency_per_vector, error_rate))
+  server.index = index
+  return server
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--port', type=int, default=8005)
+  parser.add_argument('--metric', choices=('cosine', 'dotproduct', 'euclidean'), default='cosine')
+  parser.add_argument('--latency', type=float, default=0.05)
+  parser.add_argument('--latency-per-vector', type=float, default=0.0005)
+  parser.add_argument('--capacity', type=int, default=8)
+  parser.add_argument('--error-rate', type=float, default=0.0)
+  args = parser.parse_args()
+  server = serve(args.port, args.latency, args.latency_per_vector, args.capacity, args.error_rate, args.metric)
+  print(f'Fake Pinecone index listening on http://127.0.0.1:{args.port}')
+  server.serve_forever()
@@ -0,0 +1,120 @@
+"""
+Local stand-in for the subset of the S3 API the backend uses, backed by a directory.
+
+Every subdirectory of --root is a bucket and every file below it an object. Serves
+ListObjectsV2 (with pagination), GetObject (with byte ranges) and HeadObject, so both boto3
+and LangChain's S3DirectoryLoader work against it. Point the backend at it with
+S3_ENDPOINT_URL=http://127.0.0.1:8004 and any AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY.
+
+Usage: python fakes/fake_s3_server.py --root ./s3 --port 8004 --latency 0.02
+"""
+import os
+import time
+import hashlib
+import argparse
+from urllib.parse import parse_qs, unquote
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def list_keys(root: str, bucket: str, prefix: str) -> list:
+  bucket_dir = os.path.join(root, bucket)
+  keys = []
+  for directory, _, files in os.walk(bucket_dir):
+    for name in files:
+      key = os.path.relpath(os.path.join(directory, name), bucket_dir).replace(os.sep, '/')
+      if key.startswith(prefix):
+        keys.append(key)
+  return sorted(keys)
+
+def make_handler(root: str, latency: float):
+  class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status: int, payload: bytes, headers: dict = None, content_type: str = 'application/xml', body: bool = True):
+      self.send_response(status)
+      self.send_header('Content-Type', content_type)
+      self.send_header('Content-Length', str(len(payload)))
+      for name, value in (headers or {}).items():
+        self.send_header(name, value)
+      self.end_headers()
+      if body:
+        self.wfile.write(payload)
+
+    def _error(self, status: int, code: str, body: bool = True):
+      self._send(status, f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code></Error>'.encode('utf-8'), body=body)
+
+    def _list(self, bucket: str, params: dict):
+      prefix = params.get('prefix', '')
+      max_keys = int(params.get('max-keys', 1000))
+      # the continuation token is simply the last key of the previous page
+      after = params.get('continuation-token') or params.get('start-after', '')
+      keys = [key for key in list_keys(root, bucket, prefix) if key > after]
+      page, truncated = keys[:max_keys], len(keys) > max_keys
+      contents = ''.join(
+        f'<Contents><Key>{escape(key)}</Key><Size>{os.path.getsize(os.path.join(root, bucket, key))}</Size>'
+        f'<StorageClass>STANDARD</StorageClass></Contents>'
+        for key in page
+      )
+      token = f'<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>' if truncated else ''
+      xml = (f'<?xml version="1.0" encoding="UTF-8"?>'
+             f'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/"><Name>{escape(bucket)}</Name>'
+             f'<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(page)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>'
+             f'<IsTruncated>{str(truncated).lower()}</IsTruncated>{token}{contents}</ListBucketResult>')
+      self._send(200, xml.encode('utf-8'))
+
+    def _object(self, bucket: str, key: str, body: bool):
+      path = os.path.join(root, bucket, *key.split('/'))
+      if not os.path.isfile(path):
+        self._error(404, 'NoSuchKey', body=body)
+        return
+      with open(path, 'rb') as f:
+        data = f.read()
+      headers = {'ETag': '"' + hashlib.md5(data).hexdigest() + '"', 'Accept-Ranges': 'bytes',
+                 'Last-Modified': time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(os.path.getmtime(path)))}
+      byte_range = self.headers.get('Range')
+      if byte_range and byte_range.startswith('bytes='):
+        start, _, end = byte_range[len('bytes='):].partition('-')
+        start, end = int(start), min(int(end) if end else len(data) - 1, len(data) - 1)
+        headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+        self._send(206, data[start:end + 1], headers, 'application/octet-stream', body)
+        return
+      self._send(200, data, headers, 'application/octet-stream', body)
+
+    def _route(self, body: bool):
+      time.sleep(latency)
+      path, _, query = self.path.partition('?')
+      params = {key: values[0] for key, values in parse_qs(query, keep_blank_values=True).items()}
+      bucket, _, key = unquote(path.lstrip('/')).partition('/')
+      if not bucket or not os.path.isdir(os.path.join(root, bucket)):
+        self._error(404, 'NoSuchBucket', body=body)
+      elif not key:
+        self._list(bucket, params)
+      else:
+        self._object(bucket, key, body)
+
+    def do_GET(self):
+      self._route(body=True)
+
+    def do_HEAD(self):
+      self._route(body=False)
+
+    def log_message(self, format, *args):
+      pass
+
+  return FakeS3Handler
+
+def serve(port: int, root: str, latency: float = 0.02) -> ThreadingHTTPServer:
+  """
+  Create a fake S3 server over a directory. Call serve_forever() on the result, e.g. from a thread.
+  """
+  return ThreadingHTTPServer(('127.0.0.1', port), make_handler(root, latency))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--root', default='s3')
+  parser.add_argument('--port', type=int, default=8004)
+  parser.add_argument('--latency', type=float, default=0.02)
+  args = parser.parse_args()
+  server = serve(args.port, args.root, args.latency)
+  print(f'Fake S3 server for {os.path.abspath(args.root)} listening on http://127.0.0.1:{args.port}')
+  server.serve_forever()
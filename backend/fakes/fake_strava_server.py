@@ -0,0 +1,182 @@
+"""
+Local stand-in for the subset of the Strava API the backend uses.
+
+Serves athlete stats, activities and activity streams.
+Athlete stats carry an ETag and honour If-None-Match with a 304. Tracks usage in 15-minute and daily windows, sends X-RateLimit-Limit / X-RateLimit-Usage
+headers and returns 429 once a limit is exceeded, like Strava does. Point the backend at
+it with STRAVA_API_BASE=http://127.0.0.1:8003/api/v3
+
+Usage: python fakes/fake_strava_server.py --port 8003 --short-limit 100 --daily-limit 1000 --latency 0.05 --error-rate 0.0
+"""
+import re
+import json
+import calendar
+import hashlib
+import time
+import random
+import argparse
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SHORT_WINDOW_SECONDS = 15 * 60
+
+def sample_stats(athlete_id: int) -> dict:
+  rng = random.Random(athlete_id)
+  def totals(weeks):
+    count = rng.randint(2, 6) * weeks
+    distance = count * rng.uniform(4000, 16000)
+    return {
+      'count': count,
+      'distance': distance,
+      'moving_time': int(distance / rng.uniform(2.5, 4.2)),
+      'elapsed_time': int(distance / 2.4),
+      'elevation_gain': distance * rng.uniform(0.002, 0.02),
+    }
+  return {'recent_run_totals': totals(4), 'ytd_run_totals': totals(40), 'all_run_totals': totals(200)}
+
+def sample_activities(access_token: str, days: int = 365) -> list:
+  """
+  One athlete's runs over the past `days` days, oldest first. New runs appear as days pass.
+  """
+  athlete_seed = int(hashlib.md5(access_token.encode('utf-8')).hexdigest()[:8], 16)
+  today = int(time.time() // 86400)
+  activities = []
+  for day in range(today - days, today + 1):
+    rng = random.Random(athlete_seed * 100003 + day)
+    if rng.random() < 0.4:
+      continue
+    distance = rng.choice([5000, 8000, 10000, 16000, 21097]) * rng.uniform(0.8, 1.2)
+    activities.append({
+      'id': athlete_seed * 1000 + day,
+      'type': 'Run', 'sport_type': rng.choice(['Run', 'Run', 'TrailRun']),
+      'start_date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(day * 86400 + 7 * 3600)),
+      'distance': distance,
+      'moving_time': int(distance / rng.uniform(2.6, 4.0)),
+      'total_elevation_gain': distance * rng.uniform(0.002, 0.03),
+    })
+  return activities
+
+def sample_streams(activity_id: int) -> dict:
+  """
+  Per-second time and distance streams of an activity, with the pace drifting over the run.
+  """
+  rng = random.Random(activity_id)
+  seconds = rng.randint(1200, 7200)
+  speed, distance = rng.uniform(2.6, 4.0), 0.0
+  time_data, distance_data = [], []
+  for second in range(seconds):
+    speed = min(max(speed + rng.gauss(0, 0.05), 1.5), 6.0)
+    time_data.append(second)
+    distance_data.append(round(distance, 1))
+    distance += speed
+  return {
+    'time': {'data': time_data, 'series_type': 'distance', 'original_size': seconds, 'resolution': 'high'},
+    'distance': {'data': distance_data, 'series_type': 'distance', 'original_size': seconds, 'resolution': 'high'},
+  }
+
+class RateLimits:
+  def __init__(self, short_limit: int, daily_limit: int):
+    self.short_limit, self.daily_limit = short_limit, daily_limit
+    self.short_window, self.day = None, None
+    self.short_used, self.daily_used = 0, 0
+    self.lock = threading.Lock()
+
+  def hit(self):
+    with self.lock:
+      now = time.time()
+      short_window, day = int(now // SHORT_WINDOW_SECONDS), int(now // 86400)
+      if short_window != self.short_window:
+        self.short_window, self.short_used = short_window, 0
+      if day != self.day:
+        self.day, self.daily_used = day, 0
+      self.short_used += 1
+      self.daily_used += 1
+      limited = self.short_used > self.short_limit or self.daily_used > self.daily_limit
+      headers = {
+        'X-RateLimit-Limit': f'{self.short_limit},{self.daily_limit}',
+        'X-RateLimit-Usage': f'{self.short_used},{self.daily_used}',
+      }
+      return limited, headers
+
+def make_handler(limits: RateLimits, latency: float, error_rate: float):
+  class FakeStravaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, body, headers):
+      payload = json.dumps(body).encode('utf-8')
+      self.send_response(status)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(payload)))
+      for name, value in headers.items():
+        self.send_header(name, value)
+      self.end_headers()
+      self.wfile.write(payload)
+
+    def do_GET(self):
+      time.sleep(latency)
+      limited, headers = limits.hit()
+      if limited:
+        self._send_json(429, {'message': 'Rate Limit Exceeded'}, headers)
+        return
+      if random.random() < error_rate:
+        self._send_json(503, {'message': 'injected failure'}, headers)
+        return
+
+      path, _, query = self.path.partition('?')
+      params = {key: values[0] for key, values in parse_qs(query).items()}
+      if path == '/api/v3/athlete/activities':
+        activities = sample_activities(self.headers.get('Authorization', ''))
+        # like Strava, activities come oldest first when `after` is given and newest first otherwise
+        if 'after' in params:
+          after = int(params['after'])
+          activities = [a for a in activities if calendar.timegm(time.strptime(a['start_date'], '%Y-%m-%dT%H:%M:%SZ')) > after]
+        else:
+          activities.reverse()
+        page, per_page = int(params.get('page', 1)), int(params.get('per_page', 30))
+        self._send_json(200, activities[(page - 1) * per_page:page * per_page], headers)
+        return
+
+      match = re.fullmatch(r'/api/v3/activities/(\d+)/streams', path)
+      if match:
+        self._send_json(200, sample_streams(int(match.group(1))), headers)
+        return
+
+      match = re.fullmatch(r'/api/v3/athletes/(\d+)/stats', path)
+      if match:
+        stats = sample_stats(int(match.group(1)))
+        etag = '"' + hashlib.md5(json.dumps(stats, sort_keys=True).encode('utf-8')).hexdigest() + '"'
+        headers['ETag'] = etag
+        if self.headers.get('If-None-Match') == etag:
+          self.send_response(304)
+          for name, value in headers.items():
+            self.send_header(name, value)
+          self.send_header('Content-Length', '0')
+          self.end_headers()
+          return
+        self._send_json(200, stats, headers)
+        return
+      self._send_json(404, {'message': 'Record Not Found'}, headers)
+
+    def log_message(self, format, *args):
+      pass
+
+  return FakeStravaHandler
+
+def serve(port: int, short_limit: int = 100, daily_limit: int = 1000, latency: float = 0.05, error_rate: float = 0.0) -> ThreadingHTTPServer:
+  """
+  Create a fake Strava server. Call serve_forever() on the result, e.g. from a thread.
+  """
+  return ThreadingHTTPServer(('127.0.0.1', port), make_handler(RateLimits(short_limit, daily_limit), latency, error_rate))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--port', type=int, default=8003)
+  parser.add_argument('--short-limit', type=int, default=100)
+  parser.add_argument('--daily-limit', type=int, default=1000)
+  parser.add_argument('--latency', type=float, default=0.05)
+  parser.add_argument('--error-rate', type=float, default=0.0)
+  args = parser.parse_args()
+  server = serve(args.port, args.short_limit, args.daily_limit, args.latency, args.error_rate)
+  print(f'Fake Strava server listening on http://127.0.0.1:{args.port}/api/v3')
+  server.serve_forever()
@@ -3,6 +3,8 @@ import axios from 'axios';
 
 export const dynamic = 'force-dynamic';
 
+const BACKEND_URL = process.env.BACKEND_URL ?? 'http://127.0.0.1:5000';
+
 export async function GET(request: NextRequest) {
   try {
     const { searchParams } = new URL(request.url);
@@ -19,7 +21,19 @@ export async function GET(request: NextRequest) {
       grant_type: 'authorization_code',
     });
 
-    const { access_token } = response.data;
+    const { access_token, athlete } = response.data;
+
+    // start computing recommendations on the backend while the client loads the athlete profile
+    if (athlete) {
+      await axios.post(`${BACKEND_URL}/prefetch`, {
+        id: athlete.id,
+        location: `${athlete.city}, ${athlete.state}`,
+      }, {
+        headers: { Authorization: `Bearer ${access_token}` },
+        timeout: 2000,
+      }).catch(error => console.error('Error starting recommendation prefetch:', error));
+    }
+
     return NextResponse.json({ access_token });
   } catch (error) {
     console.error('Error exchanging code for token:', error);